@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -55,6 +56,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.db_router.ReadYourWritesMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -83,16 +85,40 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 # Redis Configuration
 REDIS_URL = 'redis://localhost:6379/0'
 
-# Channel Layers using Redis
-CHANNEL_LAYERS = {
-    "default": {
+# Channel layer backend, chosen with the CHANNEL_LAYER environment variable:
+# "redis" (default), "local" for several workers on one host without Redis
+# (processes share a broker over a Unix socket), or "memory" for a single
+# process
+CHANNEL_LAYER = os.environ.get('CHANNEL_LAYER', 'redis')
+CHANNEL_LAYER_SOCKET = os.environ.get('CHANNEL_LAYER_SOCKET')  # Defaults to a path in the temp directory
+
+CHANNEL_LAYER_BACKENDS = {
+    "redis": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [REDIS_URL],
         },
     },
+    "local": {
+        "BACKEND": "core.channel_layers.LocalChannelLayer",
+        "CONFIG": {
+            "path": CHANNEL_LAYER_SOCKET,
+        },
+    },
+    "memory": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+    },
+}
+
+CHANNEL_LAYERS = {
+    "default": CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER],
 }
 
+# Serve the ESP32 polling endpoints (commands, status, command executed) with
+# the async views in core/async_views.py. Only helps under an ASGI server;
+# compare both modes with `manage.py loadtest_esp32`.
+ASYNC_ESP32_VIEWS = False
+
 CSRF_TRUSTED_ORIGINS = [
     'https://currentwatchbackend.onrender.com',
     'http://10.120.37.63:8000',
@@ -105,14 +131,195 @@ CORS_ALLOWED_ORIGINS = [
     "http://localhost:8000",
 ]
 
+# Caches. 'default' is process-local. 'shared' (SHARED_CACHE) is seen by every
+# worker process and holds the state they must agree on: presence counts, the
+# event replay buffer, analytics versions, read-your-writes pins and poll
+# activity. It follows the channel layer: Redis with "redis"; files in the temp
+# directory with "local" (one host, no Redis; its counters are not atomic, so
+# presence and event numbering stay off, see core/presence.py); with "memory"
+# there is only one process and a LocMemCache is enough.
+SHARED_CACHE_BACKENDS = {
+    'redis': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': REDIS_URL},
+    'local': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), f'currentwatch-cache-{os.getuid()}'),
+    },
+    'memory': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+}
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': SHARED_CACHE_BACKENDS[CHANNEL_LAYER],
+}
+SHARED_CACHE = 'shared'
+
+# WebSocket presence: per-user open socket counts kept in this cache alias so
+# send helpers can skip users with no app open. Every process sending events
+# must see every process's sockets; where the counts cannot be trusted users
+# are always treated as online (see core/presence.py).
+WEBSOCKET_PRESENCE_CACHE = SHARED_CACHE
+WEBSOCKET_PRESENCE_TTL = 24 * 60 * 60  # Seconds; bounds how long a crashed worker's counts linger
+
+# Events kept per user so a reconnecting client can resume with ?since=<seq>
+# instead of reloading the full state snapshot
+WEBSOCKET_REPLAY_BUFFER = 200
+WEBSOCKET_REPLAY_TTL = 60 * 60  # Seconds
+
+# WebSocket sends are queued when the request's transaction commits and sent
+# in batches by a background thread (inline with the in-memory layer)
+WEBSOCKET_BACKGROUND_DISPATCH = True
+WEBSOCKET_DISPATCH_BATCH_SIZE = 100
+
+# Energy accounting
+ENERGY_SUPPLY_VOLTAGE = 230.0  # Volts; reported socket amps are converted to watts with this
+ENERGY_MAX_SAMPLE_GAP = 300  # Seconds; longer gaps between reports are not integrated
+
+# Server-side high_current detection (see core/anomaly.py for all parameters)
+CURRENT_ANOMALY_DETECTION = {
+    'z_threshold': 4.0,  # Standard deviations above the EWMA mean counted as outliers
+    'sustain': 3,  # Consecutive outlying reports before alerting
+    'drift_ratio': 0.3,  # Alert when the recent mean exceeds the long-term baseline by 30%
+    'rated_current': 10.0,  # Socket rating in Amps
+    'limit_ratio': 0.85,  # Alert when the recent mean passes 85% of the rating
+}
+
+# next_poll_ms hint in the commands poll response (see core/polling.py)
+POLL_INTERVALS = {
+    'active_ms': 500,  # Commands pending, or a user sent one within active_window
+    'watching_ms': 2000,  # Owner has the app open
+    'idle_ms': 10000,
+    'max_ms': 30000,  # Cap once stretched for load
+    'active_window': 60,  # Seconds
+    'target_latency': 0.1,  # Seconds of poll handling time (EWMA) above which every interval stretches
+    'max_stretch': 4.0,
+}
+# Shared, so a command sent through any worker speeds up the poll served by another
+POLL_ACTIVITY_CACHE = SHARED_CACHE
+
+# With True, pending commands are served from per-controller queues in the
+# serving process (core/command_queue.py), with claims and timeouts written to
+# the database in batches. Only enable it while a single process handles all
+# command and poll requests (one daphne); with several workers a command
+# created in one is never seen by the others. False polls the database.
+COMMAND_QUEUES_IN_MEMORY = False
+COMMAND_PERSIST_BATCH_SIZE = 500
+
+# Reports that change nothing but last_seen are only written once the stored
+# last_seen is HEARTBEAT_RESOLUTION seconds old, batched across rows
+# (core/coalescing.py); skipped writes show up as writes.coalesced. Keep it
+# below ENERGY_MAX_SAMPLE_GAP, since unchanged current is integrated at the
+# next write. Held reports are remembered per process: with several workers a
+# change of current may be spread over up to HEARTBEAT_RESOLUTION seconds
+# instead of one report interval.
+HEARTBEAT_RESOLUTION = 60
+HEARTBEAT_PERSIST_BATCH_SIZE = 500
+
+# Control requests sent with an Idempotency-Key header get their first
+# response replayed to retries (core/idempotency.py): from IDEMPOTENCY_CACHE
+# for IDEMPOTENCY_CACHE_TTL seconds, then from IdempotencyRecord rows until
+# IDEMPOTENCY_TTL seconds have passed
+IDEMPOTENCY_CACHE = 'default'
+IDEMPOTENCY_CACHE_TTL = 10 * 60
+IDEMPOTENCY_TTL = 24 * 60 * 60
+
+# Consumption analytics results and the per-user versions that invalidate
+# them; shared, so a report handled by any worker invalidates for all
+ANALYTICS_CACHE = SHARED_CACHE
+
+# Retention: rows older than `days` (and matching `filter`) are archived to
+# RETENTION_ARCHIVE_ROOT/<table>/<day>.ndjson.gz and deleted by `manage.py apply_retention`
+RETENTION_ARCHIVE_ROOT = BASE_DIR / 'archive'
+RETENTION_POLICIES = {
+    'activitylog': {'days': 90},
+    'devicecommand': {'days': 30, 'filter': {'is_executed': True}},
+    'devicealert': {'days': 180, 'filter': {'is_resolved': True}},
+    'currentreading': {'days': 400, 'date_field': 'recorded_at'},
+    'idempotencyrecord': {'days': 2},
+}
+
+# Rendered pairing QR codes: an in-process LRU of QR_MEMORY_CACHE_SIZE PNGs
+# in front of PNG files under QR_CACHE_ROOT (see core/qr.py)
+QR_CACHE_ROOT = BASE_DIR / 'qr_cache'
+QR_MEMORY_CACHE_SIZE = 512
+QR_LABEL_WORKERS = None  # Processes rendering bulk label sheets; None = one per CPU
+# Most labels the admin's bulk QR action renders within the request; larger
+# selections are pointed at `manage.py generate_qrcodes` instead
+ADMIN_BULK_QR_LIMIT = 500
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# Profile chosen with the DATABASE_PROFILE environment variable:
+# "sqlite" (default): db.sqlite3 in WAL mode with the SQLITE_PRAGMAS below,
+#     applied to every new connection by core/db.py. IMMEDIATE transactions
+#     take the write lock up front, so concurrent writers wait out the busy
+#     timeout instead of failing with "database is locked".
+# "postgres": PostgreSQL through a psycopg connection pool (needs
+#     psycopg[pool]; connection details from the POSTGRES_* variables)
+# Compare them with `manage.py benchmark_database`.
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+
+DATABASE_PROFILES = {
+    'sqlite': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Under ASGI (daphne) sync code runs on a pool of executor threads, each
+        # with its own connection that request_finished never gets to close;
+        # persistent connections would pile up there. Opening a SQLite file is cheap.
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {
+            'timeout': 20,  # Seconds to wait for the write lock
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+    'postgres': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'currentwatch'),
+        'USER': os.environ.get('POSTGRES_USER', 'currentwatch'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        # The pool replaces persistent connections (Django requires CONN_MAX_AGE=0 with it)
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {
+            'pool': {
+                'min_size': 2,
+                'max_size': int(os.environ.get('POSTGRES_POOL_SIZE', 20)),
+                'timeout': 10,
+            },
+        },
+    },
+}
+
+DATABASES = {
+    'default': DATABASE_PROFILES[DATABASE_PROFILE],
+}
+
+# Read replica for the mobile read endpoints and admin changelists, enabled by
+# setting DATABASE_REPLICA_NAME (a SQLite file or Postgres database; the host
+# defaults to the primary's, override with DATABASE_REPLICA_HOST).
+# core/db_router.py routes those reads there and keeps a client on the primary
+# for READ_YOUR_WRITES_WINDOW seconds after it writes.
+READ_REPLICA_ALIAS = 'replica'
+if os.environ.get('DATABASE_REPLICA_NAME'):
+    DATABASES[READ_REPLICA_ALIAS] = {
+        **DATABASES['default'],
+        'NAME': os.environ['DATABASE_REPLICA_NAME'],
+        'HOST': os.environ.get('DATABASE_REPLICA_HOST', DATABASES['default'].get('HOST', '')),
+        'TEST': {'MIRROR': 'default'},
     }
+DATABASE_ROUTERS = ['core.db_router.ReadReplicaRouter']
+READ_YOUR_WRITES_WINDOW = 5  # Seconds
+# Shared, so a write handled by one worker pins the client's reads on all of them
+READ_YOUR_WRITES_CACHE = SHARED_CACHE
+READ_YOUR_WRITES_COOKIE = 'db_primary'
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # Readers no longer block the writer
+    'synchronous': 'NORMAL',  # Safe with WAL; skips an fsync per commit
+    'busy_timeout': 20000,  # Milliseconds
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,  # Negative = KiB
+    'temp_store': 'MEMORY',
 }
 
 
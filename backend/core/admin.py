@@ -1,30 +1,81 @@
-from django.contrib import admin
-from django.utils.crypto import get_random_string
-from .models import UserProfile, Room, Device, Controller, DeviceCommand, DeviceAlert, ActivityLog
+import os
+import shlex
+import tempfile
+import zipfile
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from .models import UserProfile, Room, Device, Controller, DeviceCommand, DeviceAlert, ActivityLog, EnergyBucket, MaintenanceCheckpoint
 from django.utils.html import format_html
-import qrcode
-from io import BytesIO
-import base64
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.urls import path, reverse
+from django.utils.http import parse_etags
+from .command_latency import stage_seconds
+from .command_queue import command_queues
+from .db_router import read_from_replica
+from .metrics import metrics
+from .qr import qr_cache, qr_etag
+from .qr_labels import generate_label_sheets
 from django.utils.safestring import mark_safe
 from django.utils import timezone
+from django.utils.decorators import method_decorator
+
+def count_related(model, field, **filters):
+    """Correlated subquery counting the ``model`` rows whose ``field`` is the outer row.
+
+    One subquery per relation, rather than Count() over several reverse joins
+    whose rows multiply each other before being counted.
+    """
+    counts = (
+        model.objects.filter(**{field: OuterRef('pk')}, **filters)
+        .order_by().values(field).annotate(count=Count('pk')).values('count')
+    )
+    return Coalesce(Subquery(counts), 0)
+
+class ReadReplicaModelAdmin(admin.ModelAdmin):
+    """Changelist pages read from the read replica; change forms and actions stay on the primary"""
 
-class UserProfileAdmin(admin.ModelAdmin):
+    @method_decorator(read_from_replica)
+    def changelist_view(self, request, extra_context=None):
+        return super().changelist_view(request, extra_context)
+
+class RoomListFilter(admin.RelatedFieldListFilter):
+    """Room filter whose choices load their owners in the same query (Room.__str__ shows the owner)"""
+
+    def field_choices(self, field, request, model_admin):
+        rooms = Room.objects.select_related('owner').order_by('name')
+        return [(room.pk, str(room)) for room in rooms]
+
+class UserProfileAdmin(ReadReplicaModelAdmin):
     list_display = ('email', 'full_name', 'phone_number', 'phone_verified', 'room_count', 'device_count', 'controller_count', 'created_at')
     list_filter = ('phone_verified', 'created_at')
     search_fields = ('email', 'full_name', 'phone_number')
     readonly_fields = ('created_at',)
     
+    def get_queryset(self, request):
+        # Count related rows in the changelist query instead of once per row
+        return super().get_queryset(request).annotate(
+            _room_count=count_related(Room, 'owner'),
+            _device_count=count_related(Device, 'owner', is_paired=True),
+            _controller_count=count_related(Controller, 'owner'),
+        )
+
     def room_count(self, obj):
-        return obj.rooms.count()
+        return obj._room_count
     room_count.short_description = 'Rooms'
+    room_count.admin_order_field = '_room_count'
     
     def device_count(self, obj):
-        return obj.devices.filter(is_paired=True).count()
+        return obj._device_count
     device_count.short_description = 'Paired Devices'
+    device_count.admin_order_field = '_device_count'
     
     def controller_count(self, obj):
-        return obj.controllers.count()
+        return obj._controller_count
     controller_count.short_description = 'Controllers'
+    controller_count.admin_order_field = '_controller_count'
 
 class DeviceInline(admin.TabularInline):
     model = Device
@@ -44,20 +95,28 @@ class ControllerInline(admin.TabularInline):
     fields = ('controller_id', 'name', 'is_online', 'last_seen', 'ip_address')
     readonly_fields = ('controller_id', 'last_seen')
 
-class RoomAdmin(admin.ModelAdmin):
+class RoomAdmin(ReadReplicaModelAdmin):
     list_display = ('name', 'owner', 'icon', 'device_count', 'controller_count', 'created_at')
     list_filter = ('owner', 'created_at')
     search_fields = ('name', 'owner__email')
     readonly_fields = ('created_at',)
     inlines = [DeviceInline, ControllerInline]
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('owner').annotate(
+            _device_count=count_related(Device, 'room'),
+            _controller_count=count_related(Controller, 'room'),
+        )
+
     def device_count(self, obj):
-        return obj.devices.count()
+        return obj._device_count
     device_count.short_description = 'Devices'
+    device_count.admin_order_field = '_device_count'
     
     def controller_count(self, obj):
-        return obj.controllers.count()
+        return obj._controller_count
     controller_count.short_description = 'Controllers'
+    controller_count.admin_order_field = '_controller_count'
 
 class DeviceCommandInline(admin.TabularInline):
     model = DeviceCommand
@@ -77,13 +136,13 @@ class DeviceAlertInline(admin.TabularInline):
     fields = ('alert_type', 'message', 'created_at', 'is_resolved')
     readonly_fields = ('created_at',)
 
-class ControllerAdmin(admin.ModelAdmin):
+class ControllerAdmin(ReadReplicaModelAdmin):
     list_display = ('controller_id', 'name', 'owner', 'room', 'is_online', 'device_count', 'pending_commands', 'last_seen', 'ip_address')
-    list_filter = ('is_online', 'owner', 'room', 'created_at')
+    list_filter = ('is_online', 'owner', ('room', RoomListFilter), 'created_at')
     search_fields = ('controller_id', 'name', 'owner__email', 'ip_address')
     readonly_fields = ('created_at', 'last_seen')
     inlines = [DeviceInline, DeviceCommandInline, DeviceAlertInline]
-    actions = ['mark_online', 'mark_offline', 'clear_pending_commands']
+    actions = ['mark_online', 'mark_offline', 'clear_pending_commands', 'generate_bulk_qr']
     
     fieldsets = (
         ('Controller Information', {
@@ -101,16 +160,24 @@ class ControllerAdmin(admin.ModelAdmin):
         }),
     )
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('owner', 'room__owner').annotate(
+            _device_count=count_related(Device, 'controller'),
+            _pending_commands=count_related(DeviceCommand, 'controller', is_executed=False),
+        )
+
     def device_count(self, obj):
-        return obj.devices.count()
+        return obj._device_count
     device_count.short_description = 'Devices'
+    device_count.admin_order_field = '_device_count'
     
     def pending_commands(self, obj):
-        count = obj.commands.filter(is_executed=False).count()
+        count = obj._pending_commands
         if count > 0:
             return format_html('<span style="color: orange; font-weight: bold;">{}</span>', count)
         return count
     pending_commands.short_description = 'Pending Commands'
+    pending_commands.admin_order_field = '_pending_commands'
     
     def mark_online(self, request, queryset):
         count = queryset.update(is_online=True, last_seen=timezone.now())
@@ -131,35 +198,56 @@ class ControllerAdmin(admin.ModelAdmin):
     clear_pending_commands.short_description = "Clear pending commands for selected controllers"
 
     def generate_bulk_qr(self, request, queryset):
-        for controller in queryset:
-            devices_data = []
-            for device in controller.devices.all():
-                devices_data.append({
-                    'device_id': device.device_id,
-                    'name': device.name,
-                    'type': device.type,
-                    'hardware_pin': device.hardware_pin
-                })
-            
-            bulk_qr = BulkDeviceQR.objects.create(
-                qr_id=get_random_string(12),
-                controller=controller,
-                devices_data=devices_data
+        """Download label sheets (PDF) and individual code PNGs for the selected controllers"""
+        devices = (
+            Device.objects.filter(controller__in=queryset)
+            .exclude(pairing_code__isnull=True).exclude(pairing_code='')
+            .order_by('controller__controller_id', 'device_id')
+            .values_list('device_id', 'pairing_code', 'name')
+        )
+        total = devices.count()
+        if not total:
+            self.message_user(request, "Selected controllers have no devices with pairing codes", level=messages.WARNING)
+            return None
+        limit = getattr(settings, 'ADMIN_BULK_QR_LIMIT', 500)
+        if total > limit:
+            # Too slow for a request; the command renders on all CPUs without a timeout
+            controllers = ' '.join(
+                f'--controller {shlex.quote(controller_id)}'
+                for controller_id in queryset.order_by('controller_id').values_list('controller_id', flat=True)
+            )
+            self.message_user(
+                request,
+                f"{total} labels is more than the {limit} rendered here; run "
+                f"`python manage.py generate_qrcodes {controllers}` instead",
+                level=messages.WARNING
             )
-            
-            self.message_user(request, f"Generated bulk QR for {controller.controller_id}: {bulk_qr.qr_id}")
+            return None
+
+        # Render into a temporary directory, then bundle sheets and codes into one ZIP
+        bundle = tempfile.TemporaryFile()
+        with tempfile.TemporaryDirectory() as work_dir:
+            sheet_path = os.path.join(work_dir, 'labels.pdf')
+            result = generate_label_sheets(devices.iterator(chunk_size=2000), sheet_path, bundle)
+            with zipfile.ZipFile(bundle, 'a') as archive:
+                archive.write(sheet_path, 'labels.pdf')
+        bundle.seek(0)
+
+        self.message_user(request, f"Generated {result['labels']} QR labels on {result['pages']} pages")
+        return FileResponse(bundle, as_attachment=True, filename='pairing_qr_codes.zip', content_type='application/zip')
 
-    generate_bulk_qr.short_description = "Generate Bulk QR for all devices"
+    generate_bulk_qr.short_description = "Download QR label sheets for all devices"
 
-class DeviceAdmin(admin.ModelAdmin):
+class DeviceAdmin(ReadReplicaModelAdmin):
     list_display = (
         'device_id', 'name', 'hardware_pin_display', 'type', 'owner', 'room', 
         'controller', 'is_paired', 'status', 'current_display', 'pairing_code', 
         'qr_code_preview', 'last_seen'
     )
-    list_filter = ('type', 'is_paired', 'status', 'owner', 'room', 'controller', 'created_at')
+    list_filter = ('type', 'is_paired', 'status', 'owner', ('room', RoomListFilter), 'controller', 'created_at')
     search_fields = ('device_id', 'name', 'pairing_code', 'owner__email', 'hardware_pin')
-    readonly_fields = ('qr_code_preview', 'created_at', 'last_seen', 'device_info_summary')
+    # Codes come from the PairingCodeBlock allocator (save / the generate action), never typed in
+    readonly_fields = ('pairing_code', 'qr_code_preview', 'created_at', 'last_seen', 'device_info_summary')
     actions = ['generate_pairing_codes', 'unpair_devices', 'pair_devices', 'turn_on_devices', 'turn_off_devices']
     inlines = [DeviceCommandInline, DeviceAlertInline]
     
@@ -210,34 +298,45 @@ class DeviceAdmin(admin.ModelAdmin):
 
     def qr_code_preview(self, obj):
         if obj.pairing_code:
-            # Generate QR code on the fly for display
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=4,
-                border=2,
-            )
-            qr_data = f"device_id:{obj.device_id}|pairing_code:{obj.pairing_code}"
-            qr.add_data(qr_data)
-            qr.make(fit=True)
-            
-            img = qr.make_image(fill_color="black", back_color="white")
-            buffer = BytesIO()
-            img.save(buffer, format="PNG")
-            img_b64 = base64.b64encode(buffer.getvalue()).decode()
-            
+            # The image is served (and browser-cached) by qr_image_view; the etag in
+            # the query string changes the URL whenever the pairing code changes
+            url = reverse('admin:core_device_qr', args=[obj.pk])
             return format_html(
-                '<img src="data:image/png;base64,{}" width="100" height="100" />',
-                img_b64
+                '<img src="{}?v={}" width="100" height="100" loading="lazy" />',
+                url, qr_etag(obj.device_id, obj.pairing_code, 'thumb')
             )
         return "No pairing code generated"
     qr_code_preview.short_description = 'QR Code'
 
+    def get_urls(self):
+        urls = [
+            path('<int:object_id>/qr.png', self.admin_site.admin_view(self.qr_image_view, cacheable=True), name='core_device_qr'),
+        ]
+        return urls + super().get_urls()
+
+    def qr_image_view(self, request, object_id):
+        """Pairing QR preview as a cacheable PNG"""
+        device = Device.objects.filter(pk=object_id).only('device_id', 'pairing_code').first()
+        if device is None or not device.pairing_code:
+            raise Http404("No pairing code for this device")
+
+        size = 'full' if request.GET.get('size') == 'full' else 'thumb'
+        etag = f'"{qr_etag(device.device_id, device.pairing_code, size)}"'
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            _, png = qr_cache.get(device.device_id, device.pairing_code, size)
+            response = HttpResponse(png, content_type='image/png')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=86400'
+        return response
+
     def generate_pairing_codes(self, request, queryset):
         count = 0
         for device in queryset:
             if not device.pairing_code:
                 device.generate_pairing_code()
+                device.save(update_fields=['pairing_code'])
                 count += 1
         self.message_user(request, f"Generated pairing codes for {count} devices")
     generate_pairing_codes.short_description = "Generate Pairing Codes"
@@ -305,13 +404,13 @@ class DeviceAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         # Optimize queries by selecting related objects
-        return super().get_queryset(request).select_related('owner', 'room', 'controller')
+        return super().get_queryset(request).select_related('owner', 'room__owner', 'controller')
 
-class DeviceCommandAdmin(admin.ModelAdmin):
+class DeviceCommandAdmin(ReadReplicaModelAdmin):
     list_display = ('id', 'device_display', 'controller', 'action', 'created_at', 'executed_at', 'is_executed', 'execution_time')
     list_filter = ('action', 'is_executed', 'created_at', 'controller')
     search_fields = ('device__name', 'device__device_id', 'controller__controller_id', 'device__hardware_pin')
-    readonly_fields = ('created_at', 'executed_at', 'execution_time')
+    readonly_fields = ('created_at', 'claimed_at', 'acked_at', 'delivered_at', 'executed_at', 'execution_time')
     actions = ['mark_executed', 'mark_pending']
     
     def device_display(self, obj):
@@ -322,10 +421,27 @@ class DeviceCommandAdmin(admin.ModelAdmin):
     device_display.short_description = 'Device (Hardware Pin)'
     
     def execution_time(self, obj):
-        if obj.executed_at and obj.created_at:
-            delta = obj.executed_at - obj.created_at
-            return f"{delta.total_seconds():.1f}s"
-        return "-"
+        # Up to the latest stage reached, with the time spent in each stage
+        finished_at = obj.delivered_at or obj.acked_at or obj.executed_at
+        if not (finished_at and obj.created_at):
+            return "-"
+        total = (finished_at - obj.created_at).total_seconds()
+        breakdown = ' · '.join(
+            f'{label} {seconds:.2f}s'
+            for label, seconds in (
+                ('poll', stage_seconds(obj, 'claim')),
+                ('exec', stage_seconds(obj, 'execute')),
+                ('ws', stage_seconds(obj, 'deliver')),
+            )
+            if seconds is not None
+        )
+        fleet = metrics.summary('commands.latency.total')
+        if obj.delivered_at and fleet and total > fleet['p95']:
+            return format_html(
+                '<span style="color: #c00;" title="Slower than the fleet p95 ({}s)">{}s</span><br><small>{}</small>',
+                f"{fleet['p95']:.2f}", f'{total:.2f}', breakdown
+            )
+        return format_html('{}s<br><small>{}</small>', f'{total:.2f}', breakdown)
     execution_time.short_description = 'Exec Time'
     
     def mark_executed(self, request, queryset):
@@ -333,6 +449,7 @@ class DeviceCommandAdmin(admin.ModelAdmin):
             is_executed=True, 
             executed_at=timezone.now()
         )
+        command_queues.reload()
         self.message_user(request, f"Marked {count} commands as executed")
     mark_executed.short_description = "Mark selected commands as executed"
     
@@ -341,10 +458,11 @@ class DeviceCommandAdmin(admin.ModelAdmin):
             is_executed=False, 
             executed_at=None
         )
+        command_queues.reload()
         self.message_user(request, f"Marked {count} commands as pending")
     mark_pending.short_description = "Mark selected commands as pending"
 
-class DeviceAlertAdmin(admin.ModelAdmin):
+class DeviceAlertAdmin(ReadReplicaModelAdmin):
     list_display = ('id', 'device_display', 'controller', 'alert_type', 'message_preview', 'created_at', 'is_resolved')
     list_filter = ('alert_type', 'is_resolved', 'created_at', 'controller')
     search_fields = ('device__name', 'device__device_id', 'controller__controller_id', 'message')
@@ -374,7 +492,7 @@ class DeviceAlertAdmin(admin.ModelAdmin):
 
 
 # --- ACTIVITY LOG ---
-class ActivityLogAdmin(admin.ModelAdmin):
+class ActivityLogAdmin(ReadReplicaModelAdmin):
     list_display = ('created_at', 'log_type', 'action_type', 'user', 'device', 'controller', 'room', 'message')
     list_filter = ('log_type', 'action_type', 'created_at', 'source')
     search_fields = ('message', 'details', 'user__email', 'device__name', 'controller__controller_id')
@@ -383,6 +501,19 @@ class ActivityLogAdmin(admin.ModelAdmin):
     list_select_related = ('user', 'device', 'controller', 'room')
 
 
+class EnergyBucketAdmin(ReadReplicaModelAdmin):
+    list_display = ('start', 'period', 'device', 'kwh')
+    list_filter = ('period', 'start')
+    search_fields = ('device__name', 'device__device_id')
+    date_hierarchy = 'start'
+    list_select_related = ('device',)
+
+
+class MaintenanceCheckpointAdmin(ReadReplicaModelAdmin):
+    list_display = ('name', 'updated_at', 'state')
+    search_fields = ('name',)
+    readonly_fields = ('updated_at',)
+
 
 
 # Register models with admin
@@ -393,6 +524,8 @@ admin.site.register(Device, DeviceAdmin)
 admin.site.register(DeviceCommand, DeviceCommandAdmin)
 admin.site.register(DeviceAlert, DeviceAlertAdmin)
 admin.site.register(ActivityLog, ActivityLogAdmin)
+admin.site.register(EnergyBucket, EnergyBucketAdmin)
+admin.site.register(MaintenanceCheckpoint, MaintenanceCheckpointAdmin)
 
 
 # Customize admin site header and title
@@ -0,0 +1,254 @@
+# core/analytics.py
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .models import CurrentReading, Device
+
+PERCENTILES = (50, 90, 95, 99)
+ANALYTICS_CACHE_TIMEOUT = 60 * 60
+WEEK_SECONDS = 7 * 24 * 3600
+# Rows fetched per round trip while streaming readings into arrays
+LOAD_CHUNK_SIZE = 10000
+_READING_DTYPE = np.dtype([('device_id', np.int64), ('timestamp', np.float64), ('current', np.float64)])
+
+
+def _cache():
+    return caches[getattr(settings, 'ANALYTICS_CACHE', 'default')]
+
+
+def _version_key(user_id):
+    return f'analytics:version:{user_id}'
+
+
+def invalidate_user_analytics(user_id):
+    """Bump the user's analytics version so cached results for open ranges are no longer used"""
+    cache = _cache()
+    try:
+        cache.incr(_version_key(user_id))
+    except ValueError:
+        cache.set(_version_key(user_id), 1, None)
+
+
+async def ainvalidate_user_analytics(user_id):
+    """Async version of invalidate_user_analytics"""
+    cache = _cache()
+    try:
+        await cache.aincr(_version_key(user_id))
+    except ValueError:
+        await cache.aset(_version_key(user_id), 1, None)
+
+
+def load_readings(user, start, end):
+    """Load the user's current readings in [start, end) as parallel NumPy arrays.
+
+    Rows stream from the cursor straight into one structured array, so they
+    are never held as Python tuples all at once.
+    """
+    rows = CurrentReading.objects.filter(
+        device__owner=user,
+        recorded_at__gte=start,
+        recorded_at__lt=end
+    ).values_list('device_id', 'recorded_at', 'current')
+    readings = np.fromiter(
+        ((device_id, recorded_at.timestamp(), current)
+         for device_id, recorded_at, current in rows.iterator(chunk_size=LOAD_CHUNK_SIZE)),
+        dtype=_READING_DTYPE
+    )
+    return readings['device_id'], readings['timestamp'], readings['current']
+
+
+def _summary(values):
+    p50, p90, p95, p99 = np.percentile(values, PERCENTILES)
+    return {
+        'samples': int(values.size),
+        'mean': round(float(values.mean()), 3),
+        'max': round(float(values.max()), 3),
+        'p50': round(float(p50), 3),
+        'p90': round(float(p90), 3),
+        'p95': round(float(p95), 3),
+        'p99': round(float(p99), 3),
+    }
+
+
+def _grouped_summaries(codes, amps):
+    """Percentile summary per group code, sorting once and splitting into contiguous runs"""
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    sorted_amps = amps[order]
+    present, starts = np.unique(sorted_codes, return_index=True)
+    groups = np.split(sorted_amps, starts[1:])
+    return {int(code): _summary(values) for code, values in zip(present, groups)}
+
+
+def _load_profiles(codes, hours, amps, n_groups):
+    """Mean current for each hour of the day, one 24-value row per group"""
+    keys = codes * 24 + hours
+    sums = np.bincount(keys, weights=amps, minlength=n_groups * 24).reshape(n_groups, 24)
+    counts = np.bincount(keys, minlength=n_groups * 24).reshape(n_groups, 24)
+    return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+
+def _peak_hour_histogram(device_codes, days, hours, amps, n_devices, mask=None):
+    """How often each hour of the day carried the highest load of its day.
+
+    Load for a (day, hour) cell is the sum of each device's mean current in
+    that hour, so a device reporting more often does not weigh more.
+    """
+    if mask is not None:
+        device_codes, days, hours, amps = device_codes[mask], days[mask], hours[mask], amps[mask]
+    if amps.size == 0:
+        return [0] * 24
+
+    day_codes = days - days.min()
+    n_days = int(day_codes.max()) + 1
+    keys = (day_codes * 24 + hours) * n_devices + device_codes
+    size = n_days * 24 * n_devices
+    sums = np.bincount(keys, weights=amps, minlength=size)
+    counts = np.bincount(keys, minlength=size)
+    means = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    load = means.reshape(n_days, 24, n_devices).sum(axis=2)
+
+    reported_days = counts.reshape(n_days, 24 * n_devices).any(axis=1)
+    peak_hours = load[reported_days].argmax(axis=1)
+    return np.bincount(peak_hours, minlength=24).tolist()
+
+
+def _week_over_week(codes, timestamps, amps, n_groups, end_ts):
+    this_week = timestamps >= end_ts - WEEK_SECONDS
+    last_week = (timestamps >= end_ts - 2 * WEEK_SECONDS) & ~this_week
+
+    def means(mask):
+        sums = np.bincount(codes[mask], weights=amps[mask], minlength=n_groups)
+        counts = np.bincount(codes[mask], minlength=n_groups)
+        # An empty selection gives integer sums, hence the explicit float output
+        return np.divide(sums, counts, out=np.full(n_groups, np.nan), where=counts > 0)
+
+    current, previous = means(this_week), means(last_week)
+    change = np.divide(current - previous, previous, out=np.full_like(current, np.nan), where=previous > 0) * 100
+
+    def clean(value, digits=3):
+        return None if np.isnan(value) else round(float(value), digits)
+
+    return [
+        {'this_week_mean': clean(current[i]), 'last_week_mean': clean(previous[i]), 'change_pct': clean(change[i], 1)}
+        for i in range(n_groups)
+    ]
+
+
+def compute_statistics(device_ids, timestamps, amps, device_rooms, start_ts, end_ts, utc_offset=0):
+    """Per-device and per-room current statistics over bulk-loaded sample arrays.
+
+    Samples before ``start_ts`` only feed the week-over-week comparison.
+    ``device_rooms`` maps each device primary key to its room id (or None) and
+    ``utc_offset`` (seconds) places samples into local hours and days.
+    """
+    in_range = timestamps >= start_ts
+    result = {
+        'samples': int(in_range.sum()),
+        'load_profile': [0.0] * 24,
+        'peak_hours': [0] * 24,
+        'devices': {},
+        'rooms': {},
+    }
+    if amps.size == 0:
+        return result
+
+    devices, device_codes = np.unique(device_ids, return_inverse=True)
+    rooms = sorted({device_rooms.get(int(pk)) for pk in devices}, key=lambda room: (room is None, room or 0))
+    room_index = {room: i for i, room in enumerate(rooms)}
+    room_of_device = np.array([room_index[device_rooms.get(int(pk))] for pk in devices], dtype=np.int64)
+    room_codes = room_of_device[device_codes]
+    n_devices, n_rooms = len(devices), len(rooms)
+
+    device_wow = _week_over_week(device_codes, timestamps, amps, n_devices, end_ts)
+    room_wow = _week_over_week(room_codes, timestamps, amps, n_rooms, end_ts)
+
+    device_codes, room_codes = device_codes[in_range], room_codes[in_range]
+    amps = amps[in_range]
+    local = timestamps[in_range] + utc_offset
+    hours = (local // 3600 % 24).astype(np.int64)
+    days = (local // 86400).astype(np.int64)
+
+    device_summaries = _grouped_summaries(device_codes, amps) if amps.size else {}
+    room_summaries = _grouped_summaries(room_codes, amps) if amps.size else {}
+    device_profiles = _load_profiles(device_codes, hours, amps, n_devices)
+    room_profiles = _load_profiles(room_codes, hours, amps, n_rooms)
+
+    for code, pk in enumerate(devices):
+        result['devices'][int(pk)] = {
+            **device_summaries.get(code, {'samples': 0}),
+            'load_profile': np.round(device_profiles[code], 3).tolist(),
+            'week_over_week': device_wow[code],
+        }
+
+    for code, room in enumerate(rooms):
+        result['rooms'][room] = {
+            **room_summaries.get(code, {'samples': 0}),
+            'load_profile': np.round(room_profiles[code], 3).tolist(),
+            'peak_hours': _peak_hour_histogram(device_codes, days, hours, amps, n_devices, mask=room_codes == code),
+            'week_over_week': room_wow[code],
+        }
+
+    if amps.size:
+        result['load_profile'] = np.round(
+            np.bincount(hours, weights=amps, minlength=24) / np.maximum(np.bincount(hours, minlength=24), 1), 3
+        ).tolist()
+        result['peak_hours'] = _peak_hour_histogram(device_codes, days, hours, amps, n_devices)
+    return result
+
+
+def get_consumption_analytics(user, start, end):
+    """Cached analytics for the user's devices over the [start, end) datetime range.
+
+    Readings are stamped when they arrive, so only a range that ends in the
+    future can still change; closed ranges are cached regardless of the
+    user's version and survive the invalidation every status report causes.
+    """
+    cache = _cache()
+    version = cache.get(_version_key(user.id), 0) if end > timezone.now() else 'closed'
+    cache_key = f'analytics:{user.id}:{start.isoformat()}:{end.isoformat()}:{version}'
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Load an extra week so week-over-week has a full previous week to compare
+    device_ids, timestamps, amps = load_readings(user, min(start, end - timedelta(days=14)), end)
+
+    devices = {
+        device['id']: device
+        for device in Device.objects.filter(owner=user).values('id', 'device_id', 'name', 'room_id', 'room__name')
+    }
+    stats = compute_statistics(
+        device_ids, timestamps, amps,
+        device_rooms={pk: device['room_id'] for pk, device in devices.items()},
+        start_ts=start.timestamp(),
+        end_ts=end.timestamp(),
+        utc_offset=timezone.localtime(end).utcoffset().total_seconds()
+    )
+
+    room_names = {device['room_id']: device['room__name'] for device in devices.values()}
+    data = {
+        'samples': stats['samples'],
+        'load_profile': stats['load_profile'],
+        'peak_hours': stats['peak_hours'],
+        'devices': [
+            {
+                'device_id': devices[pk]['device_id'],
+                'name': devices[pk]['name'],
+                'room_id': devices[pk]['room_id'],
+                **summary,
+            }
+            for pk, summary in stats['devices'].items() if pk in devices
+        ],
+        'rooms': [
+            {'room_id': room, 'room_name': room_names.get(room), **summary}
+            for room, summary in stats['rooms'].items()
+        ],
+    }
+
+    cache.set(cache_key, data, ANALYTICS_CACHE_TIMEOUT)
+    return data
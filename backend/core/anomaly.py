@@ -0,0 +1,118 @@
+# core/anomaly.py
+import math
+import threading
+from array import array
+
+from django.conf import settings
+
+# Per-device alert flags, so each condition alerts once until it clears
+DEVIATION_ALERTED = 1
+DRIFT_ALERTED = 2
+LIMIT_ALERTED = 4
+
+
+class CurrentAnomalyDetector:
+    """Streaming anomaly detection over each socket's current reports.
+
+    Every device owns one slot in a set of flat arrays holding a fast EWMA
+    mean and variance, a slow EWMA baseline, a sample count, the length of
+    the current run of outlying samples and its alert flags. Observing a
+    sample is O(1) and touches only that slot.
+
+    The state lives in the serving process only: after a restart every
+    device warms up again (no deviation or drift alerts for ``warmup``
+    samples), and each worker process learns its own baselines.
+    """
+
+    def __init__(self, alpha=0.1, baseline_alpha=0.0005, z_threshold=4.0, sustain=3,
+                 min_std=0.05, drift_ratio=0.3, drift_min_amps=0.5, warmup=30,
+                 rated_current=10.0, limit_ratio=0.85):
+        self.alpha = alpha
+        self.baseline_alpha = baseline_alpha
+        self.z_threshold = z_threshold
+        self.sustain = sustain
+        self.min_std = min_std
+        self.drift_ratio = drift_ratio
+        self.drift_min_amps = drift_min_amps
+        self.warmup = warmup
+        self.rated_current = rated_current
+        self.limit_ratio = limit_ratio
+
+        self._slots = {}
+        self._mean = array('d')
+        self._var = array('d')
+        self._baseline = array('d')
+        self._count = array('L')
+        self._run = array('L')
+        self._flags = array('B')
+        self._lock = threading.Lock()
+
+    def _slot(self, device_key, amps):
+        slot = self._slots.get(device_key)
+        if slot is None:
+            slot = self._slots[device_key] = len(self._mean)
+            self._mean.append(amps)
+            self._var.append(0.0)
+            self._baseline.append(amps)
+            self._count.append(0)
+            self._run.append(0)
+            self._flags.append(0)
+        return slot
+
+    def observe(self, device_key, amps):
+        """Feed one sample; returns a list of (kind, detail) anomalies to alert on"""
+        anomalies = []
+        with self._lock:
+            i = self._slot(device_key, amps)
+            mean, var, baseline = self._mean[i], self._var[i], self._baseline[i]
+            count, flags = self._count[i] + 1, self._flags[i]
+
+            # Sustained deviation above the recent mean
+            std = max(math.sqrt(var), self.min_std)
+            z = (amps - mean) / std
+            run = self._run[i] + 1 if z > self.z_threshold else 0
+            if count > self.warmup and run >= self.sustain:
+                if not flags & DEVIATION_ALERTED:
+                    flags |= DEVIATION_ALERTED
+                    anomalies.append(('deviation', f'{amps:.2f}A is {z:.1f} standard deviations above the usual {mean:.2f}A'))
+            elif run == 0:
+                flags &= ~DEVIATION_ALERTED
+
+            # EWMA mean and variance update (West's incremental form), with outliers
+            # clipped so a sudden step does not immediately inflate the variance
+            diff = min(amps - mean, self.z_threshold * std)
+            increment = self.alpha * diff
+            mean += increment
+            var = (1 - self.alpha) * (var + diff * increment)
+            if count <= self.warmup:
+                baseline = mean
+            else:
+                baseline += self.baseline_alpha * (mean - baseline)
+
+            # Slow drift: the recent mean creeping away from the long-term baseline
+            # while individual samples still look ordinary (spikes are handled above)
+            drifting = (
+                mean - baseline > self.drift_min_amps
+                and mean > baseline * (1 + self.drift_ratio)
+            )
+            if count > self.warmup and drifting and run == 0:
+                if not flags & DRIFT_ALERTED:
+                    flags |= DRIFT_ALERTED
+                    anomalies.append(('drift', f'average load rose from {baseline:.2f}A to {mean:.2f}A'))
+            elif not drifting:
+                flags &= ~DRIFT_ALERTED
+
+            # Recent mean approaching the socket rating, before the hardware trips
+            near_limit = mean > self.rated_current * self.limit_ratio
+            if near_limit and not flags & LIMIT_ALERTED:
+                flags |= LIMIT_ALERTED
+                anomalies.append(('near_limit', f'average load {mean:.2f}A is close to the {self.rated_current:.0f}A rating'))
+            elif not near_limit:
+                flags &= ~LIMIT_ALERTED
+
+            self._mean[i], self._var[i], self._baseline[i] = mean, var, baseline
+            self._count[i], self._run[i], self._flags[i] = min(count, 0xFFFFFFFF), run, flags
+        return anomalies
+
+
+current_anomaly_detector = CurrentAnomalyDetector(**getattr(settings, 'CURRENT_ANOMALY_DETECTION', {}))
@@ -0,0 +1,333 @@
+# core/async_views.py
+import json
+import logging
+from collections import defaultdict
+from time import perf_counter
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.utils.encoders import JSONEncoder
+
+from .analytics import ainvalidate_user_analytics
+from .coalescing import acontroller_seen, heartbeats
+from .anomaly import current_anomaly_detector
+from .command_latency import record_ack
+from .command_queue import command_queues
+from .energy import aaccumulate_energy
+from .metrics import metrics
+from .models import Controller, CurrentReading, Device, DeviceCommand
+from .polling import poll_advisor
+from .presence import ais_online
+from .views import raise_device_alert
+from .websocket_utils import asend_alert_notification, asend_command_status_update, asend_device_status_update
+
+logger = logging.getLogger(__name__)
+
+VALID_HARDWARE_PINS = ['kitchen', 'living', 'light1', 'light2', 'fan']
+# Sockets that measure current and can trip
+FAULT_HARDWARE_PINS = ['kitchen', 'living']
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncESP32View(View):
+    """Base for the ESP32 endpoints served on the event loop (ASYNC_ESP32_VIEWS).
+
+    Same URLs, payloads and responses as the DRF views in views.py, but the
+    handlers are coroutines using the async ORM and await the channel layer
+    directly, so a request waiting on the database or a send holds a socket
+    rather than a sync worker thread.
+    """
+
+    def parse_data(self, request):
+        if request.content_type == 'application/json':
+            return json.loads(request.body or b'{}')
+        return request.POST
+
+    def respond(self, data, status_code=status.HTTP_200_OK):
+        # DRF's encoder, so dates come out exactly as from the sync views
+        return JsonResponse(data, status=status_code, encoder=JSONEncoder, safe=False)
+
+
+class AsyncDeviceCommandsView(AsyncESP32View):
+    async def get(self, request, format=None):
+        """ESP32 checks for pending commands"""
+        started = perf_counter()
+        try:
+            controller_id = request.GET.get('controller_id')
+
+            if not controller_id:
+                return self.respond({'error': 'Controller ID is required'}, status.HTTP_400_BAD_REQUEST)
+
+            try:
+                controller = await Controller.objects.select_related('owner').aget(controller_id=controller_id)
+            except Controller.DoesNotExist:
+                return self.respond({'error': 'Controller not found'}, status.HTTP_404_NOT_FOUND)
+
+            await acontroller_seen(controller, timezone.now())
+            commands = await command_queues.apoll(controller)
+
+            poll_advisor.observe_latency(perf_counter() - started)
+            return self.respond({
+                'commands': commands,
+                'timestamp': timezone.now().isoformat(),
+                'next_poll_ms': await poll_advisor.anext_poll_ms(
+                    controller.controller_id,
+                    has_pending=bool(commands),
+                    owner_online=bool(controller.owner) and await ais_online(controller.owner.email)
+                )
+            })
+
+        except Exception as e:
+            logger.error(f"Error in AsyncDeviceCommandsView: {str(e)}")
+            return self.respond({'error': str(e)}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class AsyncDeviceCommandExecutedView(AsyncESP32View):
+    async def post(self, request, format=None):
+        """ESP32 reports command execution"""
+        try:
+            data = self.parse_data(request)
+            command_id = data.get('command_id')
+            execution_result = data.get('result', 'success')
+
+            if not command_id:
+                return self.respond({'error': 'Command ID is required'}, status.HTTP_400_BAD_REQUEST)
+
+            try:
+                command = await DeviceCommand.objects.select_related(
+                    'device__owner', 'controller__owner'
+                ).aget(id=command_id)
+            except DeviceCommand.DoesNotExist:
+                return self.respond({'error': 'Command not found'}, status.HTTP_404_NOT_FOUND)
+
+            queued = command_queues.get(command.id, command.controller.controller_id)
+            if queued and command.claimed_at is None:
+                # The claim may still be waiting to be written
+                command.claimed_at = queued.claimed_at
+            first_ack = command.acked_at is None
+            command.is_executed = True
+            command.executed_at = timezone.now()
+            if first_ack:
+                command.acked_at = command.executed_at
+            command.status = 'completed' if execution_result == 'success' else 'failed'
+            await command.asave(update_fields=['is_executed', 'executed_at', 'acked_at', 'claimed_at', 'status'])
+            # Saved in autocommit, so the result is committed by now
+            command_queues.ack(command.id, command.controller.controller_id)
+            if first_ack:
+                record_ack(command)
+
+            if command.device and execution_result == 'success':
+                if command.action == 'on':
+                    command.device.status = 'on'
+                elif command.action == 'off':
+                    command.device.status = 'off'
+                command.device.last_seen = timezone.now()
+                await command.device.asave(update_fields=['status', 'last_seen'])
+
+            # Send success alert only after ESP32 confirms execution
+            if execution_result == 'success' and command.device and command.device.owner:
+                owner_email = command.device.owner.email
+                recent_commands = await DeviceCommand.objects.filter(
+                    device=command.device,
+                    action=command.action,
+                    status='completed',
+                    executed_at__gte=timezone.now() - timedelta(seconds=5)
+                ).exclude(id=command.id).acount()
+
+                if recent_commands == 0:
+                    await asend_alert_notification(
+                        user_email=owner_email,
+                        alert_type='success',
+                        title=f"{command.device.name} {command.action.title()}",
+                        message=f"Device turned {command.action} successfully",
+                        device_id=command.device.device_id
+                    )
+
+                await asend_device_status_update(
+                    user_email=owner_email,
+                    device_id=command.device.device_id,
+                    status=command.device.status,
+                    current_value=command.device.current_value
+                )
+                await asend_command_status_update(
+                    user_email=owner_email,
+                    command_id=command.id,
+                    device_id=command.device.device_id,
+                    status=command.status
+                )
+
+            if command.action.startswith('test_alert:') and command.controller.owner:
+                command.controller.owner.phone_verified = True
+                await command.controller.owner.asave(update_fields=['phone_verified'])
+
+            return self.respond({
+                'message': 'Command execution confirmed',
+                'command_id': command_id,
+                'final_status': command.status
+            })
+
+        except Exception as e:
+            logger.error(f"Error in AsyncDeviceCommandExecutedView: {str(e)}")
+            return self.respond({'error': str(e)}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class AsyncDeviceStatusView(AsyncESP32View):
+    async def post(self, request, format=None):
+        """Endpoint for ESP32 to report status"""
+        try:
+            data = self.parse_data(request)
+            controller_id = data.get('controller_id')
+            device_status = data.get('device_status', {})
+
+            logger.debug(f"Received status from {controller_id}: {device_status}")
+
+            if not controller_id:
+                return self.respond({'error': 'Controller ID is required'}, status.HTTP_400_BAD_REQUEST)
+
+            try:
+                controller = await Controller.objects.aget(controller_id=controller_id)
+            except Controller.DoesNotExist:
+                return self.respond({'error': 'Controller not registered'}, status.HTTP_404_NOT_FOUND)
+
+            now = timezone.now()
+            await acontroller_seen(controller, now)
+
+            # One query for every device this report touches, instead of one per pin
+            reported_pins = [pin for pin in device_status if pin in VALID_HARDWARE_PINS]
+            devices = {
+                device.hardware_pin: device
+                async for device in Device.objects.filter(
+                    controller=controller,
+                    hardware_pin__in=set(reported_pins) | set(FAULT_HARDWARE_PINS)
+                ).select_related('owner')
+            }
+
+            readings = []
+            reading_owners = set()
+            current_anomalies = []
+            changed = []
+            # Fields each device needs saved, by hardware pin
+            dirty = defaultdict(list)
+
+            fault_alerts = self.process_device_alerts(controller, devices, device_status, dirty)
+
+            for hardware_pin in reported_pins:
+                device = devices.get(hardware_pin)
+                if device is None:
+                    logger.warning(f"Device not found for controller {controller_id} and hardware_pin {hardware_pin}")
+                    continue
+
+                old_status = device.status
+                old_current = device.current_value
+                device.status = 'on' if device_status[hardware_pin] else 'off'
+                if device.status != old_status:
+                    dirty[hardware_pin].append('status')
+
+                current_key = f'{hardware_pin}_current'
+                current_changed = False
+                if hardware_pin in FAULT_HARDWARE_PINS and current_key in device_status:
+                    if device.current_value != device_status[current_key]:
+                        device.current_value = device_status[current_key]
+                        current_changed = True
+                        dirty[hardware_pin].append('current_value')
+
+                if current_key in device_status:
+                    # Integrate energy since the previous report before the sample is overwritten;
+                    # a coalesced report's share is integrated at the next write (see views.py)
+                    if dirty[hardware_pin] or heartbeats.due(device, now):
+                        await aaccumulate_energy(
+                            device, old_current, device_status[current_key], now,
+                            steady_until=heartbeats.release(device)
+                        )
+                        dirty[hardware_pin].append('current_sampled_at')
+                    try:
+                        amps = float(device_status[current_key])
+                        readings.append(CurrentReading(device=device, recorded_at=now, current=amps))
+                        if device.owner_id:
+                            reading_owners.add(device.owner_id)
+                        # Only a running load says anything about the appliance behind the socket
+                        observed = current_anomaly_detector.observe(device.pk, amps) if device.status == 'on' else []
+                        for kind, detail in observed:
+                            current_anomalies.append((device, f'Unusual current in {device.name}: {detail}'))
+                    except (TypeError, ValueError):
+                        pass
+
+                if (old_status != device.status or current_changed) and device.owner:
+                    changed.append(device)
+
+                dirty[hardware_pin] = heartbeats.seen_fields(device, now, dirty[hardware_pin])
+
+            # One UPDATE per set of changed fields: a device is never written with
+            # loaded values for fields it did not change, which would overwrite
+            # concurrent changes (a command's status, another report's fault state)
+            by_fields = defaultdict(list)
+            for pin, fields in dirty.items():
+                if fields:
+                    by_fields[tuple(sorted(set(fields)))].append(devices[pin])
+            for fields, to_save in by_fields.items():
+                await Device.objects.abulk_update(to_save, fields)
+
+            for device in changed:
+                logger.debug(f"Sending WebSocket update for {device.device_id}: status={device.status}, current={device.current_value}")
+                await asend_device_status_update(
+                    user_email=device.owner.email,
+                    device_id=device.device_id,
+                    status=device.status,
+                    current_value=device.current_value
+                )
+
+            if readings:
+                await CurrentReading.objects.abulk_create(readings)
+                for owner_id in reading_owners:
+                    await ainvalidate_user_analytics(owner_id)
+
+            # Alerts are rare; they reuse the sync path with its dedupe and activity log
+            for device, alert_type, message in fault_alerts:
+                await sync_to_async(raise_device_alert)(device, controller, alert_type, message)
+            for device, message in current_anomalies:
+                await sync_to_async(raise_device_alert)(device, controller, 'high_current', message)
+
+            return self.respond({'message': 'Status received'})
+
+        except Exception as e:
+            return self.respond({'error': str(e)}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def process_device_alerts(self, controller, devices, device_status, dirty):
+        """Update fault state on the loaded devices, noting changes in ``dirty``; returns (device, alert_type, message) to raise"""
+        alerts = []
+        for device_key in FAULT_HARDWARE_PINS:
+            device = devices.get(device_key)
+            if device is None:
+                logger.debug(f"Device not found for controller {controller.controller_id} and hardware_pin {device_key}")
+                continue
+
+            current_fault = device_status.get(f"{device_key}_fault_detected", False)
+            previous_fault = (device.previous_fault_state or {}).get(device_key, False)
+
+            # Only create alert if fault state CHANGED from False to True
+            if current_fault and not previous_fault:
+                lockout_type = device_status.get(f"{device_key}_lockout_type", 'unknown')
+                if lockout_type == 'short_circuit':
+                    alerts.append((device, 'short_circuit', f'Short circuit detected in {device.name}'))
+                elif lockout_type == 'overload':
+                    alerts.append((device, 'overload', f'Overload detected in {device.name}'))
+                else:
+                    alerts.append((device, 'offline', f'Fault detected in {device.name}'))
+
+            if not device.previous_fault_state:
+                device.previous_fault_state = {}
+            if device.previous_fault_state.get(device_key) != current_fault:
+                device.previous_fault_state[device_key] = current_fault
+                dirty[device_key].append('previous_fault_state')
+            else:
+                metrics.incr('writes.coalesced')
+
+            if current_fault != previous_fault:
+                logger.info(f"Fault state changed for {device.name}: {previous_fault} -> {current_fault}")
+        return alerts
@@ -0,0 +1,426 @@
+# core/channel_layers.py
+import asyncio
+import fcntl
+import logging
+import os
+import random
+import string
+import struct
+import tempfile
+import threading
+import time
+import weakref
+from collections import defaultdict, deque
+
+import msgpack
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+_FRAME_HEADER = struct.Struct('!I')
+# A broker stops writing to a client whose unread backlog passes this
+MAX_CLIENT_BACKLOG = 32 * 1024 * 1024
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def default_socket_path():
+    return os.path.join(tempfile.gettempdir(), f'currentwatch-channels-{os.getuid()}.sock')
+
+
+def _non_local_name(channel):
+    return channel[:channel.find('!') + 1] if '!' in channel else channel
+
+
+async def _read_frame(reader):
+    (size,) = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+    return msgpack.unpackb(await reader.readexactly(size), raw=False)
+
+
+def _write_frame(writer, *fields):
+    body = msgpack.packb(fields, use_bin_type=True)
+    writer.write(_FRAME_HEADER.pack(len(body)) + body)
+
+
+def ensure_broker(path, capacity=100, expiry=60):
+    """Start the host's broker in this process unless another process runs it.
+
+    Whoever holds the lock file next to the socket owns the broker; the lock
+    is released by the OS when that process exits, so the next client that
+    fails to connect takes over.
+    """
+    with _brokers_lock:
+        if path in _brokers:
+            return False
+        lock_fd = os.open(f'{path}.lock', os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return False
+        broker = _brokers[path] = LocalChannelBroker(path, capacity=capacity, expiry=expiry)
+        broker.lock_fd = lock_fd
+    broker.start()
+    return True
+
+
+class LocalChannelBroker:
+    """Routes channel messages between the worker processes of one host.
+
+    Runs on its own event loop in a daemon thread. Message payloads are
+    forwarded as the packed bytes the sender produced, and a group send
+    reaches each process in one frame listing its channels. Group
+    memberships of a process are dropped when it disconnects; clients
+    re-register theirs when they reconnect to a new broker.
+    """
+
+    def __init__(self, path, capacity=100, expiry=60):
+        self.path = path
+        self.capacity = capacity
+        self.expiry = expiry
+        self.groups = defaultdict(set)
+        self.owners = {}
+        self.listening = defaultdict(set)
+        self.pending = defaultdict(deque)
+        self.last_sweep = time.monotonic()
+        self.ready = threading.Event()
+        self.clients = set()
+        self.lock_fd = self.loop = self.server = self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serve(),), name='channel-broker', daemon=True)
+        self.thread.start()
+        if not self.ready.wait(5):
+            raise RuntimeError(f'Channel broker did not start on {self.path}')
+
+    def stop(self, timeout=5):
+        """Shut the broker down and release its lock, as if its process had exited"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._shutdown)
+            self.thread.join(timeout)
+        with _brokers_lock:
+            if _brokers.get(self.path) is self:
+                del _brokers[self.path]
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+    def _shutdown(self):
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+
+    async def serve(self):
+        # Holding the lock means any socket file left behind is stale
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # Created owner-only, so no other user can connect before it could be chmodded.
+        # The umask is process-wide, but only for the moment of the bind.
+        previous_umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        finally:
+            os.umask(previous_umask)
+        self.loop = asyncio.get_running_loop()
+        self.ready.set()
+        logger.info(f"Channel broker listening on {self.path} (pid {os.getpid()})")
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def handle(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                op, *args = await _read_frame(reader)
+                if op == 'send':
+                    self.route([args[0]], args[1])
+                elif op == 'group_send':
+                    self.route(list(self.groups.get(args[0], ())), args[1])
+                elif op == 'group_add':
+                    self.groups[args[0]].add(args[1])
+                elif op == 'group_discard':
+                    self.discard(args[0], args[1])
+                elif op == 'listen':
+                    self.listen(writer, args[0])
+                elif op == 'flush':
+                    self.groups.clear()
+                    self.pending.clear()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            self.disconnect(writer)
+            writer.close()
+
+    def discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.groups[group]
+
+    def listen(self, writer, name):
+        self.owners[name] = writer
+        self.listening[writer].add(name)
+        now = time.monotonic()
+        for expires, channels, payload in self.pending.pop(name, ()):
+            if expires > now:
+                _write_frame(writer, 'message', channels, payload)
+
+    def disconnect(self, writer):
+        names = {name for name in self.listening.pop(writer, ()) if self.owners.get(name) is writer}
+        for name in names:
+            del self.owners[name]
+        if names:
+            for group, members in list(self.groups.items()):
+                members.difference_update([channel for channel in members if _non_local_name(channel) in names])
+                if not members:
+                    del self.groups[group]
+
+    def route(self, channels, payload):
+        targets = defaultdict(list)
+        for channel in channels:
+            targets[_non_local_name(channel)].append(channel)
+
+        now = time.monotonic()
+        for name, names_channels in targets.items():
+            writer = self.owners.get(name)
+            if writer is not None and not writer.is_closing():
+                if writer.transport.get_write_buffer_size() > MAX_CLIENT_BACKLOG:
+                    logger.warning(f"Channel broker dropping message for {name}: client is not reading")
+                    continue
+                _write_frame(writer, 'message', names_channels, payload)
+            else:
+                # Nobody receiving yet (or between reconnects); hold it briefly
+                queue = self.pending[name]
+                if len(queue) < self.capacity:
+                    queue.append((now + self.expiry, names_channels, payload))
+
+        if now - self.last_sweep > self.expiry:
+            self.last_sweep = now
+            for name, queue in list(self.pending.items()):
+                while queue and queue[0][0] <= now:
+                    queue.popleft()
+                if not queue:
+                    del self.pending[name]
+
+
+class _BrokerConnection:
+    """One event loop's stream to the broker.
+
+    While a receiving connection reconnects to a new broker, ``send`` waits
+    for it (up to the layer's connect_timeout) instead of writing into the
+    dead socket; a connection that is closed for good raises ConnectionError
+    so the layer can open a new one.
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.listens = set()
+        self.closed = False
+        self.connected = asyncio.Event()
+        self.reader = self.writer = self.task = None
+
+    async def open(self):
+        self.reader, self.writer = await self.layer.open_broker_stream()
+        self.connected.set()
+        self.task = asyncio.ensure_future(self.read())
+
+    async def send(self, *fields):
+        if not self.connected.is_set() and not self.closed:
+            try:
+                await asyncio.wait_for(self.connected.wait(), self.layer.connect_timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError(f'Channel broker on {self.layer.path} is unavailable')
+        if self.closed or self.writer.is_closing():
+            raise ConnectionError('Channel broker connection is closed')
+        await self._write(*fields)
+
+    async def _write(self, *fields):
+        _write_frame(self.writer, *fields)
+        await self.writer.drain()
+
+    async def read(self):
+        try:
+            await self._read_forever()
+        finally:
+            # Cancelled when the loop shuts down (async_to_sync); close the
+            # socket while the loop can still do it
+            self.connected.clear()
+            self.closed = True
+            self.writer.close()
+
+    async def _read_forever(self):
+        while True:
+            try:
+                while True:
+                    op, channels, payload = await _read_frame(self.reader)
+                    if op == 'message':
+                        self.layer.deliver(channels, msgpack.unpackb(payload, raw=False))
+            except (asyncio.IncompleteReadError, ConnectionError, OSError):
+                pass
+            self.connected.clear()
+            self.writer.close()
+            if self.closed or not self.listens:
+                self.closed = True
+                return
+            # The broker went away: receiving connections come back on their
+            # own and restore their registrations on the new broker
+            while True:
+                await asyncio.sleep(0.05 + random.random() * 0.2)
+                try:
+                    self.reader, self.writer = await self.layer.open_broker_stream()
+                    for name in self.listens:
+                        await self._write('listen', name)
+                    for group, channels in list(self.layer.groups.items()):
+                        for channel in list(channels):
+                            await self._write('group_add', group, channel)
+                    self.connected.set()
+                    break
+                except OSError as e:
+                    self.writer.close()
+                    logger.warning(f"Channel layer reconnect failed: {e}")
+
+    async def close(self):
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    """Channel layer for several worker processes on one host, without Redis.
+
+    Processes talk to a broker over a Unix domain socket (``path``); the
+    first process to need it starts the broker in a background thread.
+    Messages are at-most-once like the Redis layer: over-capacity messages
+    are dropped rather than raising ChannelFull.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path=None, expiry=60, capacity=100, channel_capacity=None, connect_timeout=5, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = str(path or default_socket_path())
+        self.connect_timeout = connect_timeout
+        self.client_prefix = 'local.' + ''.join(random.choices(string.ascii_letters, k=8))
+        # Keyed weakly by event loop: async_to_sync callers outside a loop get
+        # a fresh loop per call, and that loop's connection dies with it
+        self.connections = weakref.WeakKeyDictionary()
+        self.queues = {}
+        self.groups = defaultdict(set)
+
+    async def open_broker_stream(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                ensure_broker(self.path, capacity=self.capacity, expiry=self.expiry)
+                await asyncio.sleep(0.02)
+
+    async def connection(self):
+        loop = asyncio.get_running_loop()
+        for other in [other for other in list(self.connections) if other.is_closed()]:
+            self.connections.pop(other, None)
+        connection = self.connections.get(loop)
+        if connection is None or connection.closed:
+            connection = _BrokerConnection(self)
+            await connection.open()
+            self.connections[loop] = connection
+        return connection
+
+    async def _request(self, *fields):
+        """Send one frame to the broker, once more on a new connection if the old one closed"""
+        try:
+            await (await self.connection()).send(*fields)
+        except ConnectionError:
+            await (await self.connection()).send(*fields)
+
+    def deliver(self, channels, message):
+        for channel in channels:
+            queue = self.queues.get(channel)
+            if queue is None:
+                queue = self.queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+            try:
+                queue.put_nowait(dict(message) if len(channels) > 1 else message)
+            except asyncio.QueueFull:
+                logger.warning(f"Channel {channel} over capacity, message dropped")
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert '__asgi_channel__' not in message
+        self.require_valid_channel_name(channel)
+        await self._request('send', channel, msgpack.packb(message, use_bin_type=True))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        name = _non_local_name(channel)
+        connection = await self.connection()
+        if name not in connection.listens:
+            connection.listens.add(name)
+            try:
+                await connection.send('listen', name)
+            except ConnectionError:
+                connection = await self.connection()
+                connection.listens.add(name)
+                await connection.send('listen', name)
+
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        try:
+            return await queue.get()
+        finally:
+            if queue.empty():
+                self.queues.pop(channel, None)
+
+    async def new_channel(self, prefix='specific.'):
+        return f"{prefix}{self.client_prefix}!{''.join(random.choices(string.ascii_letters, k=12))}"
+
+    async def flush(self):
+        await self._request('flush')
+        self.queues.clear()
+        self.groups.clear()
+
+    async def close(self):
+        connection = self.connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            await connection.close()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups[group].add(channel)
+        await self._request('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.groups[group]
+        await self._request('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        await self._request('group_send', group, msgpack.packb(message, use_bin_type=True))
@@ -0,0 +1,121 @@
+# core/coalescing.py
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Q
+
+from .dispatch import BatchDispatcher
+from .metrics import metrics
+
+
+def _persist_batch(items):
+    """One UPDATE per model and timestamp; all rows seen in one report share theirs"""
+    groups = defaultdict(list)
+    for model, pk, seen_at in items:
+        groups[(model, seen_at)].append(pk)
+    for (model, seen_at), pks in groups.items():
+        # Never move last_seen back past a write made in the meantime
+        model.objects.filter(Q(last_seen__isnull=True) | Q(last_seen__lt=seen_at), pk__in=pks).update(last_seen=seen_at)
+
+
+async def _persisted(result):
+    pass
+
+
+heartbeat_writer = BatchDispatcher(
+    'heartbeats.persist', _persist_batch, _persisted,
+    batch_size=getattr(settings, 'HEARTBEAT_PERSIST_BATCH_SIZE', 500)
+).register_flush_at_exit()
+
+
+class HeartbeatCoalescer:
+    """Decides when a report that only proves a row is alive is worth a write.
+
+    Controllers and devices report every few seconds, and most reports
+    change nothing but ``last_seen``. A row whose other fields changed is
+    saved as before, with ``last_seen`` alongside. Otherwise ``last_seen``
+    is only written once the stored value is ``resolution`` seconds old, and
+    then through ``heartbeat_writer``, which batches it with other rows'
+    heartbeats. Reports in between are held: counted in the
+    ``writes.coalesced`` metric and remembered, so callers that deferred work
+    to the next write (energy integration) know when the row was last seen.
+
+    What is remembered is per process and not persisted. When the held
+    reports went to another worker, or the process restarted, ``release``
+    returns None and energy integration falls back to one linear ramp from
+    the stored sample (see ``_energy_pieces``): for a current that changed
+    right before the write, off by at most half the change over up to
+    ``resolution`` seconds.
+    """
+
+    def __init__(self, resolution=60):
+        self.resolution = resolution
+        self._held = {}
+        self._lock = threading.Lock()
+
+    def _key(self, instance):
+        return (instance._meta.label, instance.pk)
+
+    def due(self, instance, now):
+        """Whether the stored last_seen is too old to hold another report back"""
+        return instance.last_seen is None or (now - instance.last_seen).total_seconds() >= self.resolution
+
+    def hold(self, instance, now):
+        with self._lock:
+            self._held[self._key(instance)] = now
+        metrics.incr('writes.coalesced')
+
+    def release(self, instance):
+        """Time of the last report held back for the row since its last write, if any"""
+        with self._lock:
+            return self._held.pop(self._key(instance), None)
+
+    def beat(self, instance, now):
+        """Queue a write of last_seen alone"""
+        self.release(instance)
+        instance.last_seen = now
+        heartbeat_writer.submit((type(instance), instance.pk, now))
+
+    def touch(self, instance, now):
+        """For a report that changed nothing else; returns True if a write was queued"""
+        if self.due(instance, now):
+            self.beat(instance, now)
+            return True
+        self.hold(instance, now)
+        return False
+
+    def seen_fields(self, instance, now, changed):
+        """Fields to save for a report that changed ``changed``; empty if it was coalesced.
+
+        Marks the instance seen when something is to be saved; a report that
+        changed nothing is left to ``touch``.
+        """
+        if not changed:
+            self.touch(instance, now)
+            return []
+        self.release(instance)
+        instance.last_seen = now
+        return list(changed) + ['last_seen']
+
+
+heartbeats = HeartbeatCoalescer(getattr(settings, 'HEARTBEAT_RESOLUTION', 60))
+
+
+def controller_seen(controller, now):
+    """Mark a controller that just polled or reported as online and seen"""
+    if controller.is_online:
+        heartbeats.touch(controller, now)
+        return
+    heartbeats.release(controller)
+    controller.last_seen, controller.is_online = now, True
+    controller.save(update_fields=['last_seen', 'is_online'])
+
+
+async def acontroller_seen(controller, now):
+    if controller.is_online:
+        heartbeats.touch(controller, now)
+        return
+    heartbeats.release(controller)
+    controller.last_seen, controller.is_online = now, True
+    await controller.asave(update_fields=['last_seen', 'is_online'])
@@ -0,0 +1,86 @@
+# core/command_latency.py
+import threading
+
+from django.utils import timezone
+
+from .metrics import Histogram, metrics
+from .models import DeviceCommand
+
+# Stage: (start, end) timestamp fields of DeviceCommand
+STAGES = {
+    'claim': ('created_at', 'claimed_at'),  # Waiting for the controller to poll
+    'execute': ('claimed_at', 'acked_at'),  # Switching the relay and reporting back
+    'deliver': ('acked_at', 'delivered_at'),  # Result reaching the app over WebSocket
+    'total': ('created_at', 'delivered_at'),  # Tap to confirmed in the app
+}
+
+_controller_histograms = {}
+_lock = threading.Lock()
+
+
+def stage_seconds(command, stage):
+    """Seconds the command spent in ``stage``, or None if it has not got through it"""
+    start, end = (getattr(command, field) for field in STAGES[stage])
+    if start is None or end is None:
+        return None
+    return max(0.0, (end - start).total_seconds())
+
+
+def observe(stage, controller_id, seconds):
+    """Add one latency to the fleet-wide and the controller's histogram for ``stage``"""
+    if seconds is None:
+        return
+    seconds = max(0.0, seconds)
+    metrics.observe(f'commands.latency.{stage}', seconds)
+    with _lock:
+        histogram = _controller_histograms.get((controller_id, stage))
+        if histogram is None:
+            histogram = _controller_histograms[(controller_id, stage)] = Histogram()
+        histogram.observe(seconds)
+
+
+def latency_summary(controller_id=None):
+    """Per-stage count/mean/p50/p95/p99/max in seconds, fleet-wide or for one controller"""
+    if controller_id is None:
+        return {stage: metrics.summary(f'commands.latency.{stage}') for stage in STAGES}
+    with _lock:
+        return {
+            stage: histogram.summary() if (histogram := _controller_histograms.get((controller_id, stage))) else None
+            for stage in STAGES
+        }
+
+
+def record_claims(commands, controller_id):
+    for command in commands:
+        observe('claim', controller_id, stage_seconds(command, 'claim'))
+
+
+def record_ack(command):
+    observe('execute', command.controller.controller_id, stage_seconds(command, 'execute'))
+
+
+def final_command_id(message):
+    """The command whose result this WebSocket message reports, if any"""
+    data = message.get('data') or {}
+    if message.get('type') == 'command_update' and data.get('status') in ('completed', 'failed'):
+        return data.get('command_id')
+    return None
+
+
+async def arecord_deliveries(command_ids):
+    """Stamp delivered_at on commands whose result just went out over WebSocket"""
+    if not command_ids:
+        return
+    delivered_at = timezone.now()
+    rows = [
+        row async for row in DeviceCommand.objects.filter(
+            id__in=command_ids, delivered_at__isnull=True
+        ).values_list('id', 'controller__controller_id', 'created_at', 'acked_at')
+    ]
+    if not rows:
+        return
+    await DeviceCommand.objects.filter(id__in=[row[0] for row in rows]).aupdate(delivered_at=delivered_at)
+    for _, controller_id, created_at, acked_at in rows:
+        if acked_at:
+            observe('deliver', controller_id, (delivered_at - acked_at).total_seconds())
+        observe('total', controller_id, (delivered_at - created_at).total_seconds())
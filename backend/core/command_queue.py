@@ -0,0 +1,241 @@
+# core/command_queue.py
+import logging
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .command_latency import record_claims
+from .dispatch import BatchDispatcher
+from .models import DeviceCommand
+
+logger = logging.getLogger(__name__)
+
+# Unexecuted commands older than this are failed when their controller polls
+STALE_AFTER = timedelta(seconds=30)
+# Commands handed out per poll
+POLL_BATCH = 10
+
+
+def _device_name(command):
+    if not command.device_id:
+        return ''
+    if not command.device.hardware_pin:
+        logger.warning(f"Device {command.device.device_id} has no hardware pin")
+        return 'unknown'
+    return command.device.hardware_pin
+
+
+class QueuedCommand:
+    """What a poll needs to know about an undelivered command"""
+
+    __slots__ = ('id', 'device_name', 'action', 'created_at', 'status', 'claimed_at')
+
+    def __init__(self, command):
+        self.id = command.id
+        self.device_name = _device_name(command)
+        self.action = command.action
+        self.created_at = command.created_at
+        self.status = command.status
+        self.claimed_at = command.claimed_at
+
+    def as_response(self):
+        return {
+            'command_id': self.id,
+            'device_name': self.device_name,
+            'action': self.action,
+            'created_at': self.created_at
+        }
+
+
+def _persist_batch(items):
+    """Write queued claims and timeouts, one UPDATE per distinct timestamp.
+
+    The status guards keep a late write from undoing a result the controller
+    has reported in the meantime.
+    """
+    claims, failures = defaultdict(list), defaultdict(list)
+    for kind, command_id, at in items:
+        (claims if kind == 'claim' else failures)[at].append(command_id)
+    for claimed_at, ids in claims.items():
+        DeviceCommand.objects.filter(id__in=ids, status='pending').update(status='executing', claimed_at=claimed_at)
+    for executed_at, ids in failures.items():
+        DeviceCommand.objects.filter(id__in=ids, is_executed=False).update(
+            is_executed=True, status='failed', executed_at=executed_at
+        )
+
+
+async def _persisted(result):
+    pass
+
+
+command_writer = BatchDispatcher(
+    'commands.persist', _persist_batch, _persisted,
+    batch_size=getattr(settings, 'COMMAND_PERSIST_BATCH_SIZE', 500)
+).register_flush_at_exit()
+
+
+class CommandQueues:
+    """Per-controller FIFO queues of undelivered commands in the serving process.
+
+    Each controller's queue is an insertion-ordered dict keyed by command id,
+    so enqueueing, taking the head and removing an acknowledged command are
+    all O(1). Commands join their queue when the transaction creating them
+    commits (see the post_save receiver in models.py) and leave it when the
+    result the controller reports is committed, or when they go stale. Claims and timeouts
+    reach the database through ``command_writer`` in batches. A process
+    loads the unexecuted rows the first time it needs the queues, so queues
+    survive restarts.
+
+    Only correct while one process creates and serves all commands (daphne);
+    with COMMAND_QUEUES_IN_MEMORY off every poll goes to the database.
+    """
+
+    def __init__(self):
+        self._queues = defaultdict(OrderedDict)
+        self._lock = threading.Lock()
+        self._loaded_pid = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'COMMAND_QUEUES_IN_MEMORY', False)
+
+    def _ensure_loaded(self):
+        # A forked worker must not trust its parent's copy
+        if self._loaded_pid == os.getpid():
+            return
+        rows = list(
+            DeviceCommand.objects.filter(is_executed=False, status__in=['pending', 'executing'])
+            .select_related('device', 'controller').order_by('created_at')
+        )
+        with self._lock:
+            if self._loaded_pid == os.getpid():
+                return
+            queues = defaultdict(OrderedDict)
+            for command in rows:
+                queues[command.controller.controller_id][command.id] = QueuedCommand(command)
+            # Keep anything enqueued while the rows were loading
+            for controller_id, queue in self._queues.items():
+                merged = queues[controller_id]
+                for command_id, entry in queue.items():
+                    merged.setdefault(command_id, entry)
+                queues[controller_id] = OrderedDict(sorted(merged.items(), key=lambda item: item[1].created_at))
+            self._queues = queues
+            self._loaded_pid = os.getpid()
+        logger.info(f"Loaded {len(rows)} unexecuted commands into the command queues")
+
+    def reload(self):
+        """Drop the queues; they are rebuilt from the database on next use"""
+        with self._lock:
+            self._queues = defaultdict(OrderedDict)
+            self._loaded_pid = None
+
+    def enqueue(self, command):
+        with self._lock:
+            self._queues[command.controller.controller_id][command.id] = QueuedCommand(command)
+
+    def enqueue_on_commit(self, command):
+        if self.enabled:
+            transaction.on_commit(lambda: self.enqueue(command))
+
+    def get(self, command_id, controller_id):
+        """The command's queue entry, if it has one"""
+        with self._lock:
+            queue = self._queues.get(controller_id)
+            return queue.get(command_id) if queue else None
+
+    def ack(self, command_id, controller_id):
+        """Remove a command the controller reported on; returns its queue entry, if it had one"""
+        with self._lock:
+            queue = self._queues.get(controller_id)
+            return queue.pop(command_id, None) if queue else None
+
+    def ack_on_commit(self, command_id, controller_id):
+        """Remove the command once the transaction recording its result commits.
+
+        If that transaction rolls back, the command stays queued for the next poll.
+        """
+        transaction.on_commit(lambda: self.ack(command_id, controller_id))
+
+    def _take(self, controller_id):
+        """Fail stale commands at the head, then claim up to POLL_BATCH from the front"""
+        now = timezone.now()
+        stale_cutoff = now - STALE_AFTER
+        to_persist, claimed, entries = [], [], []
+        with self._lock:
+            queue = self._queues.get(controller_id)
+            if not queue:
+                return [], []
+            while queue:
+                entry = next(iter(queue.values()))
+                if entry.created_at >= stale_cutoff:
+                    break
+                queue.popitem(last=False)
+                to_persist.append(('fail', entry.id, now))
+            for entry in queue.values():
+                if len(entries) == POLL_BATCH:
+                    break
+                if entry.status == 'pending':
+                    entry.status = 'executing'
+                    entry.claimed_at = now
+                    claimed.append(entry)
+                    to_persist.append(('claim', entry.id, now))
+                entries.append(entry)
+        stale_count = sum(kind == 'fail' for kind, _, _ in to_persist)
+        if stale_count:
+            logger.info(f"Cleaned up {stale_count} stale commands for controller {controller_id}")
+        for item in to_persist:
+            command_writer.submit(item)
+        return entries, claimed
+
+    def poll(self, controller):
+        """Commands to hand to the controller, as response dicts"""
+        if not self.enabled:
+            return self._poll_database(controller)
+        self._ensure_loaded()
+        entries, claimed = self._take(controller.controller_id)
+        record_claims(claimed, controller.controller_id)
+        return [entry.as_response() for entry in entries]
+
+    async def apoll(self, controller):
+        if not self.enabled:
+            return await sync_to_async(self._poll_database)(controller)
+        if self._loaded_pid != os.getpid():
+            await sync_to_async(self._ensure_loaded)()
+        entries, claimed = self._take(controller.controller_id)
+        record_claims(claimed, controller.controller_id)
+        return [entry.as_response() for entry in entries]
+
+    def _poll_database(self, controller):
+        now = timezone.now()
+        with transaction.atomic():
+            stale_count = DeviceCommand.objects.filter(
+                controller=controller,
+                is_executed=False,
+                created_at__lt=now - STALE_AFTER
+            ).update(is_executed=True, status='failed', executed_at=now)
+            if stale_count:
+                logger.info(f"Cleaned up {stale_count} stale commands for controller {controller.controller_id}")
+
+            pending_commands = list(DeviceCommand.objects.filter(
+                controller=controller,
+                is_executed=False,
+                status__in=['pending', 'executing']
+            ).select_related('device').order_by('created_at')[:POLL_BATCH])
+
+            claimed = [cmd for cmd in pending_commands if cmd.status == 'pending']
+            for cmd in claimed:
+                cmd.status = 'executing'
+                cmd.claimed_at = now
+            if claimed:
+                DeviceCommand.objects.bulk_update(claimed, ['status', 'claimed_at'])
+        record_claims(claimed, controller.controller_id)
+        return [QueuedCommand(cmd).as_response() for cmd in pending_commands]
+
+
+command_queues = CommandQueues()
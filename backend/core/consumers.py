@@ -5,7 +5,10 @@ from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from channels.layers import get_channel_layer
+from django.utils import timezone
+from .event_stream import build_state_snapshot, replay_since
 from .models import UserProfile
+from .presence import user_connected, user_disconnected, user_seen
 import logging
 
 logger = logging.getLogger(__name__)
@@ -53,8 +56,45 @@ class DeviceStatusConsumer(AsyncWebsocketConsumer):
         )
         
         await self.accept()
+
+        # Register the socket so send helpers know this user is listening
+        self.presence_email = user.email
+        await user_connected(self.presence_email)
         logger.info(f"WebSocket connected for user: {self.user_email}")
 
+        # Bring the client up to date: replay what it missed since its last
+        # sequence number, or send the full state if that is no longer buffered
+        await self.send_initial_state(user, query_params.get('since', [None])[0])
+
+    async def send_initial_state(self, user, since):
+        events = None
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                since = None
+        if since is not None:
+            events = await database_sync_to_async(replay_since)(self.presence_email, since)
+
+        if events is not None:
+            for event in events:
+                await self.send(text_data=json.dumps(event))
+            self.sync_seq = events[-1]['seq'] if events else since
+            await self.send(text_data=json.dumps({
+                'type': 'resumed',
+                'seq': self.sync_seq,
+                'replayed': len(events)
+            }))
+            return
+
+        self.sync_seq, state = await database_sync_to_async(build_state_snapshot)(user)
+        await self.send(text_data=json.dumps({
+            'type': 'snapshot',
+            'seq': self.sync_seq,
+            'timestamp': timezone.now().isoformat(),
+            'data': state
+        }))
+
     async def disconnect(self, close_code):
         # Leave user group
         if hasattr(self, 'user_group_name'):
@@ -62,12 +102,16 @@ class DeviceStatusConsumer(AsyncWebsocketConsumer):
                 self.user_group_name,
                 self.channel_name
             )
+        if hasattr(self, 'presence_email'):
+            await user_disconnected(self.presence_email)
         logger.info(f"WebSocket disconnected for user: {getattr(self, 'user_email', 'unknown')}, code: {close_code}")
 
     async def receive(self, text_data):
         try:
             data = json.loads(text_data)
             if data.get('type') == 'heartbeat':
+                if hasattr(self, 'presence_email'):
+                    await user_seen(self.presence_email)
                 await self.send(text_data=json.dumps({
                     'type': 'heartbeat_ack',
                     'timestamp': data.get('timestamp')
@@ -75,15 +119,27 @@ class DeviceStatusConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"Error processing WebSocket message: {e}")
 
+    async def forward(self, event):
+        # Events up to the sync point are already covered by the snapshot or
+        # replay. Later ones are all forwarded: concurrent senders can deliver
+        # them slightly out of order, so this is not a moving high-water mark.
+        # Unnumbered events (no shared counters, see event_stream.sequenced)
+        # are always forwarded.
+        if (event.get('seq') or 0) and event['seq'] <= getattr(self, 'sync_seq', 0):
+            return
+        # Send helpers pre-encode the client JSON once for all of the user's
+        # sockets; plain events are still serialized here
+        await self.send(text_data=event['text'] if 'text' in event else json.dumps(event))
+
     # Message handlers
     async def device_status(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.forward(event)
 
     async def command_update(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.forward(event)
 
     async def device_paired(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.forward(event)
 
     @database_sync_to_async
     def get_user(self, email):
@@ -94,4 +150,4 @@ class DeviceStatusConsumer(AsyncWebsocketConsumer):
             return None
 
     async def alert_notification(self, event):
-        await self.send(text_data=json.dumps(event))
\ No newline at end of file
+        await self.forward(event)
\ No newline at end of file
@@ -0,0 +1,29 @@
+# core/db.py
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """connection_created receiver applying SQLITE_PRAGMAS to new SQLite connections.
+
+    journal_mode=WAL is stored in the database file, so it is only switched
+    when the file is not in WAL already (and never for in-memory test
+    databases, which cannot use it). The other pragmas are per connection.
+    """
+    if connection.vendor != 'sqlite':
+        return
+
+    pragmas = dict(getattr(settings, 'SQLITE_PRAGMAS', {}))
+    journal_mode = pragmas.pop('journal_mode', None)
+
+    with connection.cursor() as cursor:
+        if journal_mode and not connection.is_in_memory_db():
+            cursor.execute('PRAGMA journal_mode')
+            if cursor.fetchone()[0].lower() != journal_mode.lower():
+                cursor.execute(f'PRAGMA journal_mode={journal_mode}')
+                logger.info(f"SQLite journal_mode set to {cursor.fetchone()[0]} for {connection.settings_dict['NAME']}")
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
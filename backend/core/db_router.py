@@ -0,0 +1,160 @@
+# core/db_router.py
+import json
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+
+# Alias the current view reads core models from, set by read_from_replica
+_replica_reads = ContextVar('replica_reads', default=None)
+# Request being served, so a write can pin its client to the primary
+_current_request = ContextVar('current_request', default=None)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def replica_alias():
+    """The read replica's alias, or None when no replica is configured"""
+    alias = getattr(settings, 'READ_REPLICA_ALIAS', 'replica')
+    return alias if alias in settings.DATABASES else None
+
+
+def _cache():
+    return caches[getattr(settings, 'READ_YOUR_WRITES_CACHE', 'default')]
+
+
+def _window():
+    return getattr(settings, 'READ_YOUR_WRITES_WINDOW', 5)
+
+
+def _cookie_name():
+    return getattr(settings, 'READ_YOUR_WRITES_COOKIE', 'db_primary')
+
+
+def pin_key(email):
+    return f'db_primary:{email}'
+
+
+def client_email(request):
+    """The user a mobile request acts for: ``email`` in the query string or JSON body"""
+    email = request.GET.get('email')
+    if not email and request.method not in SAFE_METHODS and request.content_type == 'application/json':
+        try:
+            email = json.loads(request.body or b'{}').get('email')
+        except (ValueError, AttributeError):
+            email = None
+    return email if isinstance(email, str) and email else None
+
+
+def reads_pinned(request):
+    """True while the client is inside the read-your-writes window of its last write"""
+    if request.COOKIES.get(_cookie_name()):
+        return True
+    email = request.GET.get('email')
+    return bool(email) and bool(_cache().get(pin_key(email)))
+
+
+def _pin_to_primary(request):
+    request.wrote_primary = True
+    email = getattr(request, 'db_client_email', None)
+    if email:
+        _cache().set(pin_key(email), True, _window())
+
+
+def read_from_replica(view_func):
+    """Serve the view's reads of core models from the read replica.
+
+    Only for GET/HEAD and only when a replica is configured; a client that
+    wrote within READ_YOUR_WRITES_WINDOW keeps reading from the primary.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        alias = replica_alias()
+        if alias is None or request.method not in ('GET', 'HEAD') or reads_pinned(request):
+            return view_func(request, *args, **kwargs)
+        token = _replica_reads.set(alias)
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+    return wrapper
+
+
+class ReadReplicaRouter:
+    """Writes always go to the primary; core reads go to the replica inside read_from_replica views.
+
+    Auth, sessions and the other contrib apps always use the primary, so a
+    login is never checked against a lagging copy.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'core':
+            alias = _replica_reads.get()
+            if alias is not None:
+                return alias
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == 'core':
+            request = _current_request.get()
+            if request is not None and not getattr(request, 'wrote_primary', False):
+                _pin_to_primary(request)
+        # Explicit, or an instance loaded from the replica would be saved back to it
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+
+class ReadYourWritesMiddleware:
+    """Tracks the request so writes to core models pin the client to the primary.
+
+    The client's email (when the request carries one) is pinned in the cache
+    and the response gets a short-lived cookie, which also covers requests
+    identified only by device or command id and the admin. Does nothing
+    without a replica. Works for sync and async views alike.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if replica_alias() is None:
+            return self.get_response(request)
+        token = self.track(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        return self.finish(request, response)
+
+    async def __acall__(self, request):
+        if replica_alias() is None:
+            return await self.get_response(request)
+        token = self.track(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        return self.finish(request, response)
+
+    def track(self, request):
+        request.db_client_email = client_email(request)
+        return _current_request.set(request)
+
+    def finish(self, request, response):
+        if getattr(request, 'wrote_primary', False):
+            response.set_cookie(_cookie_name(), '1', max_age=_window(), httponly=True, samesite='Lax')
+        return response
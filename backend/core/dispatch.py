@@ -0,0 +1,98 @@
+# core/dispatch.py
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from django.db import close_old_connections
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BatchDispatcher:
+    """Hands work off to a background thread that processes it in batches.
+
+    ``prepare(items)`` runs synchronously in the sender thread (database and
+    cache access belong here) and returns what ``send`` needs; ``send`` is a
+    coroutine run on the thread's own event loop, which stays open so channel
+    layer connections are reused across batches. Whatever is queued when the
+    thread wakes up forms the next batch, up to ``batch_size``.
+
+    When ``background()`` is false the work runs inline in the caller instead.
+    """
+
+    def __init__(self, name, prepare, send, background=lambda: True, batch_size=100):
+        self.name = name
+        self.prepare = prepare
+        self.send = send
+        self.background = background
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def submit(self, item):
+        if not self.background():
+            async_to_sync(self.send)(self.prepare([item]))
+            return
+        self._ensure_thread()
+        self.queue.put(item)
+
+    def _ensure_thread(self):
+        # A forked worker inherits the object but not the thread
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                close_old_connections()
+                payload = self.prepare(batch)
+                close_old_connections()
+                loop.run_until_complete(self.send(payload))
+                metrics.incr(f'{self.name}.batches')
+                metrics.incr(f'{self.name}.items', len(batch))
+            except Exception as e:
+                metrics.incr(f'{self.name}.errors')
+                logger.error(f"{self.name}: batch of {len(batch)} failed: {e}", exc_info=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self, timeout=5):
+        """Wait until everything queued so far has been processed (or ``timeout`` passes)"""
+        if self.thread is None or self.pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def register_flush_at_exit(self):
+        # Short-lived processes (management commands) still deliver what they queued
+        atexit.register(self.flush)
+        return self
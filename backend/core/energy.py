@@ -0,0 +1,140 @@
+# core/energy.py
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import EnergyBucket
+
+logger = logging.getLogger(__name__)
+
+# Converts amps x volts x seconds (watt-seconds) into kWh
+WATT_SECONDS_PER_KWH = 3600 * 1000
+
+
+def _hour_start(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _day_start(moment):
+    local = timezone.localtime(moment)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def split_interval(start, end, start_amps, end_amps, voltage):
+    """Split a trapezoid between two samples into (hour_start, kwh) pieces.
+
+    Current is assumed to change linearly between the two samples, so the
+    value at each hour boundary is interpolated before integrating each piece.
+    """
+    total_seconds = (end - start).total_seconds()
+    pieces = []
+    piece_start, piece_amps = start, start_amps
+
+    while piece_start < end:
+        piece_end = min(_hour_start(piece_start) + timedelta(hours=1), end)
+        fraction = (piece_end - start).total_seconds() / total_seconds
+        piece_end_amps = start_amps + (end_amps - start_amps) * fraction
+        seconds = (piece_end - piece_start).total_seconds()
+        kwh = (piece_amps + piece_end_amps) / 2 * voltage * seconds / WATT_SECONDS_PER_KWH
+        pieces.append((_hour_start(piece_start), kwh))
+        piece_start, piece_amps = piece_end, piece_end_amps
+
+    return pieces
+
+
+def _add_to_bucket(device, period, start, kwh):
+    lookup = {'device': device, 'period': period, 'start': start}
+    if EnergyBucket.objects.filter(**lookup).update(kwh=F('kwh') + kwh):
+        return
+    try:
+        with transaction.atomic():
+            EnergyBucket.objects.create(kwh=kwh, **lookup)
+    except IntegrityError:
+        # Another report created the bucket first
+        EnergyBucket.objects.filter(**lookup).update(kwh=F('kwh') + kwh)
+
+
+def _energy_pieces(device, previous_amps, amps, sampled_at, steady_until=None):
+    """(period, bucket start, kWh) increments for a new sample; advances the device's baseline.
+
+    ``steady_until`` is the last report since the baseline whose write was
+    coalesced away (see core/coalescing.py): it carried ``previous_amps``
+    again, so the current is held flat up to it and only ramps after. When
+    it is None (no reports held, or held by another process) the current
+    ramps linearly across the whole interval.
+    """
+    last_sampled_at = device.current_sampled_at
+    device.current_sampled_at = sampled_at
+
+    try:
+        amps = max(float(amps), 0.0)
+        previous_amps = max(float(previous_amps), 0.0) if previous_amps is not None else None
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring non-numeric current sample for {device.device_id}: {amps!r}")
+        return []
+
+    if last_sampled_at is None or previous_amps is None:
+        return []
+
+    if steady_until is not None and not last_sampled_at < steady_until < sampled_at:
+        steady_until = None
+    ramp_start = steady_until or last_sampled_at
+    elapsed = (sampled_at - ramp_start).total_seconds()
+    if elapsed <= 0:
+        return []
+
+    max_gap = getattr(settings, 'ENERGY_MAX_SAMPLE_GAP', 300)
+    if elapsed > max_gap:
+        # Nothing is known about the load while the controller was silent, so
+        # restart integration from this sample instead of guessing
+        logger.info(f"Skipping {elapsed:.0f}s reporting gap for {device.device_id}")
+        return []
+
+    voltage = getattr(settings, 'ENERGY_SUPPLY_VOLTAGE', 230.0)
+    pieces = split_interval(ramp_start, sampled_at, previous_amps, amps, voltage)
+    if steady_until is not None:
+        pieces = split_interval(last_sampled_at, steady_until, previous_amps, previous_amps, voltage) + pieces
+
+    hourly, daily = defaultdict(float), defaultdict(float)
+    for hour_start, kwh in pieces:
+        hourly[hour_start] += kwh
+        daily[_day_start(hour_start)] += kwh
+    return [('hour', start, kwh) for start, kwh in hourly.items()] + [('day', start, kwh) for start, kwh in daily.items()]
+
+
+def accumulate_energy(device, previous_amps, amps, sampled_at, steady_until=None):
+    """Integrate a new current sample into the device's hourly and daily buckets.
+
+    ``previous_amps`` is the value reported at ``device.current_sampled_at``
+    (and, if given, at every report up to ``steady_until``).
+    The caller is responsible for saving ``device`` afterwards, which persists
+    the new integration baseline. Returns the kWh added.
+    """
+    pieces = _energy_pieces(device, previous_amps, amps, sampled_at, steady_until)
+    for period, start, kwh in pieces:
+        _add_to_bucket(device, period, start, kwh)
+    return sum(kwh for period, _, kwh in pieces if period == 'hour')
+
+
+async def _aadd_to_bucket(device, period, start, kwh):
+    lookup = {'device': device, 'period': period, 'start': start}
+    if await EnergyBucket.objects.filter(**lookup).aupdate(kwh=F('kwh') + kwh):
+        return
+    try:
+        # Async queries run in autocommit, so a failed insert leaves nothing to roll back
+        await EnergyBucket.objects.acreate(kwh=kwh, **lookup)
+    except IntegrityError:
+        await EnergyBucket.objects.filter(**lookup).aupdate(kwh=F('kwh') + kwh)
+
+
+async def aaccumulate_energy(device, previous_amps, amps, sampled_at, steady_until=None):
+    """Async version of accumulate_energy"""
+    pieces = _energy_pieces(device, previous_amps, amps, sampled_at, steady_until)
+    for period, start, kwh in pieces:
+        await _aadd_to_bucket(device, period, start, kwh)
+    return sum(kwh for period, _, kwh in pieces if period == 'hour')
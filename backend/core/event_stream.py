@@ -0,0 +1,168 @@
+# core/event_stream.py
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import Controller, Device, DeviceAlert
+from .presence import tracked
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_TTL = 30 * 24 * 60 * 60
+
+
+def _cache():
+    return caches[getattr(settings, 'WEBSOCKET_PRESENCE_CACHE', 'default')]
+
+
+def _buffer_size():
+    return getattr(settings, 'WEBSOCKET_REPLAY_BUFFER', 200)
+
+
+def _sequence_key(user_email):
+    return f'ws_seq:{user_email}'
+
+
+def _slot_key(user_email, seq):
+    return f'ws_event:{user_email}:{seq % _buffer_size()}'
+
+
+def sequenced():
+    """Whether events are numbered and buffered for replay.
+
+    The counter and the ring live in the presence cache, so numbering needs
+    the same shared, atomic counters as presence tracking. Otherwise each
+    process would hand out its own numbers and clients could skip or replay
+    the wrong events; they get no numbers and a snapshot on every connect.
+    """
+    return tracked()
+
+
+def current_seq(user_email):
+    if not sequenced():
+        return 0
+    return _cache().get(_sequence_key(user_email)) or 0
+
+
+def record_event(user_email, message):
+    """Stamp an outgoing event with the user's next sequence number and buffer it for replay.
+
+    The counter starts from the current time in microseconds, so if it is ever
+    evicted the new numbers still jump past anything a client has seen and
+    its next resume falls back to a snapshot instead of replaying the wrong
+    events. The buffer is a ring of cache keys, one per slot, so concurrent
+    writers never read-modify-write a shared list. Without shared counters
+    (see ``sequenced``) the message is returned unnumbered.
+    """
+    if not sequenced():
+        return message
+    cache, key = _cache(), _sequence_key(user_email)
+    try:
+        cache.add(key, time.time_ns() // 1000, SEQUENCE_TTL)
+        try:
+            seq = cache.incr(key)
+        except ValueError:
+            # Culled between add and incr; restart from the clock like a new counter
+            seq = time.time_ns() // 1000
+            cache.set(key, seq, SEQUENCE_TTL)
+        message = {**message, 'seq': seq}
+        cache.set(_slot_key(user_email, seq), message, getattr(settings, 'WEBSOCKET_REPLAY_TTL', 60 * 60))
+    except Exception as e:
+        logger.warning(f"Could not record WebSocket event for {user_email}: {e}")
+    return message
+
+
+async def arecord_event(user_email, message):
+    """Async version of record_event"""
+    if not sequenced():
+        return message
+    cache, key = _cache(), _sequence_key(user_email)
+    try:
+        await cache.aadd(key, time.time_ns() // 1000, SEQUENCE_TTL)
+        try:
+            seq = await cache.aincr(key)
+        except ValueError:
+            seq = time.time_ns() // 1000
+            await cache.aset(key, seq, SEQUENCE_TTL)
+        message = {**message, 'seq': seq}
+        await cache.aset(_slot_key(user_email, seq), message, getattr(settings, 'WEBSOCKET_REPLAY_TTL', 60 * 60))
+    except Exception as e:
+        logger.warning(f"Could not record WebSocket event for {user_email}: {e}")
+    return message
+
+
+def replay_since(user_email, since):
+    """Events after ``since``, oldest first, or None if the buffer no longer covers the gap"""
+    if not sequenced():
+        return None
+    latest = current_seq(user_email)
+    if since == latest:
+        return []
+    if since > latest or latest - since > _buffer_size():
+        return None
+
+    wanted = range(since + 1, latest + 1)
+    keys = [_slot_key(user_email, seq) for seq in wanted]
+    found = _cache().get_many(keys)
+    events = []
+    for seq, key in zip(wanted, keys):
+        event = found.get(key)
+        if event is None or event.get('seq') != seq:
+            # Expired, or overwritten by a newer event in the same slot
+            return None
+        events.append(event)
+    return events
+
+
+def build_state_snapshot(user):
+    """Sequence number and compact state of everything the app shows on its home screens.
+
+    The sequence is read before the state, so any event not reflected in the
+    snapshot carries a higher number and is still delivered afterwards.
+    """
+    seq = current_seq(user.email)
+
+    devices = [
+        {
+            'device_id': device.device_id,
+            'name': device.name,
+            'hardware_pin': device.hardware_pin,
+            'type': device.type,
+            'status': device.status,
+            'room_id': device.room_id,
+            'room_name': device.room.name if device.room else None,
+            'controller_id': device.controller.controller_id if device.controller else None,
+            'current_value': device.current_value,
+            'last_seen': device.last_seen.isoformat() if device.last_seen else None,
+        }
+        for device in Device.objects.filter(owner=user, is_paired=True).select_related('room', 'controller')
+    ]
+    controllers = Controller.objects.filter(owner=user).aggregate(
+        controllers_count=Count('id'),
+        online_controllers=Count('id', filter=Q(is_online=True)),
+    )
+    alert = DeviceAlert.objects.filter(
+        device__owner=user,
+        is_resolved=False,
+        created_at__gte=timezone.now() - timedelta(hours=24)
+    ).order_by('-created_at').first()
+
+    return seq, {
+        'devices': devices,
+        'system': {
+            'devices_count': len(devices),
+            'online_devices': sum(device['status'] == 'on' for device in devices),
+            **controllers,
+            'active_alert': {
+                'id': str(alert.id),
+                'message': alert.message,
+                'timestamp': alert.created_at.strftime('%H:%M'),
+                'type': alert.alert_type
+            } if alert else None,
+        },
+    }
@@ -0,0 +1,166 @@
+# core/idempotency.py
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .metrics import metrics
+from .models import Device, IdempotencyRecord, UserProfile
+
+HEADER = 'Idempotency-Key'
+# Cached while the first request with a key is still running
+IN_PROGRESS = 'in_progress'
+
+
+def _cache():
+    return caches[getattr(settings, 'IDEMPOTENCY_CACHE', 'default')]
+
+
+def _cache_ttl():
+    return getattr(settings, 'IDEMPOTENCY_CACHE_TTL', 10 * 60)
+
+
+def _ttl():
+    return getattr(settings, 'IDEMPOTENCY_TTL', 24 * 60 * 60)
+
+
+def caller(request):
+    """Whose key it is: the signed-in user, else the email the app sends, else the client address"""
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    email = request.data.get('email') if hasattr(request.data, 'get') else None
+    email = email or request.query_params.get('email')
+    if email:
+        return f'email:{email.strip().lower()}'
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    return f"ip:{forwarded.split(',')[0].strip() if forwarded else request.META.get('REMOTE_ADDR', '')}"
+
+
+def device_owner(request):
+    """The owner of the device in the body (or of its controller), else ``caller``.
+
+    Device control requests carry no email, so without this the key would
+    be scoped by client address, which changes as a phone moves networks.
+    """
+    device_id = request.data.get('device_id') if hasattr(request.data, 'get') else None
+    owners = Device.objects.filter(device_id=device_id).values_list('owner_id', 'controller__owner_id').first()
+    if owners and (owners[0] or owners[1]):
+        return f'profile:{owners[0] or owners[1]}'
+    return caller(request)
+
+
+def profile_owner(request):
+    """The profile named by the email in the body, else ``caller``"""
+    email = request.data.get('email') if hasattr(request.data, 'get') else None
+    pk = UserProfile.objects.filter(email=email).values_list('pk', flat=True).first() if email else None
+    return f'profile:{pk}' if pk else caller(request)
+
+
+def cache_key(scope, owner, key):
+    # Hashed: client keys may hold characters memcached keys cannot
+    digest = hashlib.sha256('\n'.join((owner, key)).encode()).hexdigest()
+    return f'idempotency:{scope}:{digest}'
+
+
+def _stored(scope, owner, key):
+    """(request_hash, status_code, response) saved for the key, from the cache or the database"""
+    stored = _cache().get(cache_key(scope, owner, key))
+    if stored is not None:
+        return stored
+    record = IdempotencyRecord.objects.filter(
+        scope=scope, caller=owner, key=key, created_at__gte=timezone.now() - timedelta(seconds=_ttl())
+    ).first()
+    if record is None:
+        return None
+    stored = (record.request_hash, record.status_code, record.response)
+    _cache().set(cache_key(scope, owner, key), stored, _cache_ttl())
+    return stored
+
+
+def _replay(stored, request_hash):
+    if stored == IN_PROGRESS:
+        return Response(
+            {'error': f'A request with this {HEADER} is still being processed'},
+            status=status.HTTP_409_CONFLICT
+        )
+    stored_hash, status_code, data = stored
+    if stored_hash != request_hash:
+        return Response(
+            {'error': f'{HEADER} was already used for a different request'},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    metrics.incr('idempotency.replays')
+    response = Response(data, status=status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(scope, owner=caller):
+    """Replay the first response to retries of a request carrying an Idempotency-Key.
+
+    For APIView handlers. Keys are per owner, ``owner(request)``: the caller
+    by default, or the owner of the resource acted on (``device_owner``,
+    ``profile_owner``). Two clients picking the same key never see each
+    other's responses. The key
+    is claimed in the cache while the first request runs; its response (anything but a 5xx) is kept in the cache for
+    IDEMPOTENCY_CACHE_TTL and in IdempotencyRecord for IDEMPOTENCY_TTL, so a
+    retry gets the same answer without running the handler again. Requests
+    without the header behave as before.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return handler(self, request, *args, **kwargs)
+            if len(key) > 255:
+                return Response({'error': f'{HEADER} is too long'}, status=status.HTTP_400_BAD_REQUEST)
+
+            request_hash = hashlib.sha256(request.body).hexdigest()
+            key_owner = owner(request)
+            stored = _stored(scope, key_owner, key)
+            if stored is not None:
+                return _replay(stored, request_hash)
+
+            cache, slot = _cache(), cache_key(scope, key_owner, key)
+            if not cache.add(slot, IN_PROGRESS, _cache_ttl()):
+                # Another request with the key got here first
+                return _replay(cache.get(slot) or IN_PROGRESS, request_hash)
+
+            try:
+                response = handler(self, request, *args, **kwargs)
+            except Exception:
+                cache.delete(slot)
+                raise
+            if response.status_code >= 500:
+                # Let the retry run again
+                cache.delete(slot)
+                return response
+
+            # Stored as rendered, so datetimes replay exactly as first sent
+            data = json.loads(JSONRenderer().render(response.data))
+            cache.set(slot, (request_hash, response.status_code, data), _cache_ttl())
+            try:
+                # A savepoint, so the conflict below leaves an enclosing transaction usable
+                with transaction.atomic():
+                    IdempotencyRecord.objects.create(
+                        scope=scope, caller=key_owner, key=key, request_hash=request_hash,
+                        status_code=response.status_code, response=data
+                    )
+            except IntegrityError:
+                # An expired record with the same key; the fresh one wins
+                IdempotencyRecord.objects.filter(scope=scope, caller=key_owner, key=key).update(
+                    request_hash=request_hash, status_code=response.status_code,
+                    response=data, created_at=timezone.now()
+                )
+            return response
+        return wrapper
+    return decorator
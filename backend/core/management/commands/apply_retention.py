@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.retention import RetentionPolicy, apply_policy, archive_root, get_policies
+
+
+class Command(BaseCommand):
+    help = 'Archive expired log, command and alert rows to compressed NDJSON and delete them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be archived and deleted without making changes'
+        )
+        parser.add_argument('--table', action='append', help='Only apply the policy for this table (repeatable)')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows archived per chunk')
+        parser.add_argument('--delete-batch', type=int, default=500, help='Rows deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between delete batches')
+
+    def handle(self, *args, **options):
+        policies = get_policies()
+        tables = options['table'] or list(policies)
+        unknown = set(tables) - set(policies)
+        if unknown:
+            raise CommandError(f'No retention policy for: {", ".join(sorted(unknown))}')
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        for table in tables:
+            policy = RetentionPolicy(table, **policies[table])
+
+            if options['dry_run']:
+                report = policy.report()
+                self.stdout.write(
+                    f"{table}: {report['expired_rows']} of {report['total_rows']} rows older than "
+                    f"{report['cutoff']:%Y-%m-%d} ({policy.days} days)"
+                )
+                if report['expired_rows']:
+                    self.stdout.write(f"  would archive {report['oldest']:%Y-%m-%d} .. {report['newest']:%Y-%m-%d} to {archive_root() / table}")
+                continue
+
+            totals = apply_policy(
+                policy,
+                chunk_size=options['chunk_size'],
+                delete_batch=options['delete_batch'],
+                pause=options['pause'],
+                log=self.stdout.write
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f"{table}: archived {totals['archived']} rows, deleted {totals['deleted']}"
+            ))
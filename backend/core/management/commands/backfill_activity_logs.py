@@ -0,0 +1,87 @@
+import time
+from multiprocessing import get_context
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core.models import MaintenanceCheckpoint
+from core.utils import BACKFILL_SOURCES, backfill_checkpoint_name, backfill_range, finish_backfill, plan_backfill
+
+
+def run_range(job):
+    """Pool entry point: backfill one planned range in this worker process"""
+    source, part, chunk_size = job
+    try:
+        return source, part, backfill_range(source, part, chunk_size)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Create activity logs from existing device commands and alerts, in resumable chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            action='append',
+            choices=list(BACKFILL_SOURCES),
+            help='Only backfill from this table (repeatable)'
+        )
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Source rows per bulk insert')
+        parser.add_argument('--workers', type=int, default=1, help='Processes, each backfilling its own id range')
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Forget previous progress and start from the first row (logs already written are kept, '
+                 'so only use this after deleting them)'
+        )
+
+    def handle(self, *args, **options):
+        sources = options['source'] or list(BACKFILL_SOURCES)
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+
+        if options['reset']:
+            for source in sources:
+                MaintenanceCheckpoint.objects.filter(name__startswith=backfill_checkpoint_name(source)).delete()
+
+        jobs = []
+        planned = []
+        for source in sources:
+            checkpoint = MaintenanceCheckpoint.objects.filter(name=backfill_checkpoint_name(source)).first()
+            resuming = bool(checkpoint and checkpoint.state.get('ranges'))
+            ranges = plan_backfill(source, workers)
+            if not ranges:
+                high_water = MaintenanceCheckpoint.objects.get(name=backfill_checkpoint_name(source)).state['high_water']
+                self.stdout.write(f'{source}: already backfilled through id {high_water}; newer rows are logged live')
+                continue
+            verb = 'resuming' if resuming else 'planned'
+            self.stdout.write(f'{source}: {verb} ids {ranges[0][0]}-{ranges[-1][1]} in {len(ranges)} ranges')
+            jobs.extend((source, part, options['chunk_size']) for part in range(len(ranges)))
+            planned.append(source)
+
+        if not jobs:
+            return
+
+        started = time.perf_counter()
+        written = dict.fromkeys(planned, 0)
+        if workers == 1 or len(jobs) < 2:
+            self.collect(map(run_range, jobs), written)
+        else:
+            # Each worker opens its own database connection
+            connections.close_all()
+            with get_context('spawn').Pool(min(workers, len(jobs)), initializer=django.setup) as pool:
+                self.collect(pool.imap_unordered(run_range, jobs), written)
+
+        for source in planned:
+            if finish_backfill(source):
+                self.stdout.write(self.style.SUCCESS(f'{source}: wrote {written[source]} activity logs'))
+            else:
+                self.stdout.write(self.style.WARNING(f'{source}: incomplete, run again to resume'))
+        self.stdout.write(f'Finished in {time.perf_counter() - started:.1f}s')
+
+    def collect(self, results, written):
+        for source, part, count in results:
+            written[source] += count
+            self.stdout.write(f'  {source} range {part}: {count} logs')
@@ -0,0 +1,104 @@
+import time
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.analytics import compute_statistics, load_readings
+from core.models import CurrentReading, Device, UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the vectorized consumption analytics over synthetic readings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=50, help='Number of sockets in the home')
+        parser.add_argument('--rooms', type=int, default=8, help='Number of rooms the sockets are spread over')
+        parser.add_argument('--days', type=int, default=365, help='Days of history to generate')
+        parser.add_argument('--interval', type=int, default=300, help='Seconds between reports per device')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs (the best is reported)')
+        parser.add_argument(
+            '--from-database', action='store_true',
+            help='Also time load_readings: the readings are written for a throwaway user in a '
+                 'transaction that is rolled back afterwards (slow to set up for large histories)'
+        )
+
+    def handle(self, *args, **options):
+        devices = options['devices']
+        days = options['days']
+        interval = options['interval']
+
+        rng = np.random.default_rng(42)
+        end_ts = 1_760_000_000.0
+        per_device = days * 86400 // interval
+        timestamps = np.tile(end_ts - np.arange(per_device, 0, -1) * interval, devices)
+        device_ids = np.repeat(np.arange(1, devices + 1, dtype=np.int64), per_device)
+
+        # Daily sine-shaped load plus noise, so percentiles and peaks are non-trivial
+        hour = timestamps // 3600 % 24
+        amps = np.clip(1.5 + np.sin((hour - 6) / 24 * 2 * np.pi) + rng.normal(0, 0.4, timestamps.size), 0, None)
+        device_rooms = {pk: pk % options['rooms'] for pk in range(1, devices + 1)}
+
+        self.stdout.write(
+            f'{devices} devices x {days} days at {interval}s = {amps.size:,} readings '
+            f'({(timestamps.nbytes + device_ids.nbytes + amps.nbytes) / 1e6:.0f} MB of arrays)'
+        )
+
+        timings = []
+        for _ in range(options['repeat']):
+            started = time.perf_counter()
+            stats = compute_statistics(
+                device_ids, timestamps, amps, device_rooms,
+                start_ts=end_ts - days * 86400, end_ts=end_ts
+            )
+            timings.append(time.perf_counter() - started)
+
+        best = min(timings)
+        self.stdout.write(self.style.SUCCESS(
+            f'compute_statistics: best {best * 1000:.0f} ms of {len(timings)} runs '
+            f'({amps.size / best / 1e6:.1f}M readings/s, {len(stats["devices"])} devices, {len(stats["rooms"])} rooms)'
+        ))
+
+        if options['from_database']:
+            # The request path also loads two weeks before the range for week-over-week
+            start_ts = end_ts - (days + 14) * 86400
+            self.time_database_load(device_ids, timestamps, amps, start_ts, end_ts, options['repeat'])
+
+    def time_database_load(self, device_ids, timestamps, amps, start_ts, end_ts, repeat):
+        """Time loading the readings back through load_readings, then roll everything back"""
+        with transaction.atomic():
+            user = UserProfile.objects.create(full_name='Analytics Benchmark', email='benchmark-analytics@example.invalid')
+            devices = {
+                number: Device.objects.create(device_id=f'BENCH-ANALYTICS-{number}', name=f'Socket {number}', owner=user).pk
+                for number in np.unique(device_ids).tolist()
+            }
+            started = time.perf_counter()
+            batch = 10000
+            for offset in range(0, amps.size, batch):
+                CurrentReading.objects.bulk_create([
+                    CurrentReading(
+                        device_id=devices[int(number)],
+                        recorded_at=datetime.fromtimestamp(float(ts), dt_timezone.utc),
+                        current=float(current)
+                    )
+                    for number, ts, current in zip(
+                        device_ids[offset:offset + batch], timestamps[offset:offset + batch], amps[offset:offset + batch]
+                    )
+                ])
+            self.stdout.write(f'Wrote {amps.size:,} readings in {time.perf_counter() - started:.1f}s')
+
+            start = datetime.fromtimestamp(start_ts, dt_timezone.utc)
+            end = datetime.fromtimestamp(end_ts + 1, dt_timezone.utc)
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                loaded = load_readings(user, start, end)
+                timings.append(time.perf_counter() - started)
+            transaction.set_rollback(True)
+
+        best = min(timings)
+        self.stdout.write(self.style.SUCCESS(
+            f'load_readings: best {best * 1000:.0f} ms of {len(timings)} runs '
+            f'({loaded[2].size / best / 1e6:.2f}M rows/s, {loaded[2].size:,} rows)'
+        ))
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from multiprocessing import get_context
+from queue import Empty
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+GROUP = 'benchmark'
+
+
+def _layer(backend, config):
+    return import_string(backend)(**config)
+
+
+async def serve_receivers(layer, receivers, messages, report):
+    """Join ``receivers`` channels to the group, echo pings, and report when every channel got every message"""
+    channels = [await layer.new_channel() for _ in range(receivers)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+    echo = await layer.new_channel()
+
+    async def echo_pings():
+        while True:
+            message = await layer.receive(echo)
+            if message['type'] == 'stop':
+                return
+            await layer.send(message['reply'], message)
+
+    async def drain(channel):
+        for _ in range(messages):
+            await layer.receive(channel)
+        return time.monotonic()
+
+    echoing = asyncio.ensure_future(echo_pings())
+    await report(('ready', echo))
+    try:
+        finished = await asyncio.wait_for(asyncio.gather(*(drain(channel) for channel in channels)), 120)
+        await report(('done', max(finished)))
+    except asyncio.TimeoutError:
+        await report(('lost', None))
+    await echoing
+
+
+def run_receivers(backend, config, receivers, messages, results):
+    """Process entry point: the receiving side for layers that work across processes"""
+    async def report(item):
+        results.put(item)
+
+    asyncio.run(serve_receivers(_layer(backend, config), receivers, messages, report))
+
+
+class Command(BaseCommand):
+    help = 'Benchmark group_send throughput and round-trip latency of the channel layer backends'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--layers',
+            nargs='+',
+            choices=['redis', 'local', 'memory'],
+            default=['redis', 'local', 'memory'],
+            help='Backends to measure'
+        )
+        parser.add_argument('--receivers', type=int, default=10, help='Channels in the group (sockets of one user)')
+        parser.add_argument('--messages', type=int, default=2000, help='Group sends in the throughput run')
+        parser.add_argument('--pings', type=int, default=500, help='Round trips in the latency run')
+
+    def handle(self, *args, **options):
+        # Imported here: spawned receivers load this module before Django is set up
+        from core.websocket_utils import encode_channel_message
+
+        # Every message must arrive, so give the layers room for the whole burst
+        capacity = options['messages'] + 100
+        socket_dir = tempfile.mkdtemp(prefix='channels-bench-')
+        backends = {
+            'redis': (
+                'channels_redis.core.RedisChannelLayer',
+                {'hosts': settings.CHANNEL_LAYER_BACKENDS['redis']['CONFIG']['hosts'], 'capacity': capacity}
+            ),
+            'local': (
+                'core.channel_layers.LocalChannelLayer',
+                {'path': os.path.join(socket_dir, 'bench.sock'), 'capacity': capacity}
+            ),
+            'memory': ('channels.layers.InMemoryChannelLayer', {'capacity': capacity}),
+        }
+        payload = encode_channel_message({
+            'type': 'device_status',
+            'timestamp': '2025-01-01T00:00:00+00:00',
+            'data': {'device_id': 'ESP-0001-kitchen', 'status': 'on', 'current_value': 1.25, 'last_seen': '2025-01-01T00:00:00+00:00'},
+            'seq': 1,
+        })
+
+        self.stdout.write(
+            f"{options['receivers']} receiving channels, {options['messages']} group sends, {options['pings']} pings"
+        )
+        for name in options['layers']:
+            backend, config = backends[name]
+            try:
+                result = asyncio.run(self.measure(name, backend, config, payload, options))
+            except OSError as e:
+                self.stdout.write(self.style.WARNING(f'{name:>7}: skipped, {e}'))
+                continue
+            if result is None:
+                self.stdout.write(self.style.ERROR(f'{name:>7}: messages were lost'))
+                continue
+
+            deliveries, elapsed, rtts = result
+            self.stdout.write(self.style.SUCCESS(
+                f'{name:>7}: {deliveries / elapsed:>9,.0f} deliveries/s '
+                f'({deliveries:,} in {elapsed:.2f}s), round trip '
+                f'p50 {statistics.median(rtts) * 1000:.3f} ms, '
+                f'p99 {rtts[int(len(rtts) * 0.99) - 1] * 1000:.3f} ms'
+            ))
+
+    async def measure(self, name, backend, config, payload, options):
+        receivers, messages = options['receivers'], options['messages']
+        layer = _layer(backend, config)
+        loop = asyncio.get_running_loop()
+
+        if name == 'memory':
+            # Only works inside one process
+            reports = asyncio.Queue()
+            receiving = asyncio.ensure_future(serve_receivers(layer, receivers, messages, reports.put))
+
+            async def next_report():
+                return await reports.get()
+        else:
+            if name == 'redis':
+                try:
+                    await asyncio.wait_for(layer.group_send(GROUP, {'type': 'probe'}), 2)
+                except Exception as e:
+                    raise OSError(f'Redis is not reachable at {config["hosts"][0]}') from e
+            context = get_context('spawn')
+            results = context.Queue()
+            receiving = context.Process(target=run_receivers, args=(backend, config, receivers, messages, results))
+            receiving.start()
+
+            def wait_for_report():
+                while True:
+                    try:
+                        return results.get(timeout=1)
+                    except Empty:
+                        if not receiving.is_alive():
+                            raise OSError(f'receiver process exited with code {receiving.exitcode}')
+
+            async def next_report():
+                return await loop.run_in_executor(None, wait_for_report)
+
+        try:
+            kind, echo = await next_report()
+            reply = await layer.new_channel()
+            rtts = []
+            for _ in range(options['pings']):
+                started = time.perf_counter()
+                await layer.send(echo, {'type': 'ping', 'reply': reply})
+                await layer.receive(reply)
+                rtts.append(time.perf_counter() - started)
+            rtts.sort()
+
+            started = time.monotonic()
+            for _ in range(messages):
+                await layer.group_send(GROUP, payload)
+            kind, finished = await next_report()
+            await layer.send(echo, {'type': 'stop'})
+        finally:
+            if name == 'memory':
+                await receiving
+            else:
+                receiving.join(10)
+                if receiving.is_alive():
+                    receiving.terminate()
+
+        if kind != 'done':
+            return None
+        return receivers * messages, finished - started, rtts
@@ -0,0 +1,184 @@
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+from multiprocessing import get_context
+from queue import Empty
+
+from django.core.management.base import BaseCommand, CommandError
+
+from .loadtest_esp32 import seed_controllers, status_report
+
+
+def use_profile(profile):
+    """Set up Django in this process with the default database on ``profile``"""
+    # Settings read DATABASE_PROFILE on import, so this has to come first
+    os.environ['DATABASE_PROFILE'] = 'postgres' if profile == 'postgres' else 'sqlite'
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+
+    settings.DEBUG = False
+    settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+    if profile == 'baseline':
+        # What DATABASES used to be: rollback journal, the driver's 5 s lock
+        # timeout and a new connection for every request
+        settings.SQLITE_PRAGMAS = {}
+        connection.settings_dict.update(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False, OPTIONS={})
+    return connection
+
+
+def run_reports(profile, database_name, controller_ids, reports, start, results):
+    """Worker process: post ``reports`` status reports per controller through DeviceStatusView"""
+    connection = use_profile(profile)
+    connection.settings_dict['NAME'] = database_name
+
+    from django.db import close_old_connections
+    from rest_framework.test import APIRequestFactory
+
+    from core.views import DeviceStatusView
+
+    view = DeviceStatusView.as_view()
+    factory = APIRequestFactory()
+    latencies, errors, locked = [], 0, 0
+
+    start.wait()
+    started = time.monotonic()
+    # The view prints every report; keep that out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        for number in range(reports):
+            for controller_id in controller_ids:
+                request = factory.post(
+                    '/api/devices/status/',
+                    {'controller_id': controller_id, 'device_status': status_report(number)},
+                    format='json'
+                )
+                # What request_started/request_finished do around a real request,
+                # so CONN_MAX_AGE decides whether the connection is reused
+                close_old_connections()
+                request_started = time.perf_counter()
+                response = view(request)
+                latencies.append(time.perf_counter() - request_started)
+                close_old_connections()
+                if response.status_code != 200:
+                    errors += 1
+                    if 'locked' in str(response.data.get('error', '')):
+                        locked += 1
+    results.put((latencies, errors, locked, started, time.monotonic()))
+
+
+def run_profile(profile, controllers, reports, workers, db_path, results):
+    """Process entry point: create and seed a throwaway database, then run the workers against it"""
+    try:
+        connection = use_profile(profile)
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = db_path
+        database_name = connection.settings_dict['NAME']
+        test_database_name = connection.creation.create_test_db(verbosity=0)
+    except Exception as e:
+        results.put(('error', str(e)))
+        return
+
+    try:
+        controller_ids = seed_controllers(controllers)
+        connection.close()
+
+        context = get_context('spawn')
+        start = context.Event()
+        worker_results = context.Queue()
+        processes = [
+            context.Process(
+                target=run_reports,
+                args=(profile, test_database_name, controller_ids[index::workers], reports, start, worker_results)
+            )
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        start.set()
+
+        outcomes = []
+        while len(outcomes) < len(processes):
+            try:
+                outcomes.append(worker_results.get(timeout=1))
+            except Empty:
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError('a worker process exited early')
+        for process in processes:
+            process.join()
+
+        latencies = sorted(latency for outcome in outcomes for latency in outcome[0])
+        elapsed = max(outcome[4] for outcome in outcomes) - min(outcome[3] for outcome in outcomes)
+        results.put((
+            'done',
+            (latencies, sum(outcome[1] for outcome in outcomes), sum(outcome[2] for outcome in outcomes), elapsed)
+        ))
+    except Exception as e:
+        results.put(('error', str(e)))
+    finally:
+        connection.creation.destroy_test_db(database_name, verbosity=0)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark status report write throughput under each database profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profiles',
+            nargs='+',
+            choices=['baseline', 'sqlite', 'postgres'],
+            default=['baseline', 'sqlite', 'postgres'],
+            help='baseline is the old default-configured SQLite; the others are DATABASE_PROFILES entries'
+        )
+        parser.add_argument('--controllers', type=int, default=20, help='Controllers reporting')
+        parser.add_argument('--reports', type=int, default=20, help='Status reports per controller')
+        parser.add_argument('--workers', type=int, default=4, help='Processes posting reports concurrently')
+
+    def handle(self, *args, **options):
+        if options['workers'] > options['controllers']:
+            raise CommandError('Need at least one controller per worker')
+
+        self.stdout.write(
+            f"{options['controllers']} controllers x {options['reports']} status reports "
+            f"from {options['workers']} worker processes"
+        )
+        context = get_context('spawn')
+        for profile in options['profiles']:
+            if profile == 'postgres':
+                try:
+                    import psycopg_pool  # noqa: F401
+                except ImportError:
+                    self.stdout.write(self.style.WARNING(f'{profile:>8}: skipped, psycopg[pool] is not installed'))
+                    continue
+
+            results = context.Queue()
+            db_path = os.path.join(tempfile.mkdtemp(prefix='dbbench-'), 'db.sqlite3')
+            runner = context.Process(
+                target=run_profile,
+                args=(profile, options['controllers'], options['reports'], options['workers'], db_path, results)
+            )
+            runner.start()
+            while True:
+                try:
+                    kind, outcome = results.get(timeout=1)
+                    break
+                except Empty:
+                    if not runner.is_alive():
+                        raise CommandError(f'{profile} run failed (exit code {runner.exitcode})')
+            runner.join()
+
+            if kind == 'error':
+                self.stdout.write(self.style.WARNING(f'{profile:>8}: skipped, {outcome}'))
+                continue
+
+            latencies, errors, locked, elapsed = outcome
+            self.stdout.write(self.style.SUCCESS(
+                f'{profile:>8}: {len(latencies) / elapsed:7.1f} reports/s, '
+                f'p50 {statistics.median(latencies) * 1000:7.1f} ms, '
+                f'p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms, '
+                f'{errors} errors ({locked} "database is locked")'
+            ))
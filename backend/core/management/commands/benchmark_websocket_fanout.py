@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from channels_redis.core import RedisChannelLayer
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.consumers import DeviceStatusConsumer
+from core.websocket_utils import encode_channel_message
+
+
+class Command(BaseCommand):
+    help = "Benchmark the CPU cost of fanning one WebSocket event out to a user's open sockets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, nargs='+', default=[1, 10, 1000], help='Open sockets per user to measure')
+        parser.add_argument('--events', type=int, default=2000, help='Events sent per timed run')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs (the best is reported)')
+
+    def handle(self, *args, **options):
+        # Only the Redis layer's (de)serializer is used; no connection is opened
+        layer = RedisChannelLayer()
+        modes = (
+            ('per-socket json', lambda message: message),
+            ('pre-encoded', encode_channel_message),
+        )
+
+        for sockets in options['sockets']:
+            # Each event reaches about as many sockets, so keep total work per run similar
+            events = max(options['events'] // sockets, 20)
+            consumers = [self.make_consumer() for _ in range(sockets)]
+            results = {}
+            for name, build in modes:
+                timings = []
+                for _ in range(options['repeat']):
+                    started = time.process_time()
+                    asyncio.run(self.fan_out(layer, consumers, build, events))
+                    timings.append((time.process_time() - started) / events)
+                results[name] = min(timings)
+
+            before, after = results['per-socket json'], results['pre-encoded']
+            self.stdout.write(
+                f'{sockets:>5} sockets: per-socket json {before * 1e6:8.1f} us/event, '
+                f'pre-encoded {after * 1e6:8.1f} us/event'
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f'{"":>14}{before / after:.2f}x less CPU, {after / sockets * 1e6:.2f} us per socket'
+            ))
+
+    def make_consumer(self):
+        consumer = DeviceStatusConsumer()
+
+        async def base_send(message):
+            pass
+
+        consumer.base_send = base_send
+        return consumer
+
+    async def fan_out(self, layer, consumers, build, events):
+        for seq in range(1, events + 1):
+            message = {
+                'type': 'device_status',
+                'timestamp': timezone.now().isoformat(),
+                'data': {
+                    'device_id': f'DEV{seq:06d}',
+                    'status': 'on' if seq % 2 else 'off',
+                    'current_value': seq / 100,
+                    'last_seen': timezone.now().isoformat()
+                },
+                'seq': seq,
+            }
+            # Packed once per worker process by the layer, then handed to every local socket
+            channel_message = layer.deserialize(layer.serialize(build(message)))
+            for consumer in consumers:
+                await consumer.device_status(channel_message)
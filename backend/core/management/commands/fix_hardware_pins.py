@@ -1,9 +1,17 @@
+import json
+from collections import defaultdict
+
 from django.core.management.base import BaseCommand
-from core.models import Device, Controller
 from django.db import transaction
+from django.db.models import Count, Q
+from core.models import Device
+
+MAX_PIN_LENGTH = Device._meta.get_field('hardware_pin').max_length
+MISSING_PIN = Q(hardware_pin__isnull=True) | Q(hardware_pin='')
+
 
 class Command(BaseCommand):
-    help = 'Fix hardware_pin values for existing devices'
+    help = 'Audit hardware_pin values and fill in missing ones from the device_id'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -11,113 +19,175 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be fixed without making changes'
         )
+        parser.add_argument('--json', type=str, metavar='PATH', help="Write a machine-readable report here ('-' for stdout)")
+        parser.add_argument('--list-devices', action='store_true', help='Also print every device grouped by controller')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched per query while reporting')
 
     def handle(self, *args, **options):
         dry_run = options['dry_run']
-        
+        self.chunk_size = options['chunk_size']
+        # With a JSON report on stdout the human-readable output goes to stderr
+        self.out = self.stderr if options['json'] == '-' else self.stdout
+
         if dry_run:
-            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
-        
-        # Find devices with missing or incorrect hardware_pin
-        devices_to_fix = Device.objects.filter(hardware_pin__isnull=True)
-        devices_with_pins = Device.objects.exclude(hardware_pin__isnull=True)
-        
-        self.stdout.write(f'Found {devices_to_fix.count()} devices with missing hardware_pin')
-        self.stdout.write(f'Found {devices_with_pins.count()} devices with hardware_pin set')
-        
-        fixed_count = 0
-        
-        with transaction.atomic():
-            for device in devices_to_fix:
-                if device.device_id:
-                    parts = device.device_id.split('-')
-                    if len(parts) > 2:
-                        hardware_pin = parts[-1]
-                        
-                        self.stdout.write(f'Fixing {device.device_id}: setting hardware_pin to "{hardware_pin}"')
-                        
-                        if not dry_run:
-                            device.hardware_pin = hardware_pin
-                            device.save()
-                        
-                        fixed_count += 1
-        
-        # Check for potential conflicts
-        self.stdout.write('\n--- Checking for potential conflicts ---')
-        controllers = Controller.objects.all()
-        
-        for controller in controllers:
-            controller_devices = Device.objects.filter(controller=controller).exclude(hardware_pin__isnull=True)
-            pins = [d.hardware_pin for d in controller_devices]
-            
-            # Check for duplicates
-            duplicates = set([pin for pin in pins if pins.count(pin) > 1])
-            if duplicates:
-                self.stdout.write(
-                    self.style.ERROR(
-                        f'Controller {controller.controller_id} has duplicate hardware pins: {duplicates}'
-                    )
+            self.out.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        fixes, unresolved = self.plan_missing_pins()
+        if fixes and not dry_run:
+            with transaction.atomic():
+                Device.objects.bulk_update(
+                    [Device(pk=fix['id'], hardware_pin=fix['hardware_pin']) for fix in fixes],
+                    ['hardware_pin'],
+                    batch_size=500
                 )
-                
-                for pin in duplicates:
-                    conflicting_devices = controller_devices.filter(hardware_pin=pin)
-                    for i, device in enumerate(conflicting_devices):
-                        self.stdout.write(f'  - {device.name} ({device.device_id})')
-                        if i > 0:  # Keep first one, suggest fix for others
-                            suggested_pin = f"{pin}_alt_{i}"
-                            self.stdout.write(
-                                self.style.WARNING(f'    Suggest changing to: {suggested_pin}')
-                            )
-        
-        # Summary
-        self.stdout.write('\n--- Summary ---')
+
+        self.out.write('\n--- Missing hardware pins ---')
+        for fix in fixes:
+            self.out.write(f"{'Would fix' if dry_run else 'Fixed'} {fix['device_id']}: hardware_pin = \"{fix['hardware_pin']}\"")
+        for problem in unresolved:
+            self.out.write(self.style.ERROR(f"Cannot fix {problem['device_id']}: {problem['reason']}"))
+
+        conflicts = self.find_conflicts()
+        self.out.write('\n--- Checking for potential conflicts ---')
+        for conflict in conflicts:
+            self.out.write(self.style.ERROR(
+                f"Controller {conflict['controller_id']} has duplicate hardware pin: {conflict['hardware_pin']}"
+            ))
+            for device in conflict['devices']:
+                self.out.write(f"  - {device['name']} ({device['device_id']})")
+                if device.get('suggested_pin'):
+                    self.out.write(self.style.WARNING(f"    Suggest changing to: {device['suggested_pin']}"))
+        if not conflicts:
+            self.out.write('No duplicate hardware pins')
+
+        orphans = list(
+            Device.objects.filter(is_paired=True, controller__isnull=True)
+            .order_by('device_id').values('device_id', 'name')
+            .iterator(chunk_size=self.chunk_size)
+        )
+        totals = Device.objects.aggregate(
+            devices=Count('id'),
+            unpaired=Count('id', filter=Q(is_paired=False)),
+            ready=Count('id', filter=Q(is_paired=True, controller__isnull=False) & ~MISSING_PIN),
+            paired_missing_pin=Count('id', filter=Q(is_paired=True, controller__isnull=False) & MISSING_PIN),
+        )
+
+        self.out.write('\n--- Summary ---')
+        self.out.write(f"{totals['devices']} devices, {totals['unpaired']} unpaired and ready for pairing")
+        self.out.write(f"Devices ready for ESP32 commands: {totals['ready']}")
         if dry_run:
-            self.stdout.write(f'Would fix {fixed_count} devices')
+            self.out.write(f'Would fix {len(fixes)} devices')
         else:
-            self.stdout.write(self.style.SUCCESS(f'Fixed {fixed_count} devices'))
-        
-        # Show current state
-        self.stdout.write('\n--- Current Device State ---')
-        all_devices = Device.objects.all().order_by('controller__controller_id', 'hardware_pin')
-        
-        current_controller = None
-        for device in all_devices:
-            if device.controller != current_controller:
-                current_controller = device.controller
-                controller_name = current_controller.controller_id if current_controller else "No Controller"
-                self.stdout.write(f'\n{controller_name}:')
-            
-            status = "✓ Paired" if device.is_paired else "○ Unpaired"
-            hardware_pin = device.hardware_pin or "❌ MISSING"
-            
-            self.stdout.write(f'  {device.name} | Pin: {hardware_pin} | {status}')
-        
-        # Recommendations
-        self.stdout.write('\n--- Recommendations ---')
-        if devices_to_fix.count() > 0:
-            if dry_run:
-                self.stdout.write('Run this command without --dry-run to fix missing hardware pins')
+            self.out.write(self.style.SUCCESS(f'Fixed {len(fixes)} devices'))
+        if totals['paired_missing_pin']:
+            self.out.write(self.style.ERROR(f"{totals['paired_missing_pin']} paired devices still have no hardware_pin"))
+        if orphans:
+            self.out.write(self.style.ERROR(
+                f'{len(orphans)} paired devices have no controller - this will cause command failures'
+            ))
+            for device in orphans:
+                self.out.write(f"  - {device['name']} ({device['device_id']})")
+        if fixes and dry_run:
+            self.out.write('Run this command without --dry-run to fix missing hardware pins')
+
+        if options['list_devices']:
+            self.list_devices()
+
+        if options['json']:
+            report = {
+                'dry_run': dry_run,
+                'fixes': fixes,
+                'unresolved': unresolved,
+                'conflicts': conflicts,
+                'paired_without_controller': orphans,
+                'totals': totals,
+            }
+            if options['json'] == '-':
+                self.stdout.write(json.dumps(report, indent=2))
             else:
-                self.stdout.write('Missing hardware pins have been fixed')
-        
-        unpaired_devices = Device.objects.filter(is_paired=False)
-        if unpaired_devices.count() > 0:
-            self.stdout.write(f'{unpaired_devices.count()} devices are unpaired and ready for pairing')
-        
-        paired_no_controller = Device.objects.filter(is_paired=True, controller__isnull=True)
-        if paired_no_controller.count() > 0:
-            self.stdout.write(
-                self.style.ERROR(f'{paired_no_controller.count()} paired devices have no controller - this will cause command failures')
-            )
-            for device in paired_no_controller:
-                self.stdout.write(f'  - {device.name} ({device.device_id})')
-        
-        self.stdout.write('\n--- ESP32 Communication Check ---')
-        paired_devices = Device.objects.filter(is_paired=True, controller__isnull=False)
-        self.stdout.write(f'Devices ready for ESP32 commands: {paired_devices.count()}')
-        
-        for device in paired_devices:
-            if device.hardware_pin:
-                self.stdout.write(f'  ✓ {device.name} -> ESP32 uses "{device.hardware_pin}"')
+                with open(options['json'], 'w') as output:
+                    json.dump(report, output, indent=2)
+
+    def plan_missing_pins(self):
+        """Derive a pin for every device without one, refusing any that would collide"""
+        missing = list(
+            Device.objects.filter(MISSING_PIN)
+            .values('id', 'device_id', 'controller_id')
+            .iterator(chunk_size=self.chunk_size)
+        )
+        if not missing:
+            return [], []
+
+        # Pins already taken on just the controllers involved
+        taken = defaultdict(set)
+        controller_ids = {device['controller_id'] for device in missing if device['controller_id']}
+        for controller_id, pin in (
+            Device.objects.filter(controller_id__in=controller_ids).exclude(MISSING_PIN)
+            .values_list('controller_id', 'hardware_pin').iterator(chunk_size=self.chunk_size)
+        ):
+            taken[controller_id].add(pin)
+
+        fixes, unresolved = [], []
+        for device in missing:
+            parts = (device['device_id'] or '').split('-')
+            if len(parts) <= 2:
+                unresolved.append({'device_id': device['device_id'], 'reason': 'device_id has no pin suffix'})
+                continue
+            pin = parts[-1]
+            if len(pin) > MAX_PIN_LENGTH:
+                unresolved.append({'device_id': device['device_id'], 'reason': f'pin "{pin}" is longer than {MAX_PIN_LENGTH}'})
+            elif device['controller_id'] is not None and pin in taken[device['controller_id']]:
+                unresolved.append({'device_id': device['device_id'], 'reason': f'pin "{pin}" is already used on its controller'})
             else:
-                self.stdout.write(f'  ❌ {device.name} -> Missing hardware_pin!')
\ No newline at end of file
+                # Pins are only unique per controller; unassigned devices cannot collide
+                if device['controller_id'] is not None:
+                    taken[device['controller_id']].add(pin)
+                fixes.append({'id': device['id'], 'device_id': device['device_id'], 'hardware_pin': pin})
+        return fixes, unresolved
+
+    def find_conflicts(self):
+        """Controllers with a hardware pin used by more than one device, via GROUP BY ... HAVING"""
+        duplicated = (
+            Device.objects.filter(controller__isnull=False).exclude(MISSING_PIN)
+            .values('controller_id', 'hardware_pin')
+            .annotate(devices=Count('id'))
+            .filter(devices__gt=1)
+        )
+        pairs = {(row['controller_id'], row['hardware_pin']) for row in duplicated}
+        if not pairs:
+            return []
+
+        grouped = defaultdict(list)
+        candidates = Device.objects.filter(
+            controller_id__in={controller_id for controller_id, _ in pairs},
+            hardware_pin__in={pin for _, pin in pairs}
+        ).order_by('controller__controller_id', 'hardware_pin', 'id')
+        for row in candidates.values('controller_id', 'controller__controller_id', 'hardware_pin', 'device_id', 'name'):
+            if (row['controller_id'], row['hardware_pin']) in pairs:
+                grouped[(row['controller__controller_id'], row['hardware_pin'])].append(row)
+
+        conflicts = []
+        for (controller_id, pin), rows in grouped.items():
+            devices = []
+            for i, row in enumerate(rows):
+                device = {'device_id': row['device_id'], 'name': row['name']}
+                if i > 0:  # Keep first one, suggest fix for others
+                    device['suggested_pin'] = f'{pin}_alt_{i}'
+                devices.append(device)
+            conflicts.append({'controller_id': controller_id, 'hardware_pin': pin, 'devices': devices})
+        return conflicts
+
+    def list_devices(self):
+        self.out.write('\n--- Current Device State ---')
+        current_controller = object()
+        rows = (
+            Device.objects.order_by('controller__controller_id', 'hardware_pin')
+            .values_list('controller__controller_id', 'name', 'hardware_pin', 'is_paired')
+            .iterator(chunk_size=self.chunk_size)
+        )
+        for controller_id, name, hardware_pin, is_paired in rows:
+            if controller_id != current_controller:
+                current_controller = controller_id
+                self.out.write(f'\n{controller_id or "No Controller"}:')
+            status = "✓ Paired" if is_paired else "○ Unpaired"
+            self.out.write(f'  {name} | Pin: {hardware_pin or "❌ MISSING"} | {status}')
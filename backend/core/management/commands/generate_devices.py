@@ -1,7 +1,6 @@
 import random
 from django.core.management.base import BaseCommand
 from core.models import Device, Controller
-from django.utils.crypto import get_random_string
 
 class Command(BaseCommand):
     help = 'Generate devices for a specific controller with predefined types'
@@ -52,7 +51,6 @@ class Command(BaseCommand):
                 type=device_info['type'],
                 controller=controller,
                 hardware_pin=device_info['name'],
-                pairing_code=get_random_string(6, '0123456789'),
                 is_paired=False
             )
             
@@ -0,0 +1,56 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Device
+from core.qr_labels import generate_label_sheets
+
+
+class Command(BaseCommand):
+    help = 'Render printable pairing QR label sheets and a ZIP of individual codes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--controller', action='append', help='Only devices of this controller_id (repeatable)')
+        parser.add_argument('--unpaired', action='store_true', help='Only devices that are not paired yet')
+        parser.add_argument('--output', type=str, default='qr_codes', help='Output directory')
+        parser.add_argument('--format', choices=['pdf', 'png'], default='pdf', help='One multi-page PDF or a PNG per page')
+        parser.add_argument('--columns', type=int, default=4, help='Labels per row on a sheet')
+        parser.add_argument('--rows', type=int, default=6, help='Label rows per sheet')
+        parser.add_argument('--workers', type=int, help='Render processes (default: one per CPU)')
+
+    def handle(self, *args, **options):
+        devices = Device.objects.exclude(pairing_code__isnull=True).exclude(pairing_code='')
+        if options['controller']:
+            devices = devices.filter(controller__controller_id__in=options['controller'])
+        if options['unpaired']:
+            devices = devices.filter(is_paired=False)
+
+        total = devices.count()
+        if not total:
+            raise CommandError('No devices with pairing codes match')
+
+        output = Path(options['output'])
+        output.mkdir(parents=True, exist_ok=True)
+        sheet_path = output / ('labels.pdf' if options['format'] == 'pdf' else 'labels.png')
+        zip_path = output / 'qr_codes.zip'
+
+        self.stdout.write(f'Rendering {total} labels...')
+        started = time.perf_counter()
+        result = generate_label_sheets(
+            devices.order_by('controller__controller_id', 'device_id')
+                   .values_list('device_id', 'pairing_code', 'name')
+                   .iterator(chunk_size=2000),
+            sheet_path,
+            zip_path,
+            columns=options['columns'],
+            rows=options['rows'],
+            page_format=options['format'],
+            workers=options['workers'],
+            progress=lambda done: self.stdout.write(f'  {done}/{total}'),
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {result['labels']} labels on {result['pages']} pages in "
+            f"{time.perf_counter() - started:.1f}s -> {output}"
+        ))
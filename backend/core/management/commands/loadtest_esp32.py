@@ -0,0 +1,187 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from multiprocessing import get_context
+from queue import Empty
+
+from django.core.management.base import BaseCommand, CommandError
+
+HARDWARE_PINS = ['kitchen', 'living', 'light1', 'light2', 'fan']
+
+
+async def asgi_request(app, method, path, query='', body=None):
+    """Run one HTTP request through the ASGI app; returns the status code"""
+    payload = json.dumps(body).encode() if body is not None else b''
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [
+            (b'host', b'localhost'),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode()),
+        ],
+        'client': ('127.0.0.1', 40000),
+        'server': ('localhost', 80),
+    }
+    pending = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+    disconnected = asyncio.get_running_loop().create_future()
+    response = {}
+
+    async def receive():
+        if pending:
+            return pending.pop()
+        # The client stays connected until the app is done with it
+        return await disconnected
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+
+    await app(scope, receive, send)
+    return response.get('status')
+
+
+async def simulate_controllers(app, controller_ids, rounds):
+    """Every controller polls for commands and reports status ``rounds`` times, all at once"""
+    latencies, errors = [], 0
+    peak_threads = threading.active_count()
+
+    async def controller(controller_id):
+        nonlocal errors
+        for number in range(rounds):
+            for method, path, query, body in (
+                ('GET', '/api/devices/commands/', f'controller_id={controller_id}', None),
+                ('POST', '/api/devices/status/', '', {'controller_id': controller_id, 'device_status': status_report(number)}),
+            ):
+                started = time.perf_counter()
+                if await asgi_request(app, method, path, query, body) != 200:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+    async def watch_threads():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.01)
+
+    watcher = asyncio.ensure_future(watch_threads())
+    started = time.perf_counter()
+    await asyncio.gather(*(controller(controller_id) for controller_id in controller_ids))
+    elapsed = time.perf_counter() - started
+    watcher.cancel()
+    return latencies, errors, elapsed, peak_threads
+
+
+def seed_controllers(count):
+    """Create ``count`` paired controllers with one device per hardware pin; returns their ids"""
+    from core.models import Controller, Device, Room, UserProfile
+
+    controller_ids = []
+    for number in range(count):
+        owner = UserProfile.objects.create(full_name=f'Load {number}', email=f'load{number}@example.com')
+        room = Room.objects.create(name='Load room', owner=owner)
+        controller = Controller.objects.create(controller_id=f'LOAD-{number:04d}', owner=owner, room=room)
+        for pin in HARDWARE_PINS:
+            # save() assigns the pairing code, so no bulk_create here
+            Device.objects.create(
+                device_id=f'LOAD-{number:04d}-{pin}', name=pin, type='light' if pin.startswith('light') else 'socket',
+                controller=controller, owner=owner, room=room, hardware_pin=pin, is_paired=True
+            )
+        controller_ids.append(controller.controller_id)
+    return controller_ids
+
+
+def status_report(number):
+    """The status payload a controller sends on its ``number``th report"""
+    report = {pin: (number + index) % 2 == 0 for index, pin in enumerate(HARDWARE_PINS)}
+    report.update(kitchen_current=1.0 + number % 3, living_current=0.5)
+    return report
+
+
+def run_load(async_views, controllers, rounds, db_path, results):
+    """Process entry point: seed a throwaway database and load test one view mode"""
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.core.asgi import get_asgi_application
+    from django.db import connection
+
+    settings.ASYNC_ESP32_VIEWS = async_views
+    settings.DEBUG = False
+    settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+    connection.settings_dict['TEST']['NAME'] = db_path
+    connection.settings_dict['OPTIONS']['timeout'] = 30
+    database_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+
+    controller_ids = seed_controllers(controllers)
+    connection.close()
+
+    try:
+        # The views print every report; keep that out of the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            outcome = asyncio.run(simulate_controllers(get_asgi_application(), controller_ids, rounds))
+        results.put(outcome)
+    finally:
+        connection.creation.destroy_test_db(database_name, verbosity=0)
+
+
+class Command(BaseCommand):
+    help = 'Load test the ESP32 polling endpoints through the ASGI app with sync and async views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--controllers', type=int, default=50, help='Controllers polling concurrently')
+        parser.add_argument('--rounds', type=int, default=10, help='Poll + status report cycles per controller')
+        parser.add_argument(
+            '--mode',
+            nargs='+',
+            choices=['sync', 'async'],
+            default=['sync', 'async'],
+            help='View implementations to measure'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{options['controllers']} controllers x {options['rounds']} rounds "
+            f"(commands poll + status report), ASGI_THREADS={os.environ.get('ASGI_THREADS', 'default')}"
+        )
+        context = get_context('spawn')
+        for mode in options['mode']:
+            # A fresh process per mode: the URLconf reads ASYNC_ESP32_VIEWS once
+            results = context.Queue()
+            db_path = os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'db.sqlite3')
+            worker = context.Process(
+                target=run_load,
+                args=(mode == 'async', options['controllers'], options['rounds'], db_path, results)
+            )
+            worker.start()
+            while True:
+                try:
+                    latencies, errors, elapsed, peak_threads = results.get(timeout=1)
+                    break
+                except Empty:
+                    if not worker.is_alive():
+                        raise CommandError(f'{mode} run failed (exit code {worker.exitcode})')
+            worker.join()
+
+            latencies.sort()
+            self.stdout.write(self.style.SUCCESS(
+                f'{mode:>5}: {len(latencies) / elapsed:7.1f} req/s, '
+                f'p50 {statistics.median(latencies) * 1000:7.1f} ms, '
+                f'p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms, '
+                f'{errors} errors, peak {peak_threads} threads'
+            ))
@@ -0,0 +1,185 @@
+import csv
+import json
+import sys
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.models import Controller, Device, DEVICE_TYPES
+from core.pairing import allocate_pairing_codes
+
+# Pins wired on the standard board, used when a manifest entry lists none
+DEFAULT_PIN_LAYOUT = [
+    {'pin': 'kitchen', 'type': 'socket', 'name': 'Kitchen Socket'},
+    {'pin': 'living', 'type': 'socket', 'name': 'Living Room Socket'},
+    {'pin': 'light1', 'type': 'light', 'name': 'Light 1'},
+    {'pin': 'light2', 'type': 'light', 'name': 'Light 2'},
+    {'pin': 'fan', 'type': 'fan', 'name': 'Ceiling Fan'},
+]
+
+VALID_TYPES = {device_type for device_type, _ in DEVICE_TYPES}
+CODE_MANIFEST_FIELDS = ['controller_id', 'device_id', 'hardware_pin', 'type', 'name', 'pairing_code']
+
+
+class Command(BaseCommand):
+    help = 'Provision controllers and their devices in bulk from a CSV or JSON manifest'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'manifest',
+            type=str,
+            help='CSV (controller_id[,controller_name,hardware_pin,type,device_name] per row) '
+                 'or JSON ([{"controller_id", "name", "pins": [{"pin", "type", "name"}]}])'
+        )
+        parser.add_argument('--output', type=str, help='Write the pairing code manifest (CSV) here instead of stdout')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Controllers per transaction')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        controllers = self.read_manifest(Path(options['manifest']))
+        chunk_size = options['chunk_size']
+
+        output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        writer = csv.DictWriter(output, fieldnames=CODE_MANIFEST_FIELDS)
+        writer.writeheader()
+
+        created_controllers = created_devices = skipped_devices = pin_conflicts = 0
+        try:
+            for offset in range(0, len(controllers), chunk_size):
+                chunk = controllers[offset:offset + chunk_size]
+                new_controllers, new_devices, skipped, conflicts = self.provision_chunk(chunk)
+                created_controllers += new_controllers
+                created_devices += len(new_devices)
+                skipped_devices += skipped
+                pin_conflicts += len(conflicts)
+                for device_id, holder in conflicts:
+                    self.stderr.write(self.style.WARNING(
+                        f'Skipped {device_id}: its controller pin is already held by device {holder}'
+                    ))
+                writer.writerows(
+                    {
+                        'controller_id': controller_id,
+                        'device_id': device.device_id,
+                        'hardware_pin': device.hardware_pin,
+                        'type': device.type,
+                        'name': device.name,
+                        'pairing_code': device.pairing_code,
+                    }
+                    for controller_id, device in new_devices
+                )
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        self.stderr.write(self.style.SUCCESS(
+            f'Provisioned {created_controllers} new controllers and {created_devices} devices '
+            f'({skipped_devices} existing devices skipped, {pin_conflicts} pin conflicts) '
+            f'in {time.perf_counter() - started:.1f}s'
+        ))
+
+    def provision_chunk(self, chunk):
+        """Create the chunk's missing controllers and devices in one transaction.
+
+        Returns (new controllers, [(controller_id, device)], devices skipped as
+        existing, [(device_id, holder device_id)] skipped for pin conflicts).
+        """
+        controller_ids = [entry['controller_id'] for entry in chunk]
+        with transaction.atomic():
+            existing = set(Controller.objects.filter(controller_id__in=controller_ids).values_list('controller_id', flat=True))
+            Controller.objects.bulk_create([
+                Controller(controller_id=entry['controller_id'], name=entry['name'], is_online=False)
+                for entry in chunk if entry['controller_id'] not in existing
+            ])
+            controller_pks = dict(
+                Controller.objects.filter(controller_id__in=controller_ids).values_list('controller_id', 'pk')
+            )
+
+            wanted = [
+                (entry['controller_id'], pin)
+                for entry in chunk
+                for pin in entry['pins']
+            ]
+            existing_devices = set(Device.objects.filter(
+                device_id__in=[f"{controller_id}-{pin['pin']}" for controller_id, pin in wanted]
+            ).values_list('device_id', flat=True))
+            # A device under another device_id may already hold the (controller, pin) pair
+            pin_holders = {
+                (controller_pk, hardware_pin): device_id
+                for controller_pk, hardware_pin, device_id in Device.objects.filter(
+                    controller_id__in=controller_pks.values()
+                ).values_list('controller_id', 'hardware_pin', 'device_id')
+            }
+            missing, conflicts = [], []
+            for controller_id, pin in wanted:
+                device_id = f"{controller_id}-{pin['pin']}"
+                if device_id in existing_devices:
+                    continue
+                holder = pin_holders.get((controller_pks[controller_id], pin['pin']))
+                if holder is not None:
+                    conflicts.append((device_id, holder))
+                else:
+                    missing.append((controller_id, pin))
+
+            codes = allocate_pairing_codes(len(missing)) if missing else []
+            devices = Device.objects.bulk_create([
+                Device(
+                    device_id=f"{controller_id}-{pin['pin']}",
+                    name=pin['name'],
+                    type=pin['type'],
+                    controller_id=controller_pks[controller_id],
+                    hardware_pin=pin['pin'],
+                    pairing_code=code,
+                    is_paired=False
+                )
+                for (controller_id, pin), code in zip(missing, codes)
+            ], batch_size=1000)
+
+        created = [(controller_id, device) for (controller_id, _), device in zip(missing, devices)]
+        return len(chunk) - len(existing), created, len(wanted) - len(missing) - len(conflicts), conflicts
+
+    def read_manifest(self, path):
+        if not path.exists():
+            raise CommandError(f'Manifest not found: {path}')
+
+        if path.suffix.lower() == '.json':
+            with open(path) as manifest:
+                data = json.load(manifest)
+            entries = data.get('controllers', []) if isinstance(data, dict) else data
+        else:
+            entries = {}
+            with open(path, newline='') as manifest:
+                for row in csv.DictReader(manifest):
+                    entry = entries.setdefault(row['controller_id'], {
+                        'controller_id': row['controller_id'],
+                        'name': row.get('controller_name') or '',
+                        'pins': [],
+                    })
+                    if row.get('hardware_pin'):
+                        entry['pins'].append({'pin': row['hardware_pin'], 'type': row.get('type'), 'name': row.get('device_name')})
+            entries = list(entries.values())
+
+        controllers = {}
+        for entry in entries:
+            controller_id = (entry.get('controller_id') or '').strip()
+            if not controller_id:
+                raise CommandError(f'Manifest entry without controller_id: {entry}')
+            pins = []
+            for pin in entry.get('pins') or DEFAULT_PIN_LAYOUT:
+                pin_name = pin.get('pin', '').strip()
+                pin_type = pin.get('type') or 'socket'
+                if not pin_name or len(pin_name) > 10:
+                    raise CommandError(f'Invalid hardware pin {pin_name!r} for controller {controller_id}')
+                if pin_type not in VALID_TYPES:
+                    raise CommandError(f'Invalid device type {pin_type!r} for {controller_id}-{pin_name}')
+                pins.append({'pin': pin_name, 'type': pin_type, 'name': pin.get('name') or f'{pin_name.title()} Device'})
+
+            if len({pin['pin'] for pin in pins}) != len(pins):
+                raise CommandError(f'Duplicate hardware pins for controller {controller_id}')
+            controllers[controller_id] = {
+                'controller_id': controller_id,
+                'name': entry.get('name') or f'Controller {controller_id[-4:]}',
+                'pins': pins,
+            }
+        return list(controllers.values())
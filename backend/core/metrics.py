@@ -0,0 +1,101 @@
+# core/metrics.py
+import math
+import threading
+from collections import Counter
+
+
+class Histogram:
+    """Streaming histogram of positive values over log-spaced buckets.
+
+    Bucket bounds grow by ``growth`` from ``floor`` up, so a percentile is
+    within about half a bucket (5% at the default growth) of the true value.
+    Only occupied buckets are stored, and observing is O(1).
+    """
+
+    def __init__(self, floor=0.001, growth=1.1):
+        self.floor = floor
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self._buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        if value > self.floor:
+            index = int(math.log(value / self.floor) / self._log_growth)
+        self._buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                # Geometric middle of the bucket, never above the largest value seen
+                return min(self.max, self.floor * self.growth ** (index + 0.5))
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else None,
+        }
+
+
+class Metrics:
+    """Process-local operational counters and histograms, read by the metrics endpoint.
+
+    Incrementing is a dict update under a lock, cheap enough for hot paths.
+    Each worker process keeps its own numbers.
+    """
+
+    def __init__(self):
+        self._counters = Counter()
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def get(self, name):
+        return self._counters.get(name, 0)
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def summary(self, name):
+        """count/mean/p50/p95/p99/max of a histogram, or None if nothing was observed"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            return histogram.summary() if histogram else None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(sorted(self._counters.items())),
+                'histograms': {name: self._histograms[name].summary() for name in sorted(self._histograms)},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_device_previous_fault_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='current_sampled_at',
+            field=models.DateTimeField(blank=True, help_text='When current_value was last reported (energy integration baseline)', null=True),
+        ),
+        migrations.AlterField(
+            model_name='devicealert',
+            name='alert_type',
+            field=models.CharField(choices=[('overload', 'Overload'), ('short_circuit', 'Short Circuit'), ('offline', 'Device Offline'), ('high_current', 'High Current'), ('device_locked', 'Locked Device')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='EnergyBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('start', models.DateTimeField()),
+                ('kwh', models.FloatField(default=0)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='energy_buckets', to='core.device')),
+            ],
+            options={
+                'ordering': ['-start'],
+                'indexes': [models.Index(fields=['period', 'start'], name='core_energy_period_79fb37_idx')],
+                'unique_together': {('device', 'period', 'start')},
+            },
+        ),
+    ]
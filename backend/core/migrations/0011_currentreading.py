@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_device_current_sampled_at_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrentReading',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recorded_at', models.DateTimeField()),
+                ('current', models.FloatField(help_text='Current in Amps')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='current_readings', to='core.device')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['device', 'recorded_at'], name='core_curren_device__6d26ec_idx'), models.Index(fields=['recorded_at'], name='core_curren_recorde_dca21f_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_currentreading'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activitylog',
+            name='action_type',
+            field=models.CharField(choices=[('device_control', 'Device Control'), ('device_pairing', 'Device Pairing'), ('device_unpaired', 'Device Unpaired'), ('system_alert', 'System Alert'), ('user_action', 'User Action'), ('controller_status', 'Controller Status'), ('overload_detected', 'Overload Detected'), ('short_circuit', 'Short Circuit'), ('lockout_activated', 'Lockout Activated'), ('lockout_cleared', 'Lockout Cleared'), ('high_current', 'High Current')], default='user_action', max_length=20),
+        ),
+    ]
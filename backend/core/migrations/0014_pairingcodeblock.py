@@ -0,0 +1,45 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:43
+
+from django.db import migrations, models
+
+
+def seed_pairing_code_blocks(apps, schema_editor):
+    """Create the 1000 bitmap blocks and mark codes already held by devices"""
+    PairingCodeBlock = apps.get_model('core', 'PairingCodeBlock')
+    Device = apps.get_model('core', 'Device')
+    db_alias = schema_editor.connection.alias
+
+    used = {}
+    for code in Device.objects.using(db_alias).values_list('pairing_code', flat=True):
+        if code and len(code) == 6 and code.isdigit():
+            block, bit = divmod(int(code), 1000)
+            used[block] = used.get(block, 0) | (1 << bit)
+
+    PairingCodeBlock.objects.using(db_alias).bulk_create([
+        PairingCodeBlock(
+            block=block,
+            bitmap=used.get(block, 0).to_bytes(125, 'little'),
+            free_count=1000 - used.get(block, 0).bit_count()
+        )
+        for block in range(1000)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_maintenancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PairingCodeBlock',
+            fields=[
+                ('block', models.PositiveIntegerField(primary_key=True, serialize=False)),
+                ('bitmap', models.BinaryField(default=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')),
+                ('free_count', models.PositiveIntegerField(default=1000)),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(seed_pairing_code_blocks, migrations.RunPython.noop),
+    ]
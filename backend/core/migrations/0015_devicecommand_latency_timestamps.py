@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_pairingcodeblock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicecommand',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='devicecommand',
+            name='acked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='devicecommand',
+            name='delivered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
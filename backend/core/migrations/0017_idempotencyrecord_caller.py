@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-19 05:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_idempotencyrecord'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='idempotencyrecord',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='idempotencyrecord',
+            name='caller',
+            field=models.CharField(default='', max_length=320),
+        ),
+        migrations.AlterUniqueTogether(
+            name='idempotencyrecord',
+            unique_together={('scope', 'caller', 'key')},
+        ),
+    ]
@@ -1,9 +1,9 @@
 from ipaddress import ip_address
 from pyexpat import model
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
-from django.utils.crypto import get_random_string
-import qrcode
 from django.core.files import File
 from io import BytesIO
 
@@ -74,6 +74,7 @@ class Device(models.Model):
     last_seen = models.DateTimeField(null=True, blank=True)
     status = models.CharField(max_length=3, choices=STATUS_CHOICES, default='off')
     current_value = models.FloatField(null=True, blank=True, help_text="Current in Amps (only for sockets)")
+    current_sampled_at = models.DateTimeField(null=True, blank=True, help_text="When current_value was last reported (energy integration baseline)")
     previous_fault_state = models.JSONField(default=dict, blank=True, null=True)
 
     def __str__(self):
@@ -86,40 +87,36 @@ class Device(models.Model):
             if len(parts) >= 2:
                 self.hardware_pin = parts[-1]
         
-        # Generate pairing code if not exists
-        if not self.pairing_code:
-            self.generate_pairing_code()
-        
-        # Call super().save() only once
-        super().save(*args, **kwargs)
+        if self.pairing_code and not getattr(self, '_replace_pairing_code', False):
+            super().save(*args, **kwargs)
+            return
+
+        # The code is allocated (and any previous one released) in the same
+        # transaction as the row, so a failed save hands it back
+        from .pairing import allocate_pairing_code, release_pairing_code
+
+        old_code = self.pairing_code
+        try:
+            with transaction.atomic():
+                self.pairing_code = allocate_pairing_code()
+                super().save(*args, **kwargs)
+                if old_code:
+                    release_pairing_code(old_code)
+        except Exception:
+            self.pairing_code = old_code
+            raise
+        self._replace_pairing_code = False
     
     def generate_pairing_code(self):
-        """Generate a new unique pairing code"""
-        while True:
-            code = get_random_string(6, '0123456789')
-            if not Device.objects.filter(pairing_code=code).exists():
-                self.pairing_code = code
-                break
-        return self.pairing_code
+        """Give the device a new unique pairing code on its next save(), releasing the previous one"""
+        self._replace_pairing_code = True
     
     def generate_qr_code(self):
-        # Create QR data string
-        qr_data = f"device_id:{self.device_id}|pairing_code:{self.pairing_code}"
-        
-        # Generate QR code
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        return buffer
+        """PNG of the pairing QR code, served from the shared render cache"""
+        from .qr import qr_cache
+
+        _, png = qr_cache.get(self.device_id, self.pairing_code)
+        return BytesIO(png)
     
     def pair_device(self, user, room=None):
         """Pair device to user and room"""
@@ -147,12 +144,31 @@ class Device(models.Model):
         # Add unique constraint for controller + hardware_pin
         unique_together = ['controller', 'hardware_pin']
 
+class PairingCodeBlock(models.Model):
+    """Used/free bitmap for 1000 consecutive 6-digit pairing codes.
+
+    Block N covers codes N*1000 .. N*1000+999; bit i of ``bitmap`` is set when
+    code N*1000+i is assigned to a device. ``version`` is bumped on every
+    change so concurrent allocators can detect conflicting updates.
+    """
+    block = models.PositiveIntegerField(primary_key=True)
+    bitmap = models.BinaryField(default=bytes(125))
+    free_count = models.PositiveIntegerField(default=1000)
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Codes {self.block * 1000:06d}-{self.block * 1000 + 999:06d} ({self.free_count} free)"
+
+
 # Device commands queue
 class DeviceCommand(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='commands', null=True, blank=True)
     controller = models.ForeignKey(Controller, on_delete=models.CASCADE, related_name='commands')
     action = models.CharField(max_length=50)
     created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)  # First handed to the controller
+    acked_at = models.DateTimeField(null=True, blank=True)  # Controller reported the result
+    delivered_at = models.DateTimeField(null=True, blank=True)  # Result sent to the app over WebSocket
     executed_at = models.DateTimeField(null=True, blank=True)
     is_executed = models.BooleanField(default=False)
 
@@ -215,6 +231,42 @@ class DeviceAlert(models.Model):
         ordering = ['-created_at']
 
 
+class EnergyBucket(models.Model):
+    """Energy consumed by a device over one hour or one day"""
+    PERIODS = (
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    )
+
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='energy_buckets')
+    period = models.CharField(max_length=4, choices=PERIODS)
+    start = models.DateTimeField()
+    kwh = models.FloatField(default=0)
+
+    def __str__(self):
+        return f"{self.device.name} {self.period} {self.start:%Y-%m-%d %H:%M}: {self.kwh:.3f} kWh"
+
+    class Meta:
+        ordering = ['-start']
+        unique_together = ['device', 'period', 'start']
+        indexes = [
+            models.Index(fields=['period', 'start']),
+        ]
+
+
+class CurrentReading(models.Model):
+    """Raw socket current sample as reported by the controller"""
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='current_readings')
+    recorded_at = models.DateTimeField()
+    current = models.FloatField(help_text="Current in Amps")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['device', 'recorded_at']),
+            models.Index(fields=['recorded_at']),
+        ]
+
+
 class ActivityLog(models.Model):
     LOG_TYPES = (
         ('error', 'Error'),
@@ -233,6 +285,7 @@ class ActivityLog(models.Model):
         ('short_circuit', 'Short Circuit'),
         ('lockout_activated', 'Lockout Activated'),
         ('lockout_cleared', 'Lockout Cleared'),
+        ('high_current', 'High Current'),
     )
 
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='activity_logs', null=True, blank=True)
@@ -315,6 +368,7 @@ class ActivityLog(models.Model):
             'lockout_activated': 'warning',
             'lockout_cleared': 'info',
             'device_offline': 'warning',
+            'high_current': 'warning',
         }
         
         log_type = log_type_mapping.get(alert_type, 'warning')
@@ -346,4 +400,44 @@ class ActivityLog(models.Model):
         )
 
 
+class MaintenanceCheckpoint(models.Model):
+    """Progress of a resumable maintenance job (retention, backfills, ...)"""
+    name = models.CharField(max_length=100, unique=True)
+    state = models.JSONField(default=dict, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class IdempotencyRecord(models.Model):
+    """Response to a request made with an Idempotency-Key, replayed to its retries"""
+    scope = models.CharField(max_length=50)  # Endpoint the key was used on
+    caller = models.CharField(max_length=320, default='')  # Who used it, see core/idempotency.py
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)  # SHA-256 of the request body
+    status_code = models.PositiveSmallIntegerField()
+    response = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ['scope', 'caller', 'key']
+
+    def __str__(self):
+        return f"{self.scope}:{self.caller}:{self.key} ({self.status_code})"
+
+
+@receiver(post_delete, sender=Device)
+def release_deleted_device_pairing_code(sender, instance, **kwargs):
+    from .pairing import release_pairing_code
+
+    if instance.pairing_code:
+        release_pairing_code(instance.pairing_code)
+
+
+@receiver(post_save, sender=DeviceCommand)
+def queue_new_device_command(sender, instance, created, **kwargs):
+    from .command_queue import command_queues
 
+    if created:
+        command_queues.enqueue_on_commit(instance)
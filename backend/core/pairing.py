@@ -0,0 +1,132 @@
+# core/pairing.py
+import logging
+import secrets
+
+from django.db import transaction
+
+from .models import PairingCodeBlock
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1000
+BLOCK_COUNT = 1000  # 10^6 six-digit codes
+FULL_MASK = (1 << BLOCK_SIZE) - 1
+MAX_CONFLICT_RETRIES = 20
+
+_random = secrets.SystemRandom()
+
+
+class PairingCodesExhausted(Exception):
+    pass
+
+
+def _split(code):
+    """Return (block, bit) for a six-digit code, or None for legacy/free-form codes"""
+    if not code or len(code) != 6 or not code.isdigit():
+        return None
+    value = int(code)
+    return divmod(value, BLOCK_SIZE)
+
+
+def _format(block, bit):
+    return f'{block * BLOCK_SIZE + bit:06d}'
+
+
+def _used_mask(block):
+    return int.from_bytes(bytes(block.bitmap), 'little')
+
+
+def _save_block(block, used):
+    """Write the new bitmap only if nobody changed the block since it was read"""
+    return PairingCodeBlock.objects.filter(block=block.block, version=block.version).update(
+        bitmap=used.to_bytes(BLOCK_SIZE // 8, 'little'),
+        free_count=BLOCK_SIZE - used.bit_count(),
+        version=block.version + 1
+    )
+
+
+def _blocks_with_free_codes(start):
+    """Blocks that still have free codes, starting at ``start`` and wrapping around"""
+    candidates = PairingCodeBlock.objects.filter(free_count__gt=0).order_by('block')
+    yield from candidates.filter(block__gte=start).iterator(chunk_size=50)
+    yield from candidates.filter(block__lt=start).iterator(chunk_size=50)
+
+
+def allocate_pairing_code():
+    """Hand out one unused six-digit pairing code.
+
+    A random block is chosen, then the first free bit at or after a random
+    position in it, so each allocation reads and writes a single 125-byte row.
+    Call it inside the transaction that stores the code (Device.save does),
+    so a rollback frees the code again.
+    """
+    for _ in range(MAX_CONFLICT_RETRIES):
+        start = secrets.randbelow(BLOCK_COUNT)
+        candidates = PairingCodeBlock.objects.filter(free_count__gt=0).order_by('block')
+        block = candidates.filter(block__gte=start).first() or candidates.first()
+        if block is None:
+            raise PairingCodesExhausted('All 10^6 pairing codes are in use')
+
+        used = _used_mask(block)
+        free = ~used & FULL_MASK
+        offset = secrets.randbelow(BLOCK_SIZE)
+        ahead = free >> offset
+        bit = offset + (ahead & -ahead).bit_length() - 1 if ahead else (free & -free).bit_length() - 1
+
+        if _save_block(block, used | (1 << bit)):
+            return _format(block.block, bit)
+
+    raise RuntimeError('Could not allocate a pairing code: too many concurrent allocations')
+
+
+def allocate_pairing_codes(count):
+    """Hand out ``count`` unused pairing codes, touching each block at most once per pass"""
+    codes = []
+    retries = 0
+    with transaction.atomic():
+        while len(codes) < count:
+            progressed = False
+            for block in _blocks_with_free_codes(secrets.randbelow(BLOCK_COUNT)):
+                used = _used_mask(block)
+                free_bits = [bit for bit in range(BLOCK_SIZE) if not used >> bit & 1]
+                taken = _random.sample(free_bits, min(len(free_bits), count - len(codes)))
+                for bit in taken:
+                    used |= 1 << bit
+
+                if _save_block(block, used):
+                    codes.extend(_format(block.block, bit) for bit in taken)
+                    progressed = True
+                if len(codes) >= count:
+                    break
+
+            if not progressed:
+                retries += 1
+                if not PairingCodeBlock.objects.filter(free_count__gt=0).exists():
+                    raise PairingCodesExhausted(f'Only {len(codes)} of {count} pairing codes could be allocated')
+                if retries >= MAX_CONFLICT_RETRIES:
+                    raise RuntimeError('Could not allocate pairing codes: too many concurrent allocations')
+
+    _random.shuffle(codes)
+    return codes
+
+
+def release_pairing_code(code):
+    """Return a code to the free pool once no device holds it any more"""
+    position = _split(code)
+    if position is None:
+        return False
+    block_number, bit = position
+
+    for _ in range(MAX_CONFLICT_RETRIES):
+        block = PairingCodeBlock.objects.filter(block=block_number).first()
+        if block is None:
+            return False
+        used = _used_mask(block)
+        if not used >> bit & 1:
+            return False
+        if _save_block(block, used & ~(1 << bit)):
+            return True
+
+    logger.warning(f"Could not release pairing code {code}: too many concurrent updates")
+    return False
+
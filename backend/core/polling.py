@@ -0,0 +1,82 @@
+# core/polling.py
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import metrics
+
+
+class PollIntervalAdvisor:
+    """Suggests when each controller should poll for commands next (next_poll_ms).
+
+    A controller polls fast while its home is active (commands pending, or a
+    user sent one within ``active_window`` seconds), a little slower while the
+    owner has the app open and slowly when nobody is around. Every interval
+    is then stretched by the load factor, the EWMA of poll handling time
+    over ``target_latency`` (at most ``max_stretch``), so the whole fleet
+    backs off when the server falls behind. A little jitter keeps
+    controllers that polled together from staying in lockstep.
+    """
+
+    def __init__(self, active_ms=500, watching_ms=2000, idle_ms=10000, max_ms=30000, active_window=60,
+                 target_latency=0.1, max_stretch=4.0, alpha=0.1, jitter=0.1):
+        self.active_ms = active_ms
+        self.watching_ms = watching_ms
+        self.idle_ms = idle_ms
+        self.max_ms = max_ms
+        self.active_window = active_window
+        self.target_latency = target_latency
+        self.max_stretch = max_stretch
+        self.alpha = alpha
+        self.jitter = jitter
+
+        self._latency = 0.0
+        self._lock = threading.Lock()
+
+    def _cache(self):
+        return caches[getattr(settings, 'POLL_ACTIVITY_CACHE', 'default')]
+
+    def activity_key(self, controller_id):
+        return f'poll_activity:{controller_id}'
+
+    def note_activity(self, controller_id):
+        """A user just acted on this controller's home"""
+        self._cache().set(self.activity_key(controller_id), True, self.active_window)
+
+    async def anote_activity(self, controller_id):
+        await self._cache().aset(self.activity_key(controller_id), True, self.active_window)
+
+    def observe_latency(self, seconds):
+        """Feed the handling time of one poll"""
+        with self._lock:
+            self._latency += self.alpha * (seconds - self._latency)
+
+    def load_factor(self):
+        return min(self.max_stretch, max(1.0, self._latency / self.target_latency))
+
+    def _interval(self, tier):
+        base = {'active': self.active_ms, 'watching': self.watching_ms, 'idle': self.idle_ms}[tier]
+        interval = base * self.load_factor() * random.uniform(1 - self.jitter, 1 + self.jitter)
+        metrics.incr(f'polling.{tier}')
+        return int(min(self.max_ms, interval))
+
+    def next_poll_ms(self, controller_id, has_pending, owner_online):
+        if has_pending or self._cache().get(self.activity_key(controller_id)):
+            return self._interval('active')
+        return self._interval('watching' if owner_online else 'idle')
+
+    async def anext_poll_ms(self, controller_id, has_pending, owner_online):
+        if has_pending or await self._cache().aget(self.activity_key(controller_id)):
+            return self._interval('active')
+        return self._interval('watching' if owner_online else 'idle')
+
+    def snapshot(self):
+        return {
+            'poll_latency_ms': round(self._latency * 1000, 2),
+            'load_factor': round(self.load_factor(), 2),
+        }
+
+
+poll_advisor = PollIntervalAdvisor(**getattr(settings, 'POLL_INTERVALS', {}))
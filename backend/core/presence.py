@@ -0,0 +1,92 @@
+# core/presence.py
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+
+logger = logging.getLogger(__name__)
+
+
+def _cache():
+    return caches[getattr(settings, 'WEBSOCKET_PRESENCE_CACHE', 'default')]
+
+
+def _ttl():
+    return getattr(settings, 'WEBSOCKET_PRESENCE_TTL', 24 * 60 * 60)
+
+
+def presence_key(user_email):
+    return f'ws_presence:{user_email}'
+
+
+async def user_connected(user_email):
+    """Count one more open socket for the user"""
+    cache, key = _cache(), presence_key(user_email)
+    await cache.aadd(key, 0, _ttl())
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        # Expired between add and incr
+        await cache.aset(key, 1, _ttl())
+
+
+async def user_disconnected(user_email):
+    cache, key = _cache(), presence_key(user_email)
+    try:
+        if await cache.adecr(key) < 0:
+            await cache.aset(key, 0, _ttl())
+    except ValueError:
+        pass
+
+
+async def user_seen(user_email):
+    """Keep the registry entry alive while the user's sockets are active"""
+    await _cache().atouch(presence_key(user_email), _ttl())
+
+
+def tracked():
+    """Whether the counts cover every socket, so a zero can be trusted.
+
+    A process-local cache only sees its own process's sockets, and a file or
+    database cache increments by reading and writing back, losing counts
+    when processes race. Either is all of them only with the in-memory
+    channel layer, which cannot span processes anyway. A dummy cache never
+    holds a count, so it is not tracking anything.
+    """
+    cache = _cache()
+    if isinstance(cache, DummyCache):
+        return False
+    if not isinstance(cache, (LocMemCache, FileBasedCache, DatabaseCache)):
+        return True
+    return settings.CHANNEL_LAYERS['default']['BACKEND'] == 'channels.layers.InMemoryChannelLayer'
+
+
+def is_online(user_email):
+    """Whether the user has at least one open socket.
+
+    A crashed worker can leave a count behind until the TTL expires; that only
+    costs an unneeded send. Untracked presence (see ``tracked``) and errors
+    answer True, so events are never dropped because the registry cannot tell.
+    """
+    if not tracked():
+        return True
+    try:
+        return (_cache().get(presence_key(user_email)) or 0) > 0
+    except Exception as e:
+        logger.warning(f"Presence lookup failed for {user_email}: {e}")
+        return True
+
+
+async def ais_online(user_email):
+    """Async version of is_online"""
+    if not tracked():
+        return True
+    try:
+        return (await _cache().aget(presence_key(user_email)) or 0) > 0
+    except Exception as e:
+        logger.warning(f"Presence lookup failed for {user_email}: {e}")
+        return True
@@ -0,0 +1,122 @@
+# core/qr.py
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+
+import qrcode
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Rendering presets: the printable code and the small admin preview
+QR_SIZES = {
+    'full': {'box_size': 10, 'border': 4},
+    'thumb': {'box_size': 4, 'border': 2},
+}
+
+
+def qr_payload(device_id, pairing_code):
+    """The string the mobile app scans when pairing"""
+    return f"device_id:{device_id}|pairing_code:{pairing_code}"
+
+
+def qr_etag(device_id, pairing_code, size='full'):
+    """Stable identifier for one rendering; the PNG is fully determined by its inputs"""
+    key = f"{size}|{qr_payload(device_id, pairing_code)}"
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def render_qr_png(device_id, pairing_code, size='full'):
+    """Render a pairing QR code to PNG bytes, bypassing the caches"""
+    preset = QR_SIZES[size]
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=preset['box_size'],
+        border=preset['border'],
+    )
+    qr.add_data(qr_payload(device_id, pairing_code))
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class QRCodeCache:
+    """Two-level cache of rendered pairing QR codes.
+
+    A bounded in-process LRU sits in front of a directory of PNG files named
+    by their ETag. Entries never need invalidating: a new pairing code gives
+    a new key, and stale files are just never read again.
+    """
+
+    def __init__(self, root=None, max_entries=512):
+        self.root = Path(root) if root else None
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, etag):
+        return self.root / etag[:2] / f'{etag}.png'
+
+    def _remember(self, etag, png):
+        with self._lock:
+            self._entries[etag] = png
+            self._entries.move_to_end(etag)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _read_disk(self, etag):
+        if self.root is None:
+            return None
+        try:
+            return self._path(etag).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, etag, png):
+        if self.root is None:
+            return
+        path = self._path(etag)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename so concurrent readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(png)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write QR cache file {path}: {e}")
+
+    def get(self, device_id, pairing_code, size='full'):
+        """Return (etag, png bytes) for a device's pairing QR code"""
+        etag = qr_etag(device_id, pairing_code, size)
+        with self._lock:
+            png = self._entries.get(etag)
+            if png is not None:
+                self._entries.move_to_end(etag)
+                return etag, png
+
+        png = self._read_disk(etag)
+        if png is None:
+            png = render_qr_png(device_id, pairing_code, size)
+            self._write_disk(etag, png)
+        self._remember(etag, png)
+        return etag, png
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+qr_cache = QRCodeCache(
+    root=getattr(settings, 'QR_CACHE_ROOT', None),
+    max_entries=getattr(settings, 'QR_MEMORY_CACHE_SIZE', 512),
+)
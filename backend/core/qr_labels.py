@@ -0,0 +1,209 @@
+# core/qr_labels.py
+import os
+import zipfile
+import zlib
+from io import BytesIO
+from multiprocessing import get_context
+
+from django.conf import settings
+from PIL import Image, ImageDraw, ImageFont
+
+from .qr import qr_cache
+
+# A4 at 300 dpi; a full-size pairing code (box_size 10) fits a cell unscaled
+PAGE_SIZE = (2480, 3508)
+PAGE_DPI = 300
+PAGE_MARGIN = 80
+LABEL_FONT_SIZE = 26
+
+# Below this many labels a process pool costs more to start than it saves
+POOL_THRESHOLD = 64
+
+_font = None
+
+
+def _label_font():
+    global _font
+    if _font is None:
+        try:
+            _font = ImageFont.load_default(size=LABEL_FONT_SIZE)
+        except (AttributeError, TypeError, OSError):
+            # Pillow without FreeType only has the small bitmap font
+            _font = ImageFont.load_default()
+    return _font
+
+
+def cell_size(columns, rows):
+    width = (PAGE_SIZE[0] - 2 * PAGE_MARGIN) // columns
+    height = (PAGE_SIZE[1] - 2 * PAGE_MARGIN) // rows
+    return width, height
+
+
+def render_label(job):
+    """Render one device's label tile; runs in a pool worker.
+
+    ``job`` is (device_id, pairing_code, name, cell_width, cell_height).
+    Returns (device_id, png bytes of the bare code, 1-bit tile bytes) so the
+    parent only has to write the PNG and paste the tile.
+    """
+    device_id, pairing_code, name, width, height = job
+    _, png = qr_cache.get(device_id, pairing_code)
+
+    font = _label_font()
+    line_height = font.getbbox('Ag')[3] + 6
+    tile = Image.new('1', (width, height), 1)
+    code = Image.open(BytesIO(png)).convert('1')
+    room = min(width, height - 2 * line_height)
+    if code.width > room:
+        # Keep modules square and crisp: shrink by a whole factor
+        factor = -(-code.width // room)
+        code = code.resize((code.width // factor, code.height // factor), Image.NEAREST)
+    tile.paste(code, ((width - code.width) // 2, 0))
+
+    draw = ImageDraw.Draw(tile)
+    for i, text in enumerate([name or device_id, f'{device_id}  ·  {pairing_code}']):
+        text_width = draw.textlength(text, font=font)
+        draw.text(((width - text_width) // 2, code.height + i * line_height), text, fill=0, font=font)
+    return device_id, png, tile.tobytes()
+
+
+class StreamingPdfWriter:
+    """Minimal PDF writer that appends each 1-bit page image as it is produced.
+
+    Pillow's PDF append re-reads and rewrites the page tree on every call,
+    which turns a long run quadratic. Here each page is three objects (image,
+    content stream, page) written straight to the file; only their offsets
+    are kept until the page tree and xref are written on close.
+    """
+
+    def __init__(self, path, dpi=PAGE_DPI):
+        self.file = open(path, 'wb')
+        self.dpi = dpi
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3  # 1 is the catalog, 2 the page tree
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _object(self, object_id, body, stream=None):
+        self.offsets[object_id] = self.file.tell()
+        self.file.write(f'{object_id} 0 obj\n'.encode() + body)
+        if stream is not None:
+            self.file.write(b'\nstream\n' + stream + b'\nendstream')
+        self.file.write(b'\nendobj\n')
+
+    def add_page(self, image):
+        image_id, content_id, page_id = self.next_id, self.next_id + 1, self.next_id + 2
+        self.next_id += 3
+        width, height = image.size
+        points = (width * 72 / self.dpi, height * 72 / self.dpi)
+
+        # Mode '1' rows are packed 8 pixels per byte with 1 = white, which is
+        # exactly a 1-bit DeviceGray image
+        data = zlib.compress(image.tobytes(), 6)
+        self._object(image_id, (
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+            f'/ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /FlateDecode /Length {len(data)} >>'
+        ).encode(), data)
+        content = f'q {points[0]:.2f} 0 0 {points[1]:.2f} 0 0 cm /Im0 Do Q'.encode()
+        self._object(content_id, f'<< /Length {len(content)} >>'.encode(), content)
+        self._object(page_id, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {points[0]:.2f} {points[1]:.2f}] '
+            f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>'
+        ).encode())
+        self.page_ids.append(page_id)
+
+    def close(self):
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self.page_ids)
+        self._object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        self._object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>'.encode())
+
+        xref_offset = self.file.tell()
+        self.file.write(f'xref\n0 {self.next_id}\n0000000000 65535 f \n'.encode())
+        for object_id in range(1, self.next_id):
+            self.file.write(f'{self.offsets[object_id]:010d} 00000 n \n'.encode())
+        self.file.write(
+            f'trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode()
+        )
+        self.file.close()
+
+
+class LabelSheetWriter:
+    """Tiles label images onto pages and writes each page as soon as it fills"""
+
+    def __init__(self, sheet_path, columns=4, rows=6, page_format='pdf'):
+        self.sheet_path = str(sheet_path)
+        self.columns = columns
+        self.rows = rows
+        self.page_format = page_format
+        self.cell = cell_size(columns, rows)
+        self.pages = 0
+        self._page = None
+        self._slot = 0
+        self._pdf = StreamingPdfWriter(self.sheet_path) if page_format == 'pdf' else None
+
+    def add(self, tile_bytes):
+        if self._page is None:
+            self._page = Image.new('1', PAGE_SIZE, 1)
+            self._slot = 0
+        tile = Image.frombytes('1', self.cell, tile_bytes)
+        row, column = divmod(self._slot, self.columns)
+        self._page.paste(tile, (PAGE_MARGIN + column * self.cell[0], PAGE_MARGIN + row * self.cell[1]))
+        self._slot += 1
+        if self._slot == self.columns * self.rows:
+            self.flush()
+
+    def flush(self):
+        if self._page is None:
+            return
+        if self._pdf:
+            self._pdf.add_page(self._page)
+        else:
+            root, _ = os.path.splitext(self.sheet_path)
+            self._page.save(f'{root}-{self.pages + 1:03d}.png', 'PNG', dpi=(PAGE_DPI, PAGE_DPI))
+        self.pages += 1
+        self._page = None
+
+    def close(self):
+        self.flush()
+        if self._pdf:
+            self._pdf.close()
+
+
+def generate_label_sheets(devices, sheet_path, zip_path, columns=4, rows=6, page_format='pdf',
+                          workers=None, progress=None):
+    """Render pairing labels for ``devices`` into printable sheets and a ZIP of PNGs.
+
+    ``devices`` is an iterable of (device_id, pairing_code, name) tuples, e.g. a
+    values_list().iterator(). Codes are rendered in a process pool and written
+    out in input order as they arrive, so only about one page of images is
+    held in memory whatever the fleet size.
+    """
+    width, height = cell_size(columns, rows)
+    # The job tuples are tiny; materialising them keeps the database cursor
+    # in this thread, away from the pool's task feeder thread
+    jobs = [(device_id, code, name, width, height) for device_id, code, name in devices]
+    workers = workers or getattr(settings, 'QR_LABEL_WORKERS', None) or os.cpu_count()
+
+    sheets = LabelSheetWriter(sheet_path, columns, rows, page_format)
+    count = 0
+    try:
+        with zipfile.ZipFile(zip_path, 'w') as archive:
+            def collect(results):
+                nonlocal count
+                for device_id, png, tile in results:
+                    # PNG is already deflated; storing it avoids compressing twice
+                    archive.writestr(f'{device_id}.png', png, compress_type=zipfile.ZIP_STORED)
+                    sheets.add(tile)
+                    count += 1
+                    if progress and count % 500 == 0:
+                        progress(count)
+
+            if len(jobs) < POOL_THRESHOLD or workers == 1:
+                collect(map(render_label, jobs))
+            else:
+                with get_context('spawn').Pool(workers) as pool:
+                    collect(pool.imap(render_label, jobs, chunksize=32))
+    finally:
+        sheets.close()
+
+    return {'labels': count, 'pages': sheets.pages}
@@ -0,0 +1,227 @@
+# core/retention.py
+import gzip
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+from pathlib import Path
+
+from django.apps import apps
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import MaintenanceCheckpoint
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLICIES = {
+    'activitylog': {'days': 90},
+    'devicecommand': {'days': 30, 'filter': {'is_executed': True}},
+    'devicealert': {'days': 180, 'filter': {'is_resolved': True}},
+}
+
+
+def get_policies():
+    """Retention policies keyed by lower-case core model name"""
+    return getattr(settings, 'RETENTION_POLICIES', DEFAULT_POLICIES)
+
+
+def archive_root():
+    return Path(getattr(settings, 'RETENTION_ARCHIVE_ROOT', Path(settings.BASE_DIR) / 'archive'))
+
+
+class RetentionPolicy:
+    def __init__(self, table, days, filter=None, date_field='created_at'):
+        self.table = table
+        self.model = apps.get_model('core', table)
+        self.days = days
+        self.filter = filter or {}
+        self.date_field = date_field
+
+    def cutoff(self, now=None):
+        return (now or timezone.now()) - timedelta(days=self.days)
+
+    def expired(self, cutoff):
+        return self.model.objects.filter(**{f'{self.date_field}__lt': cutoff}, **self.filter)
+
+    def report(self, now=None):
+        """What a run would archive and delete, without touching anything"""
+        cutoff = self.cutoff(now)
+        stats = self.expired(cutoff).aggregate(
+            oldest=Min(self.date_field),
+            newest=Max(self.date_field),
+        )
+        return {
+            'table': self.table,
+            'cutoff': cutoff,
+            'expired_rows': self.expired(cutoff).count(),
+            'total_rows': self.model.objects.count(),
+            **stats,
+        }
+
+
+def _day_paths(table, day):
+    directory = archive_root() / table
+    return directory / f'{day}.ndjson.gz', directory / f'{day}.idx'
+
+
+def _read_index(table, day):
+    """The day's index entries, in the order the members were written"""
+    _, index_path = _day_paths(table, day)
+    if not index_path.exists():
+        return []
+    with open(index_path) as index:
+        # A last line without its newline was cut short; that member is not indexed
+        return [json.loads(line) for line in index if line.endswith('\n')]
+
+
+def write_archive_member(table, day, rows, entries=None):
+    """Append rows as one gzip member to the day's archive and index it.
+
+    A gzip file may hold several concatenated members, so each chunk is
+    readable on its own from the offset recorded in the index. Anything past
+    the last indexed member was left by a run that stopped between writing
+    data and index; it is cut off first, since its rows are written again.
+    ``entries`` is the day's index as loaded by the caller, kept up to date.
+    """
+    data_path, index_path = _day_paths(table, day)
+    data_path.parent.mkdir(parents=True, exist_ok=True)
+    if entries is None:
+        entries = _read_index(table, day)
+    indexed_end = max((entry['offset'] + entry['length'] for entry in entries), default=0)
+
+    payload = gzip.compress(
+        ''.join(json.dumps(row, cls=DjangoJSONEncoder, separators=(',', ':')) + '\n' for row in rows).encode()
+    )
+    with open(data_path, 'ab') as archive:
+        if archive.seek(0, os.SEEK_END) > indexed_end:
+            archive.truncate(indexed_end)
+        archive.write(payload)
+        archive.flush()
+        os.fsync(archive.fileno())
+
+    entry = {
+        'first_id': rows[0]['id'],
+        'last_id': rows[-1]['id'],
+        'rows': len(rows),
+        'offset': indexed_end,
+        'length': len(payload),
+    }
+    with open(index_path, 'ab+') as index:
+        if index.seek(0, os.SEEK_END):
+            index.seek(-1, os.SEEK_END)
+            if index.read(1) != b'\n':
+                # Drop an entry cut short mid-line so the new one starts on its own line
+                index.seek(0)
+                index.truncate(index.read().rfind(b'\n') + 1)
+        index.write(json.dumps(entry).encode() + b'\n')
+        index.flush()
+        os.fsync(index.fileno())
+    entries.append(entry)
+    return entry
+
+
+def find_archived(table, day, record_id):
+    """Look up one archived row by id, decompressing only the member that holds it"""
+    data_path, _ = _day_paths(table, day)
+    members = _read_index(table, day)
+    if not members:
+        return None
+
+    with open(data_path, 'rb') as archive:
+        for member in members:
+            if not member['first_id'] <= record_id <= member['last_id']:
+                continue
+            archive.seek(member['offset'])
+            for line in gzip.decompress(archive.read(member['length'])).splitlines():
+                row = json.loads(line)
+                if row['id'] == record_id:
+                    return row
+    return None
+
+
+def _archive_members(policy, members, indexes, rows=None):
+    """Write each planned member that is not indexed yet; rows are reloaded by id when not given.
+
+    ``indexes`` caches each day's index entries for the run, so they are
+    read once per day rather than once per member.
+    """
+    if rows is None:
+        ids = [pk for member in members for pk in member['ids']]
+        rows = {row['id']: row for row in policy.model.objects.filter(pk__in=ids).values()}
+    for member in members:
+        day = member['day']
+        if day not in indexes:
+            indexes[day] = _read_index(policy.table, day)
+        span = (member['ids'][0], member['ids'][-1])
+        if any((entry['first_id'], entry['last_id']) == span for entry in indexes[day]):
+            continue
+        member_rows = [rows[pk] for pk in member['ids'] if pk in rows]
+        if member_rows:
+            write_archive_member(policy.table, day, member_rows, entries=indexes[day])
+
+
+def _delete_ids(policy, ids, batch_size, pause):
+    """Delete exactly the archived rows in small batches, each in its own short transaction"""
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        deleted += policy.model.objects.filter(pk__in=ids[start:start + batch_size]).delete()[0]
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def _save_pending(checkpoint, pending):
+    checkpoint.state = {**checkpoint.state, 'pending': pending}
+    checkpoint.save(update_fields=['state', 'updated_at'])
+
+
+def apply_policy(policy, chunk_size=5000, delete_batch=500, pause=0.0, now=None, log=None):
+    """Archive then delete every expired row of one table, resuming an interrupted run first.
+
+    Each chunk's plan (its archive members and their ids) is checkpointed
+    before anything is written. A resumed run writes only the members
+    missing from the index and deletes only the planned ids, so rows are
+    archived once and nothing that expired meanwhile is deleted unarchived.
+    """
+    log = log or logger.info
+    checkpoint, _ = MaintenanceCheckpoint.objects.get_or_create(name=f'retention:{policy.table}')
+    totals = {'archived': 0, 'deleted': 0}
+    indexes = {}
+
+    pending = checkpoint.state.get('pending')
+    if pending:
+        ids = [pk for member in pending['members'] for pk in member['ids']]
+        log(f"{policy.table}: resuming archive and deletion of ids {ids[0]}-{ids[-1]}")
+        _archive_members(policy, pending['members'], indexes)
+        totals['deleted'] += _delete_ids(policy, ids, delete_batch, pause)
+        _save_pending(checkpoint, None)
+
+    cutoff = policy.cutoff(now)
+    while True:
+        rows = list(policy.expired(cutoff).order_by('pk').values()[:chunk_size])
+        if not rows:
+            break
+
+        by_day = defaultdict(list)
+        for row in rows:
+            by_day[timezone.localtime(row[policy.date_field]).date().isoformat()].append(row['id'])
+        members = [{'day': day, 'ids': ids} for day, ids in sorted(by_day.items())]
+        _save_pending(checkpoint, {'members': members, 'cutoff': cutoff.isoformat()})
+
+        _archive_members(policy, members, indexes, rows={row['id']: row for row in rows})
+        totals['archived'] += len(rows)
+        totals['deleted'] += _delete_ids(policy, [row['id'] for row in rows], delete_batch, pause)
+        log(f"{policy.table}: archived and deleted through id {rows[-1]['id']}")
+
+    checkpoint.state = {
+        'last_run': timezone.now().isoformat(),
+        'cutoff': cutoff.isoformat(),
+        **totals,
+    }
+    checkpoint.save(update_fields=['state', 'updated_at'])
+    return totals
@@ -1,3 +1,1891 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import json
+import math
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import zipfile
+from datetime import datetime, time, timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.admin import site
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.db.models import Avg, Count, Max
+from django.db.models.functions import ExtractHour
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from . import async_views, channel_layers, coalescing, command_queue, idempotency, pairing, retention, utils, views, websocket_utils
+from .analytics import get_consumption_analytics, invalidate_user_analytics, load_readings
+from .anomaly import CurrentAnomalyDetector
+from .channel_layers import LocalChannelLayer
+from .command_latency import latency_summary
+from .command_queue import command_queues
+from .consumers import DeviceStatusConsumer
+from .dispatch import BatchDispatcher
+from .energy import accumulate_energy, split_interval
+from .event_stream import build_state_snapshot, record_event, replay_since
+from .metrics import Histogram, metrics
+from .models import (
+    UserProfile, Room, Controller, Device, DeviceCommand, ActivityLog, CurrentReading, DeviceAlert, EnergyBucket,
+    IdempotencyRecord, MaintenanceCheckpoint, PairingCodeBlock
+)
+from .pairing import BLOCK_SIZE, PairingCodesExhausted, allocate_pairing_code, allocate_pairing_codes, release_pairing_code
+from .polling import PollIntervalAdvisor
+from .presence import ais_online, is_online, presence_key
+from .qr import QRCodeCache, qr_cache, qr_etag
+from .websocket_utils import encode_channel_message, send_device_status_update
+
+
+# There is no Redis here: the shared alias gets a LocMemCache of its own, and
+# WebSocket sends run inline rather than on a thread that outlives the test database
+TEST_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+}
+_test_caches = override_settings(CACHES=TEST_CACHES, WEBSOCKET_BACKGROUND_DISPATCH=False)
+
+
+def setUpModule():
+    _test_caches.enable()
+
+
+def tearDownModule():
+    _test_caches.disable()
+
+
+def clear_caches():
+    for backend in caches.all():
+        backend.clear()
+
+
+class AdminChangelistQueryTests(TestCase):
+    """Changelist pages must not issue queries per row"""
+
+    # Session, user, count, page rows, filter choices and the like: a constant
+    # number per page whatever the row count
+    QUERY_BUDGET = 12
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+
+    def create_homes(self, count, start=0):
+        for i in range(start, start + count):
+            user = UserProfile.objects.create(full_name=f'User {i}', email=f'user{i}@example.com')
+            room = Room.objects.create(name=f'Room {i}', owner=user)
+            controller = Controller.objects.create(controller_id=f'ESP-{i:04d}', owner=user, room=room)
+            for pin in ('kitchen', 'living'):
+                device = Device.objects.create(
+                    device_id=f'ESP-{i:04d}-{pin}', name=pin, type='socket', hardware_pin=pin,
+                    controller=controller, owner=user, room=room, is_paired=pin == 'kitchen'
+                )
+                DeviceCommand.objects.create(device=device, controller=controller, action='on')
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assert_constant_queries(self, url):
+        self.create_homes(2)
+        few = self.changelist_queries(url)
+        self.create_homes(20, start=2)
+        many = self.changelist_queries(url)
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, self.QUERY_BUDGET)
+
+    def test_counts_are_not_multiplied(self):
+        self.create_homes(1)
+        user = UserProfile.objects.get()
+        Room.objects.create(name='Second room', owner=user)
+        DeviceCommand.objects.filter(device__hardware_pin='kitchen').update(is_executed=True)
+
+        def annotated(model):
+            return site._registry[model].get_queryset(RequestFactory().get('/')).get()
+
+        user = annotated(UserProfile)
+        self.assertEqual((user._room_count, user._device_count, user._controller_count), (2, 1, 1))
+        room = site._registry[Room].get_queryset(RequestFactory().get('/')).get(name='Room 0')
+        self.assertEqual((room._device_count, room._controller_count), (2, 1))
+        controller = annotated(Controller)
+        self.assertEqual((controller._device_count, controller._pending_commands), (2, 1))
+
+    def test_userprofile_changelist(self):
+        self.assert_constant_queries('/admin/core/userprofile/')
+
+    def test_room_changelist(self):
+        self.assert_constant_queries('/admin/core/room/')
+
+    def test_controller_changelist(self):
+        self.assert_constant_queries('/admin/core/controller/')
+
+    def test_counts_are_annotated_and_sortable(self):
+        self.create_homes(3)
+        user = UserProfile.objects.get(email='user1@example.com')
+        Room.objects.create(name='Extra', owner=user)
+
+        response = self.client.get('/admin/core/userprofile/', {'o': '-5'})  # room_count descending
+        self.assertEqual(response.status_code, 200)
+        rows = list(response.context['cl'].result_list)
+        self.assertEqual(rows[0], user)
+        self.assertEqual((rows[0]._room_count, rows[0]._device_count, rows[0]._controller_count), (2, 1, 1))
+
+        response = self.client.get('/admin/core/controller/', {'o': '-7'})  # pending_commands descending
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_list[0]._pending_commands, 2)
+
+
+class ReadReplicaRoutingTests(TestCase):
+    """Read endpoints use the replica, except right after the client's own write"""
+
+    # Resolved when the class is set up, so it takes in the replica added below
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        # The replica is a second SQLite file next to the test database
+        cls.replica_dir = tempfile.mkdtemp(prefix='replica-test-')
+        connections.settings['replica'] = {
+            **connections['default'].settings_dict,
+            'NAME': str(Path(cls.replica_dir) / 'replica.sqlite3'),
+        }
+        call_command('migrate', database='replica', verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        shutil.rmtree(cls.replica_dir, ignore_errors=True)
+
+    def setUp(self):
+        clear_caches()
+        self.user = UserProfile.objects.create(full_name='Replica User', email='replica@example.com')
+        room = Room.objects.create(name='Kitchen', owner=self.user)
+        controller = Controller.objects.create(controller_id='ESP-REPL', owner=self.user, room=room)
+        Device.objects.create(
+            device_id='ESP-REPL-kitchen', name='kitchen', type='socket', hardware_pin='kitchen',
+            controller=controller, owner=self.user, room=room, is_paired=True
+        )
+        self.replicate()
+
+    def replicate(self):
+        """Copy the primary's rows to the replica, as replication would"""
+        for model in (UserProfile, Room, Controller, Device, ActivityLog):
+            model.objects.using('replica').all().delete()
+            model.objects.using('replica').bulk_create(model.objects.using('default').all())
+
+    def device_status(self):
+        response = self.client.get('/api/devices/list/', {'email': self.user.email})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['devices'][0]['status']
+
+    def log_messages(self):
+        response = self.client.get('/api/logs/', {'email': self.user.email})
+        self.assertEqual(response.status_code, 200)
+        return [log['message'] for log in response.json()['logs']]
+
+    def test_reads_come_from_replica(self):
+        # Changed on the primary by the ESP32, not yet replicated
+        Device.objects.filter(owner=self.user).update(status='on')
+
+        self.assertEqual(self.device_status(), 'off')
+        self.replicate()
+        self.assertEqual(self.device_status(), 'on')
+
+        response = self.client.get('/api/system/settings/', {'email': self.user.email})
+        self.assertEqual(response.json()['online_devices'], 1)
+
+    def test_writes_go_to_primary_and_pin_reads(self):
+        response = self.client.put(
+            '/api/profile/', {'email': self.user.email, 'full_name': 'Renamed'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('db_primary', response.cookies)
+        self.assertEqual(UserProfile.objects.using('default').get(pk=self.user.pk).full_name, 'Renamed')
+        self.assertEqual(UserProfile.objects.using('replica').get(pk=self.user.pk).full_name, 'Replica User')
+
+        # Pinned by the cookie, and by the email for clients that drop cookies;
+        # the pin is in the shared cache, so another worker's local cache is irrelevant
+        self.assertEqual(self.log_messages(), ['Profile updated'])
+        self.client.cookies.clear()
+        caches['default'].clear()
+        self.assertEqual(self.log_messages(), ['Profile updated'])
+
+        # Window over: back to the (still lagging) replica
+        clear_caches()
+        self.assertEqual(self.log_messages(), [])
+
+    def test_other_clients_are_not_pinned(self):
+        self.client.put(
+            '/api/profile/', {'email': self.user.email, 'full_name': 'Renamed'}, content_type='application/json'
+        )
+        # Only on the replica, so a 404 would mean the read went to the primary
+        UserProfile.objects.using('replica').create(full_name='Other', email='other@example.com')
+
+        response = self.client_class().get('/api/logs/', {'email': 'other@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['logs'], [])
+
+    def test_admin_changelist_reads_replica(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        UserProfile.objects.using('replica').create(full_name='Replica Only', email='only@example.com')
+
+        response = self.client.get('/admin/core/userprofile/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('only@example.com', [user.email for user in response.context['cl'].result_list])
+
+
+class SQLiteProfileTests(SimpleTestCase):
+    """New SQLite connections get the WAL profile's pragmas"""
+
+    def test_pragmas_applied_to_new_connections(self):
+        directory = tempfile.mkdtemp(prefix='sqlite-profile-test-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        wrapper = SQLiteDatabaseWrapper(
+            {**connections['default'].settings_dict, 'NAME': str(Path(directory) / 'profile.sqlite3')}, alias='profile-test'
+        )
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            pragmas = {}
+            for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'temp_store'):
+                cursor.execute(f'PRAGMA {name}')
+                pragmas[name] = cursor.fetchone()[0]
+        self.assertEqual(pragmas['journal_mode'], 'wal')
+        self.assertEqual(pragmas['synchronous'], 1)  # NORMAL
+        self.assertEqual(pragmas['busy_timeout'], settings.SQLITE_PRAGMAS['busy_timeout'])
+        self.assertEqual(pragmas['mmap_size'], settings.SQLITE_PRAGMAS['mmap_size'])
+        self.assertEqual(pragmas['temp_store'], 2)  # MEMORY
+
+    def test_no_persistent_connections(self):
+        # ASGI executor threads never see request_finished, so a non-zero
+        # CONN_MAX_AGE would leave one open connection per thread
+        for profile in settings.DATABASE_PROFILES.values():
+            self.assertEqual(profile['CONN_MAX_AGE'], 0)
+        self.assertEqual(settings.DATABASE_PROFILES['sqlite']['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        self.assertIn('pool', settings.DATABASE_PROFILES['postgres']['OPTIONS'])
+
+class ConsumptionAnalyticsTests(TestCase):
+    """NumPy statistics agree with the database, and closed ranges stay cached"""
+
+    def setUp(self):
+        clear_caches()
+        self.user = UserProfile.objects.create(full_name='Analytics User', email='analytics@example.com')
+        room = Room.objects.create(name='Kitchen', owner=self.user)
+        controller = Controller.objects.create(controller_id='ESP-ANLT', owner=self.user, room=room)
+        self.devices = [
+            Device.objects.create(
+                device_id=f'ESP-ANLT-{pin}', name=pin, type='socket', hardware_pin=pin,
+                controller=controller, owner=self.user, room=room, is_paired=True
+            )
+            for pin in ('kitchen', 'living')
+        ]
+        self.today = timezone.localdate()
+        self.start = self.midnight(self.today - timedelta(days=3))
+        readings = []
+        for i in range(3 * 24 * 4):  # Every 15 minutes for three days
+            at = self.start + timedelta(minutes=15 * i)
+            readings.append(CurrentReading(device=self.devices[0], recorded_at=at, current=(i * 7) % 13 / 2))
+            if i % 3 == 0:
+                readings.append(CurrentReading(device=self.devices[1], recorded_at=at, current=(i * 5) % 11 / 4))
+        CurrentReading.objects.bulk_create(readings)
+
+    def midnight(self, day):
+        return timezone.make_aware(datetime.combine(day, time.min))
+
+    def test_matches_orm_aggregation(self):
+        end = self.midnight(self.today)
+        data = get_consumption_analytics(self.user, self.start, end)
+        in_range = CurrentReading.objects.filter(recorded_at__gte=self.start, recorded_at__lt=end)
+
+        self.assertEqual(data['samples'], in_range.count())
+        devices = {device['device_id']: device for device in data['devices']}
+        for device in self.devices:
+            rows = in_range.filter(device=device)
+            expected = rows.aggregate(samples=Count('id'), mean=Avg('current'), max=Max('current'))
+            summary = devices[device.device_id]
+            self.assertEqual(summary['samples'], expected['samples'])
+            self.assertAlmostEqual(summary['mean'], expected['mean'], places=3)
+            self.assertAlmostEqual(summary['max'], expected['max'], places=3)
+            self.assertAlmostEqual(summary['p50'], statistics.median(rows.values_list('current', flat=True)), places=3)
+
+            hourly = dict(rows.annotate(hour=ExtractHour('recorded_at')).values('hour').annotate(mean=Avg('current')).values_list('hour', 'mean'))
+            for hour, mean in enumerate(summary['load_profile']):
+                self.assertAlmostEqual(mean, hourly.get(hour, 0.0), places=3)
+
+        hourly = dict(in_range.annotate(hour=ExtractHour('recorded_at')).values('hour').annotate(mean=Avg('current')).values_list('hour', 'mean'))
+        for hour, mean in enumerate(data['load_profile']):
+            self.assertAlmostEqual(mean, hourly.get(hour, 0.0), places=3)
+
+    def test_status_reports_only_invalidate_open_ranges(self):
+        closed_end = self.midnight(self.today)
+        open_end = self.midnight(self.today + timedelta(days=1))
+        closed = get_consumption_analytics(self.user, self.start, closed_end)
+        opened = get_consumption_analytics(self.user, self.start, open_end)
+
+        CurrentReading.objects.create(device=self.devices[0], recorded_at=timezone.now(), current=1.0)
+        invalidate_user_analytics(self.user.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(get_consumption_analytics(self.user, self.start, closed_end), closed)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(get_consumption_analytics(self.user, self.start, open_end)['samples'], opened['samples'] + 1)
+
+    def test_invalidation_is_shared(self):
+        open_end = self.midnight(self.today + timedelta(days=1))
+        get_consumption_analytics(self.user, self.start, open_end)
+        invalidate_user_analytics(self.user.id)
+        # Versions and results live where every worker sees them, not in the process-local default
+        self.assertEqual(caches['shared'].get(f'analytics:version:{self.user.id}'), 1)
+        self.assertIsNone(cache.get(f'analytics:version:{self.user.id}'))
+        self.assertFalse(any(key.startswith(':1:analytics') for key in cache._cache))
+
+    def test_load_readings_matches_rows(self):
+        end = self.midnight(self.today)
+        device_ids, timestamps, amps = load_readings(self.user, self.start, end)
+        rows = CurrentReading.objects.filter(recorded_at__gte=self.start, recorded_at__lt=end)
+        self.assertEqual(
+            sorted(zip(device_ids.tolist(), timestamps.tolist(), amps.tolist())),
+            sorted((device_id, at.timestamp(), current) for device_id, at, current in rows.values_list('device_id', 'recorded_at', 'current'))
+        )
+        empty = load_readings(self.user, end, end)
+        self.assertEqual([array.size for array in empty], [0, 0, 0])
+
+    def test_benchmark_times_database_load(self):
+        out = StringIO()
+        readings = CurrentReading.objects.count()
+        call_command('benchmark_analytics', devices=2, days=2, interval=3600, repeat=1, from_database=True, stdout=out)
+        self.assertIn('load_readings: best', out.getvalue())
+        self.assertIn('96 rows', out.getvalue())
+        # Everything it wrote was rolled back
+        self.assertEqual(CurrentReading.objects.count(), readings)
+        self.assertFalse(UserProfile.objects.filter(full_name='Analytics Benchmark').exists())
+
+
+class CurrentAnomalyAlertTests(TestCase):
+    """Status reports feed the detector, and a lasting spike alerts once"""
+
+    def setUp(self):
+        user = UserProfile.objects.create(full_name='Spike User', email='spike@example.com')
+        room = Room.objects.create(name='Kitchen', owner=user)
+        self.controller = Controller.objects.create(controller_id='ESP-SPKE', owner=user, room=room)
+        Device.objects.create(
+            device_id='ESP-SPKE-kitchen', name='kitchen', type='socket', hardware_pin='kitchen',
+            controller=self.controller, owner=user, room=room, is_paired=True
+        )
+
+    def report(self, amps):
+        response = self.client.post('/api/devices/status/', {
+            'controller_id': self.controller.controller_id,
+            'device_status': {'kitchen': True, 'kitchen_current': amps},
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_sustained_spike_raises_one_alert(self):
+        with mock.patch('core.views.current_anomaly_detector', CurrentAnomalyDetector()):
+            for i in range(40):
+                self.report(1.0 + 0.1 * (i % 3))
+            self.assertFalse(DeviceAlert.objects.exists())
+
+            for _ in range(30):
+                self.report(5.0)
+
+        self.assertEqual(list(DeviceAlert.objects.values_list('alert_type', flat=True)), ['high_current'])
+
+
+class RetentionResumeTests(TestCase):
+    """An interrupted retention run resumes without duplicating or losing rows"""
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp(prefix='retention-test-')
+        self.addCleanup(shutil.rmtree, self.archive_dir, ignore_errors=True)
+        override = override_settings(RETENTION_ARCHIVE_ROOT=Path(self.archive_dir))
+        override.enable()
+        self.addCleanup(override.disable)
+
+        user = UserProfile.objects.create(full_name='Retention User', email='retention@example.com')
+        controller = Controller.objects.create(controller_id='ESP-RETN', owner=user)
+        device = Device.objects.create(device_id='ESP-RETN-kitchen', name='kitchen', hardware_pin='kitchen', controller=controller)
+        old = timezone.now() - timedelta(days=40)
+        for i in range(12):
+            command = DeviceCommand.objects.create(device=device, controller=controller, action='on', is_executed=i != 5)
+            # Two days' worth, so each chunk is archived as two members
+            DeviceCommand.objects.filter(pk=command.pk).update(created_at=old - timedelta(days=i % 2))
+        self.policy = retention.RetentionPolicy('devicecommand', days=30, filter={'is_executed': True})
+
+    def archived_ids(self):
+        ids = []
+        for path in Path(self.archive_dir, 'devicecommand').glob('*.ndjson.gz'):
+            with gzip.open(path) as archive:
+                ids += [json.loads(line)['id'] for line in archive]
+        return sorted(ids)
+
+    def test_interrupted_run_resumes(self):
+        write_member = retention.write_archive_member
+        calls = []
+
+        def crash_after_first_member(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                raise RuntimeError('disk full')
+            return write_member(*args, **kwargs)
+
+        with mock.patch('core.retention.write_archive_member', side_effect=crash_after_first_member):
+            with self.assertRaises(RuntimeError):
+                retention.apply_policy(self.policy)
+        # The older day's member made it to disk; the executed rows of that day
+        self.assertEqual(len(self.archived_ids()), 5)
+        self.assertEqual(DeviceCommand.objects.count(), 12)
+
+        # Expires between the runs, inside the interrupted chunk's id range
+        late = DeviceCommand.objects.get(is_executed=False)
+        DeviceCommand.objects.filter(pk=late.pk).update(is_executed=True)
+
+        totals = retention.apply_policy(self.policy)
+        self.assertEqual(totals['deleted'], 12)
+        self.assertFalse(DeviceCommand.objects.exists())
+        # Every row archived exactly once, the late one by the resumed run's own pass
+        self.assertEqual(self.archived_ids(), sorted(set(self.archived_ids())))
+        self.assertEqual(len(self.archived_ids()), 12)
+        day = timezone.localtime(timezone.now() - timedelta(days=41)).date().isoformat()
+        self.assertEqual(retention.find_archived('devicecommand', day, late.pk)['id'], late.pk)
+        self.assertNotIn('pending', MaintenanceCheckpoint.objects.get(name='retention:devicecommand').state)
+
+    def test_unindexed_tail_is_replaced(self):
+        day = timezone.localtime(timezone.now() - timedelta(days=40)).date().isoformat()
+        first = list(DeviceCommand.objects.order_by('pk').values()[:2])
+        retention.write_archive_member('devicecommand', day, first)
+        directory = Path(self.archive_dir, 'devicecommand')
+        data_path, index_path = directory / f'{day}.ndjson.gz', directory / f'{day}.idx'
+
+        # A run that stopped after its data write, and another mid-way through its index line
+        with open(data_path, 'ab') as archive:
+            archive.write(gzip.compress(b'{"id": 999}\n'))
+        with open(index_path, 'a') as index:
+            index.write('{"first_id": 999, "last')
+
+        second = list(DeviceCommand.objects.order_by('pk').values()[2:4])
+        entry = retention.write_archive_member('devicecommand', day, second)
+        self.assertEqual(entry['offset'], retention._read_index('devicecommand', day)[0]['length'])
+        self.assertEqual(self.archived_ids(), [row['id'] for row in first + second])
+        self.assertEqual(len(retention._read_index('devicecommand', day)), 2)
+        self.assertEqual(retention.find_archived('devicecommand', day, second[1]['id'])['id'], second[1]['id'])
+        self.assertIsNone(retention.find_archived('devicecommand', day, 999))
+
+
+class BackfillActivityLogsTests(TestCase):
+    """The activity log backfill resumes after a crash and never runs twice over the same rows"""
+
+    def setUp(self):
+        user = UserProfile.objects.create(full_name='Backfill User', email='backfill@example.com')
+        self.controller = Controller.objects.create(controller_id='ESP-BKFL', owner=user)
+        self.device = Device.objects.create(device_id='ESP-BKFL-fan', name='fan', controller=self.controller, owner=user)
+        for action in ('on', 'off', 'on', 'off', 'on'):
+            DeviceCommand.objects.create(device=self.device, controller=self.controller, action=action, is_executed=True)
+
+    def backfill(self):
+        out = StringIO()
+        call_command('backfill_activity_logs', source=['devicecommand'], chunk_size=2, stdout=out)
+        return out.getvalue()
+
+    def command_logs(self):
+        return ActivityLog.objects.filter(action_type='device_control').count()
+
+    def test_interrupted_run_resumes(self):
+        write_chunk = utils._write_chunk
+        calls = []
+
+        def crash_on_second_chunk(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('killed')
+            return write_chunk(*args)
+
+        utils.plan_backfill('devicecommand')
+        with mock.patch('core.utils._write_chunk', side_effect=crash_on_second_chunk):
+            with self.assertRaises(RuntimeError):
+                utils.backfill_range('devicecommand', 0, chunk_size=2)
+        self.assertEqual(self.command_logs(), 2)
+
+        self.assertIn('resuming', self.backfill())
+        self.assertEqual(self.command_logs(), 5)
+        last = DeviceCommand.objects.aggregate(last=Max('id'))['last']
+        self.assertEqual(MaintenanceCheckpoint.objects.get(name='activity_backfill:devicecommand').state, {'high_water': last})
+
+    def test_finished_backfill_is_final(self):
+        self.backfill()
+        self.assertEqual(self.command_logs(), 5)
+
+        # Created after the backfill, so the live path has logged it already
+        DeviceCommand.objects.create(device=self.device, controller=self.controller, action='off', is_executed=True)
+        ActivityLog.objects.create(user=self.device.owner, device=self.device, action_type='device_control', message='Device turned off')
+
+        self.assertIn('already backfilled', self.backfill())
+        self.assertEqual(self.command_logs(), 6)
+
+    def test_empty_table_is_final(self):
+        DeviceCommand.objects.all().delete()
+        self.assertIn('already backfilled through id 0', self.backfill())
+        DeviceCommand.objects.create(device=self.device, controller=self.controller, action='on', is_executed=True)
+        self.backfill()
+        self.assertEqual(self.command_logs(), 0)
+
+class PairingCodeAllocatorTests(TestCase):
+    """Pairing codes come from the block bitmaps and go back to them"""
+
+    def used(self, code):
+        block = PairingCodeBlock.objects.get(block=int(code) // BLOCK_SIZE)
+        return bool(int.from_bytes(bytes(block.bitmap), 'little') >> int(code) % BLOCK_SIZE & 1)
+
+    def test_allocate_and_release(self):
+        code = allocate_pairing_code()
+        self.assertRegex(code, r'^\d{6}$')
+        self.assertTrue(self.used(code))
+        self.assertEqual(PairingCodeBlock.objects.get(block=int(code) // BLOCK_SIZE).free_count, BLOCK_SIZE - 1)
+
+        self.assertTrue(release_pairing_code(code))
+        self.assertFalse(self.used(code))
+        self.assertFalse(release_pairing_code(code))
+        self.assertFalse(release_pairing_code('legacy-1'))
+
+    def test_bulk_codes_are_unique(self):
+        codes = allocate_pairing_codes(2500)
+        self.assertEqual(len(set(codes)), 2500)
+        self.assertTrue(all(self.used(code) for code in codes[:50]))
+
+    def test_exhaustion(self):
+        PairingCodeBlock.objects.exclude(block=7).update(free_count=0)
+        full = (1 << BLOCK_SIZE) - 1
+        # Only codes 007998 and 007999 are left
+        PairingCodeBlock.objects.filter(block=7).update(
+            bitmap=(full >> 2).to_bytes(BLOCK_SIZE // 8, 'little'), free_count=2
+        )
+        self.assertEqual(sorted(allocate_pairing_codes(2)), ['007998', '007999'])
+        with self.assertRaises(PairingCodesExhausted):
+            allocate_pairing_code()
+        with self.assertRaises(PairingCodesExhausted):
+            allocate_pairing_codes(1)
+
+        release_pairing_code('007999')
+        self.assertEqual(allocate_pairing_code(), '007999')
+
+    def test_conflict_retry(self):
+        save_block = pairing._save_block
+        calls = []
+
+        def lose_first_race(block, used):
+            calls.append(block.version)
+            if len(calls) == 1:
+                # Someone else took a code from this block meanwhile
+                PairingCodeBlock.objects.filter(block=block.block).update(version=block.version + 1)
+                return 0
+            return save_block(block, used)
+
+        with mock.patch('core.pairing._save_block', side_effect=lose_first_race):
+            code = allocate_pairing_code()
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(self.used(code))
+        self.assertEqual(self.used_count(), 1)
+
+        with mock.patch('core.pairing._save_block', return_value=0) as always_lost, \
+                mock.patch.object(pairing, 'MAX_CONFLICT_RETRIES', 3):
+            with self.assertRaises(RuntimeError):
+                allocate_pairing_code()
+        self.assertEqual(always_lost.call_count, 3)
+
+    def used_count(self):
+        return sum(BLOCK_SIZE - free for free in PairingCodeBlock.objects.values_list('free_count', flat=True))
+
+    def test_failed_save_releases_code(self):
+        Device.objects.create(device_id='ESP-PAIR-fan', name='fan')
+        self.assertEqual(self.used_count(), 1)
+
+        duplicate = Device(device_id='ESP-PAIR-fan', name='fan')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            duplicate.save()
+        self.assertEqual(duplicate.pairing_code, '')
+        self.assertEqual(self.used_count(), 1)
+
+    def test_regenerate_releases_previous_code(self):
+        device = Device.objects.create(device_id='ESP-PAIR-light1', name='light1')
+        old_code = device.pairing_code
+        device.generate_pairing_code()
+        device.save(update_fields=['pairing_code'])
+
+        device.refresh_from_db()
+        self.assertNotEqual(device.pairing_code, old_code)
+        self.assertTrue(self.used(device.pairing_code))
+        self.assertFalse(self.used(old_code))
+        self.assertEqual(self.used_count(), 1)
+
+    def test_admin_cannot_edit_pairing_code(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        device = Device.objects.create(device_id='ESP-PAIR-kitchen', name='kitchen', hardware_pin='kitchen')
+        response = self.client.get(f'/admin/core/device/{device.pk}/change/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('pairing_code', response.context['adminform'].form.fields)
+
+
+class ProvisionFleetTests(TestCase):
+    """provision_fleet skips pins another device already holds instead of failing the run"""
+
+    def test_pin_held_under_another_device_id(self):
+        controller = Controller.objects.create(controller_id='ESP-PROV')
+        Device.objects.create(device_id='legacy-kitchen', name='kitchen', hardware_pin='kitchen', controller=controller)
+        manifest = Path(tempfile.mkdtemp(prefix='provision-test-')) / 'fleet.csv'
+        self.addCleanup(shutil.rmtree, manifest.parent, ignore_errors=True)
+        manifest.write_text(
+            'controller_id,controller_name,hardware_pin,type,device_name\n'
+            'ESP-PROV,Home,kitchen,socket,Kitchen\n'
+            'ESP-PROV,Home,living,socket,Living\n'
+            'ESP-NEW1,New,kitchen,socket,Kitchen\n'
+        )
+
+        out, err = StringIO(), StringIO()
+        call_command('provision_fleet', str(manifest), stdout=out, stderr=err)
+
+        self.assertIn('Skipped ESP-PROV-kitchen: its controller pin is already held by device legacy-kitchen', err.getvalue())
+        self.assertEqual(
+            sorted(Device.objects.values_list('device_id', flat=True)),
+            ['ESP-NEW1-kitchen', 'ESP-PROV-living', 'legacy-kitchen']
+        )
+
+
+class FixHardwarePinsTests(TestCase):
+    """Missing pins are only refused when they collide on the same controller"""
+
+    def test_unassigned_devices_do_not_collide(self):
+        controller = Controller.objects.create(controller_id='ESP-PINS')
+        Device.objects.create(device_id='ESP-PINS-kitchen', name='kitchen', hardware_pin='kitchen', controller=controller)
+        Device.objects.create(device_id='ESP-PINS-2-kitchen', name='kitchen 2', hardware_pin='-', controller=controller)
+        Device.objects.create(device_id='ESP-AAAA-kitchen', name='a')
+        Device.objects.create(device_id='ESP-BBBB-kitchen', name='b')
+        # save() derives a pin from the device_id; blank them as legacy rows were
+        Device.objects.exclude(device_id='ESP-PINS-kitchen').update(hardware_pin='')
+
+        out = StringIO()
+        call_command('fix_hardware_pins', '--dry-run', '--json', '-', stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(sorted(fix['device_id'] for fix in report['fixes']), ['ESP-AAAA-kitchen', 'ESP-BBBB-kitchen'])
+        self.assertEqual([entry['device_id'] for entry in report['unresolved']], ['ESP-PINS-2-kitchen'])
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    WEBSOCKET_PRESENCE_CACHE='default',
+)
+class PresenceTests(TransactionTestCase):
+    """Open sockets are counted per user, and sends to users with none are skipped"""
+
+    email = 'presence@example.com'
+
+    def setUp(self):
+        clear_caches()
+        metrics.reset()
+        UserProfile.objects.create(full_name='Presence User', email=self.email)
+
+    async def open_socket(self):
+        communicator = WebsocketCommunicator(DeviceStatusConsumer.as_asgi(), f'/ws/devices/?email={self.email}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # Initial state
+        return communicator
+
+    def test_connect_and_disconnect_counts(self):
+        async def scenario():
+            first, second = await self.open_socket(), await self.open_socket()
+            self.assertEqual(await cache.aget(presence_key(self.email)), 2)
+            await first.disconnect()
+            self.assertEqual(await cache.aget(presence_key(self.email)), 1)
+            self.assertTrue(await ais_online(self.email))
+            await second.disconnect()
+            self.assertEqual(await cache.aget(presence_key(self.email)), 0)
+            self.assertFalse(await ais_online(self.email))
+
+        async_to_sync(scenario)()
+
+    def test_send_skipped_without_socket(self):
+        self.assertFalse(is_online(self.email))
+        send_device_status_update(self.email, 'ESP-PRES-kitchen', 'on')
+        self.assertEqual(metrics.get('websocket.sends_skipped_offline.device_status'), 1)
+        self.assertEqual(metrics.get('websocket.sends'), 0)
+
+        async def scenario():
+            socket = await self.open_socket()
+            await sync_to_async(send_device_status_update)(self.email, 'ESP-PRES-kitchen', 'off')
+            message = await socket.receive_json_from()
+            self.assertEqual((message['type'], message['data']['status']), ('device_status', 'off'))
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(metrics.get('websocket.sends'), 1)
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}})
+    def test_process_local_counts_are_not_trusted(self):
+        # Another worker may hold the user's socket, so a local zero means nothing
+        self.assertTrue(is_online(self.email))
+
+    @override_settings(
+        CACHES={**TEST_CACHES, 'dummy': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+        WEBSOCKET_PRESENCE_CACHE='dummy',
+    )
+    def test_dummy_cache_is_not_tracked(self):
+        # It never stores the count, so the in-memory layer does not make a zero trustworthy
+        self.assertTrue(is_online(self.email))
+        self.assertTrue(async_to_sync(ais_online)(self.email))
+        send_device_status_update(self.email, 'ESP-PRES-kitchen', 'on')
+        self.assertEqual(metrics.get('websocket.sends_skipped_offline'), 0)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    WEBSOCKET_PRESENCE_CACHE='default',
+)
+class PreEncodedPayloadTests(TransactionTestCase):
+    """Send helpers encode the client JSON once; consumers forward it verbatim"""
+
+    email = 'payload@example.com'
+
+    def setUp(self):
+        clear_caches()
+        UserProfile.objects.create(full_name='Payload User', email=self.email)
+
+    def test_encode_channel_message(self):
+        message = {'type': 'device_status', 'seq': 7, 'data': {'status': 'on'}}
+        self.assertEqual(encode_channel_message(message), {'type': 'device_status', 'seq': 7, 'text': json.dumps(message)})
+
+    def test_sockets_receive_the_same_text(self):
+        async def scenario():
+            sockets = []
+            for _ in range(2):
+                socket = WebsocketCommunicator(DeviceStatusConsumer.as_asgi(), f'/ws/devices/?email={self.email}')
+                self.assertTrue((await socket.connect())[0])
+                await socket.receive_from()  # Initial state
+                sockets.append(socket)
+
+            with mock.patch('core.consumers.json.dumps', wraps=json.dumps) as dumps:
+                await sync_to_async(send_device_status_update)(self.email, 'ESP-PAYL-kitchen', 'on')
+                texts = [await socket.receive_from() for socket in sockets]
+            # The helper's one encoding; the consumers added none
+            self.assertEqual(dumps.call_count, 1)
+            self.assertEqual(texts[0], texts[1])
+            self.assertEqual(json.loads(texts[0])['data']['status'], 'on')
+            for socket in sockets:
+                await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_forward_sends_text_verbatim(self):
+        consumer = DeviceStatusConsumer()
+        consumer.send = mock.AsyncMock()
+        async_to_sync(consumer.forward)({'type': 'device_status', 'seq': None, 'text': '{"pre": "encoded"}'})
+        consumer.send.assert_awaited_once_with(text_data='{"pre": "encoded"}')
+
+        # Events from elsewhere without pre-encoded text are still serialized
+        consumer.send.reset_mock()
+        async_to_sync(consumer.forward)({'type': 'device_status', 'data': {}})
+        self.assertEqual(json.loads(consumer.send.await_args.kwargs['text_data'])['type'], 'device_status')
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    WEBSOCKET_PRESENCE_CACHE='default',
+    WEBSOCKET_REPLAY_BUFFER=3,
+)
+class EventReplayTests(TransactionTestCase):
+    """Reconnecting clients get the events they missed, or a snapshot when those are gone"""
+
+    email = 'replay@example.com'
+
+    def setUp(self):
+        clear_caches()
+        UserProfile.objects.create(full_name='Replay User', email=self.email)
+
+    async def connect(self, since=None):
+        path = f'/ws/devices/?email={self.email}' + (f'&since={since}' if since is not None else '')
+        socket = WebsocketCommunicator(DeviceStatusConsumer.as_asgi(), path)
+        self.assertTrue((await socket.connect())[0])
+        return socket
+
+    def record(self, status):
+        return record_event(self.email, {'type': 'device_status', 'data': {'status': status}})['seq']
+
+    def test_replay_hit(self):
+        first = self.record('on')
+        self.record('off')
+
+        async def scenario():
+            socket = await self.connect(since=first)
+            replayed = await socket.receive_json_from()
+            self.assertEqual((replayed['seq'], replayed['data']['status']), (first + 1, 'off'))
+            self.assertEqual(await socket.receive_json_from(), {'type': 'resumed', 'seq': first + 1, 'replayed': 1})
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_replay_miss_sends_snapshot(self):
+        first = self.record('on')
+        for _ in range(4):
+            latest = self.record('off')
+
+        async def scenario():
+            # More events than the buffer holds have been sent since
+            socket = await self.connect(since=first)
+            snapshot = await socket.receive_json_from()
+            self.assertEqual((snapshot['type'], snapshot['seq']), ('snapshot', latest))
+            await socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_forward_skips_events_covered_by_sync_point(self):
+        consumer = DeviceStatusConsumer()
+        consumer.send = mock.AsyncMock()
+        consumer.sync_seq = 10
+        for seq in (9, 10, 12, 11, None):
+            async_to_sync(consumer.forward)({'type': 'device_status', 'seq': seq, 'text': f'event {seq}'})
+        self.assertEqual(
+            [call.kwargs['text_data'] for call in consumer.send.await_args_list], ['event 12', 'event 11', 'event None']
+        )
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}})
+    def test_unshared_cache_always_snapshots(self):
+        # Another worker's events would be numbered by its own counter
+        message = record_event(self.email, {'type': 'device_status'})
+        self.assertNotIn('seq', message)
+        self.assertIsNone(replay_since(self.email, 0))
+        self.assertEqual(build_state_snapshot(UserProfile.objects.get(email=self.email))[0], 0)
+
+class LocalChannelLayerTests(SimpleTestCase):
+    """Two layer instances (two workers) share one broker and survive losing it"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = str(Path(self.directory) / 'channels.sock')
+
+    def tearDown(self):
+        broker = channel_layers._brokers.get(self.path)
+        if broker is not None:
+            broker.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 5)
+
+    async def round_trip(self, layer, channel):
+        # Everything the layer sent before is processed by the broker once this comes back
+        await layer.send(channel, {'type': 'ping'})
+        self.assertEqual(await self.receive(layer, channel), {'type': 'ping'})
+
+    def test_send_and_group_fan_out_across_instances(self):
+        async def scenario():
+            first, second = LocalChannelLayer(path=self.path), LocalChannelLayer(path=self.path)
+            first_channel, second_channel = await first.new_channel(), await second.new_channel()
+
+            await second.send(first_channel, {'type': 'hello', 'n': 1})
+            self.assertEqual(await self.receive(first, first_channel), {'type': 'hello', 'n': 1})
+
+            await first.group_add('devices', first_channel)
+            await second.group_add('devices', second_channel)
+            await self.round_trip(first, first_channel)
+            await self.round_trip(second, second_channel)
+            await first.group_send('devices', {'type': 'status', 'state': 'on'})
+            self.assertEqual(await self.receive(first, first_channel), {'type': 'status', 'state': 'on'})
+            self.assertEqual(await self.receive(second, second_channel), {'type': 'status', 'state': 'on'})
+
+            await second.group_discard('devices', second_channel)
+            await self.round_trip(second, second_channel)
+            await second.group_send('devices', {'type': 'status', 'state': 'off'})
+            self.assertEqual(await self.receive(first, first_channel), {'type': 'status', 'state': 'off'})
+            self.assertTrue(second.queues.get(second_channel) is None)
+            await first.close()
+            await second.close()
+
+        async_to_sync(scenario)()
+
+    def test_broker_failover(self):
+        async def scenario():
+            first, second = LocalChannelLayer(path=self.path), LocalChannelLayer(path=self.path)
+            first_channel, second_channel = await first.new_channel(), await second.new_channel()
+            await first.group_add('devices', first_channel)
+            await second.group_add('devices', second_channel)
+            await self.round_trip(first, first_channel)
+            await self.round_trip(second, second_channel)
+
+            old_broker = channel_layers._brokers[self.path]
+            await asyncio.get_running_loop().run_in_executor(None, old_broker.stop)
+
+            # Sends wait for the reconnect instead of going into the dead socket
+            await self.round_trip(first, first_channel)
+            await self.round_trip(second, second_channel)
+            self.assertIsNot(channel_layers._brokers[self.path], old_broker)
+
+            # Group memberships were restored on the new broker
+            await second.group_send('devices', {'type': 'status', 'state': 'on'})
+            self.assertEqual(await self.receive(first, first_channel), {'type': 'status', 'state': 'on'})
+            self.assertEqual(await self.receive(second, second_channel), {'type': 'status', 'state': 'on'})
+            await first.close()
+            await second.close()
+
+        async_to_sync(scenario)()
+
+    def test_connection_per_event_loop(self):
+        layer = LocalChannelLayer(path=self.path)
+        channel = async_to_sync(layer.new_channel)()
+        # Each async_to_sync call outside a loop runs on a new loop that is then closed
+        async_to_sync(layer.send)(channel, {'type': 'first'})
+        async_to_sync(layer.send)(channel, {'type': 'second'})
+        self.assertLessEqual(len(layer.connections), 1)
+
+        async def scenario():
+            self.assertEqual(await self.receive(layer, channel), {'type': 'first'})
+            self.assertEqual(await self.receive(layer, channel), {'type': 'second'})
+            await layer.close()
+
+        async_to_sync(scenario)()
+        self.assertEqual(len(layer.connections), 0)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    WEBSOCKET_PRESENCE_CACHE='default',
+)
+class AsyncESP32ViewParityTests(TestCase):
+    """The async ESP32 views answer and write exactly like the sync ones"""
+
+    def setUp(self):
+        clear_caches()
+        command_queues.reload()
+        # Batched writes are applied after each request, inside the test's transaction
+        self.batched = {command_queue._persist_batch: [], coalescing._persist_batch: []}
+        for writer, persist in [(command_queue.command_writer, command_queue._persist_batch),
+                                (coalescing.heartbeat_writer, coalescing._persist_batch)]:
+            patcher = mock.patch.object(writer, 'submit', side_effect=self.batched[persist].append)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def flush_batched(self):
+        for persist, items in self.batched.items():
+            if items:
+                persist(list(items))
+                items.clear()
+
+    def run_session(self, mode, controller_id):
+        metrics.reset()
+        user = UserProfile.objects.create(full_name='Parity User', email=f'{mode}@example.com')
+        room = Room.objects.create(name='Kitchen', owner=user)
+        controller = Controller.objects.create(controller_id=controller_id, owner=user, room=room)
+        devices = [
+            Device.objects.create(
+                device_id=f'{controller_id}-{pin}', name=pin, type=device_type, controller=controller,
+                owner=user, room=room, is_paired=True, hardware_pin=pin
+            )
+            for pin, device_type in [('kitchen', 'socket'), ('living', 'socket'), ('light1', 'light')]
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            commands = [
+                DeviceCommand.objects.create(device=devices[i], controller=controller, action=action)
+                for i, action in enumerate(['on', 'off', 'on'])
+            ]
+
+        def call(sync_view, async_view, path, data=None):
+            factory = RequestFactory() if mode == 'sync' else AsyncRequestFactory()
+            if data is None:
+                request = factory.get(path)
+            else:
+                request = factory.post(path, data=json.dumps(data), content_type='application/json')
+            with self.captureOnCommitCallbacks(execute=True):
+                if mode == 'sync':
+                    response = sync_view.as_view()(request)
+                    response.render()
+                else:
+                    response = async_to_sync(async_view.as_view())(request)
+            self.flush_batched()
+            body = json.loads(response.content)
+            body.pop('timestamp', None)
+            # Depends on measured latency
+            self.assertIsInstance(body.pop('next_poll_ms', 0), int)
+            for command in body.get('commands', []):
+                command['command_id'] = [c.id for c in commands].index(command['command_id'])
+                command.pop('created_at')
+            if body.get('command_id') in [c.id for c in commands]:
+                body['command_id'] = [c.id for c in commands].index(body['command_id'])
+            return response.status_code, body
+
+        report = {
+            'kitchen': True, 'living': False, 'light1': True,
+            'kitchen_current': 1.5, 'living_current': 0.0, 'kitchen_fault_detected': False,
+        }
+        tripped = dict(report, kitchen_current=2.0, kitchen_fault_detected=True, kitchen_lockout_type='overload')
+        poll, status_report, executed = (
+            (views.DeviceCommandsView, async_views.AsyncDeviceCommandsView),
+            (views.DeviceStatusView, async_views.AsyncDeviceStatusView),
+            (views.DeviceCommandExecutedView, async_views.AsyncDeviceCommandExecutedView),
+        )
+        responses = [
+            call(*poll, f'/api/devices/commands/?controller_id={controller_id}'),
+            call(*poll, '/api/devices/commands/'),
+            call(*poll, '/api/devices/commands/?controller_id=ESP-MISSING'),
+            call(*status_report, '/api/devices/status/', {'controller_id': controller_id, 'device_status': report}),
+            call(*status_report, '/api/devices/status/', {'controller_id': controller_id, 'device_status': tripped}),
+            call(*status_report, '/api/devices/status/', {'controller_id': 'ESP-MISSING', 'device_status': report}),
+            call(*executed, '/api/devices/commands/executed/', {'command_id': commands[1].id, 'result': 'success'}),
+            call(*executed, '/api/devices/commands/executed/', {'command_id': commands[2].id, 'result': 'error'}),
+            call(*executed, '/api/devices/commands/executed/', {'command_id': 999999}),
+        ]
+        state = {
+            'devices': [
+                (device.hardware_pin, device.status, device.current_value, device.previous_fault_state,
+                 device.current_sampled_at is not None)
+                for device in Device.objects.filter(controller=controller).order_by('hardware_pin')
+            ],
+            'commands': [
+                (command.action, command.status, command.is_executed, command.acked_at is not None)
+                for command in DeviceCommand.objects.filter(controller=controller).order_by('id')
+            ],
+            'alerts': sorted(DeviceAlert.objects.filter(controller=controller).values_list('alert_type', 'message')),
+            'readings': CurrentReading.objects.filter(device__controller=controller).count(),
+            'buckets': EnergyBucket.objects.filter(device__controller=controller).count(),
+            'activity': ActivityLog.objects.filter(controller=controller).count(),
+            'online': Controller.objects.get(pk=controller.pk).is_online,
+            'coalesced': metrics.get('writes.coalesced'),
+        }
+        return responses, state
+
+    def test_same_responses_and_state(self):
+        sync_responses, sync_state = self.run_session('sync', 'ESP-SYNC')
+        async_responses, async_state = self.run_session('async', 'ESP-ASYN')
+        self.assertEqual(sync_responses, async_responses)
+        self.assertEqual(sync_state, async_state)
+        self.assertEqual(sync_state['alerts'], [('overload', 'Overload detected in kitchen')])
+
+    def test_devices_updated_by_changed_fields(self):
+        controller = Controller.objects.create(controller_id='ESP-FLDS')
+        for pin in ('kitchen', 'living', 'light1'):
+            Device.objects.create(
+                device_id=f'ESP-FLDS-{pin}', name=pin, controller=controller, hardware_pin=pin,
+                previous_fault_state={pin: False} if pin != 'light1' else None
+            )
+        report = {'kitchen': True, 'living': False, 'light1': True, 'living_current': 0.5}
+        request = AsyncRequestFactory().post(
+            '/api/devices/status/', data=json.dumps({'controller_id': 'ESP-FLDS', 'device_status': report}),
+            content_type='application/json'
+        )
+        abulk_update = Device.objects.abulk_update
+        with mock.patch.object(Device.objects, 'abulk_update', side_effect=abulk_update) as updates:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = async_to_sync(async_views.AsyncDeviceStatusView.as_view())(request)
+        self.assertEqual(response.status_code, 200)
+
+        written = {
+            tuple(call.args[1]): sorted(device.hardware_pin for device in call.args[0]) for call in updates.call_args_list
+        }
+        # last_seen rides along with any other write (see coalescing.heartbeats)
+        self.assertEqual(written, {
+            ('last_seen', 'status'): ['kitchen', 'light1'],
+            ('current_sampled_at', 'current_value', 'last_seen'): ['living'],
+        })
+
+
+class BatchDispatcherTests(SimpleTestCase):
+    """Queued items are processed in batches of at most batch_size, without waiting for a batch to fill"""
+
+    def make_dispatcher(self, batch_size=3, background=True):
+        self.batches = []
+        self.preparing = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+        def prepare(items):
+            self.preparing.set()
+            self.release.wait(5)
+            return list(items)
+
+        async def send(items):
+            self.batches.append(items)
+
+        return BatchDispatcher(f'test.dispatch.{id(self)}', prepare, send, background=lambda: background, batch_size=batch_size)
+
+    def test_lone_item_is_sent_promptly(self):
+        dispatcher = self.make_dispatcher()
+        dispatcher.submit('only')
+        self.assertTrue(dispatcher.flush(timeout=2))
+        self.assertEqual(self.batches, [['only']])
+
+    def test_backlog_is_split_by_batch_size(self):
+        dispatcher = self.make_dispatcher(batch_size=3)
+        self.release.clear()
+        dispatcher.submit(0)
+        self.assertTrue(self.preparing.wait(2))
+        # The thread is held in prepare() while the rest queue up behind it
+        for item in range(1, 8):
+            dispatcher.submit(item)
+        self.release.set()
+        self.assertTrue(dispatcher.flush(timeout=2))
+        self.assertEqual(self.batches, [[0], [1, 2, 3], [4, 5, 6], [7]])
+
+    def test_failed_batch_does_not_stop_the_thread(self):
+        dispatcher = self.make_dispatcher()
+        send = dispatcher.send
+
+        async def fail_once(items):
+            if items == ['bad']:
+                raise RuntimeError('layer down')
+            await send(items)
+
+        dispatcher.send = fail_once
+        errors = metrics.get(f'{dispatcher.name}.errors')
+        dispatcher.submit('bad')
+        self.assertTrue(dispatcher.flush(timeout=2))
+        dispatcher.submit('good')
+        self.assertTrue(dispatcher.flush(timeout=2))
+        self.assertEqual(self.batches, [['good']])
+        self.assertEqual(metrics.get(f'{dispatcher.name}.errors'), errors + 1)
+
+    def test_inline_when_not_in_background(self):
+        dispatcher = self.make_dispatcher(background=False)
+        dispatcher.submit('inline')
+        self.assertEqual(self.batches, [['inline']])
+        self.assertIsNone(dispatcher.thread)
+
+
+class WebSocketDispatchOnCommitTests(TestCase):
+    """Send helpers hand their message to the dispatcher only once the transaction commits"""
+
+    def setUp(self):
+        submit = mock.patch.object(websocket_utils.websocket_dispatcher, 'submit')
+        self.submit = submit.start()
+        self.addCleanup(submit.stop)
+
+    def test_nothing_sent_on_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                send_device_status_update('dispatch@example.com', 'ESP-DISP-fan', 'on')
+                raise RuntimeError('rolled back')
+        self.assertEqual(callbacks, [])
+        self.submit.assert_not_called()
+
+    def test_sent_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            send_device_status_update('dispatch@example.com', 'ESP-DISP-fan', 'on')
+            self.submit.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        [[(user_email, message)]] = [call.args for call in self.submit.call_args_list]
+        self.assertEqual(user_email, 'dispatch@example.com')
+        self.assertEqual((message['type'], message['data']['status']), ('device_status', 'on'))
+
+class PollIntervalAdvisorTests(SimpleTestCase):
+    """next_poll_ms follows the home's activity and stretches with server load"""
+
+    def setUp(self):
+        clear_caches()
+        self.advisor = PollIntervalAdvisor(
+            active_ms=500, watching_ms=2000, idle_ms=10000, max_ms=30000, target_latency=0.1, max_stretch=4.0,
+            alpha=1.0, jitter=0
+        )
+
+    def test_tiers(self):
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=False, owner_online=False), 10000)
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=False, owner_online=True), 2000)
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=True, owner_online=False), 500)
+
+        self.advisor.note_activity('ESP-POLL')
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=False, owner_online=False), 500)
+        self.assertEqual(self.advisor.next_poll_ms('ESP-OTHER', has_pending=False, owner_online=False), 10000)
+        self.assertEqual(async_to_sync(self.advisor.anext_poll_ms)('ESP-POLL', False, False), 500)
+
+    def test_activity_is_shared_between_workers(self):
+        async_to_sync(self.advisor.anote_activity)('ESP-POLL')
+        # Another worker's process-local cache knows nothing of it
+        caches['default'].clear()
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=False, owner_online=False), 500)
+        caches['shared'].clear()
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=False, owner_online=False), 10000)
+
+    def test_load_stretches_intervals(self):
+        self.advisor.observe_latency(0.25)
+        self.assertEqual(self.advisor.load_factor(), 2.5)
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=True, owner_online=False), 1250)
+
+        self.advisor.observe_latency(2.0)
+        self.assertEqual(self.advisor.load_factor(), 4.0)
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=False, owner_online=True), 8000)
+        # 10s idle x 4 is capped
+        self.assertEqual(self.advisor.next_poll_ms('ESP-POLL', has_pending=False, owner_online=False), 30000)
+
+        self.advisor.observe_latency(0.01)
+        self.assertEqual(self.advisor.load_factor(), 1.0)
+
+    def test_jitter_stays_in_range(self):
+        advisor = PollIntervalAdvisor(idle_ms=10000, jitter=0.1)
+        intervals = {advisor.next_poll_ms('ESP-POLL', has_pending=False, owner_online=False) for _ in range(50)}
+        self.assertTrue(all(9000 <= interval <= 11000 for interval in intervals))
+        self.assertGreater(len(intervals), 1)
+
+class HistogramTests(SimpleTestCase):
+    """Percentiles stay within half a bucket of the exact nearest-rank value"""
+
+    def assert_percentiles(self, values):
+        histogram = Histogram()
+        for value in values:
+            histogram.observe(value)
+        ordered = sorted(values)
+        for q in (50, 90, 95, 99, 99.9):
+            exact = ordered[math.ceil(q / 100 * len(ordered)) - 1]
+            # A bucket spans a factor of growth; its geometric middle is within sqrt(growth) of any member
+            self.assertLessEqual(abs(histogram.percentile(q) - exact) / exact, math.sqrt(histogram.growth) - 1, q)
+        self.assertEqual(histogram.count, len(values))
+        self.assertEqual(histogram.max, ordered[-1])
+        self.assertAlmostEqual(histogram.summary()['mean'], statistics.fmean(values))
+
+    def test_uniform(self):
+        rng = random.Random(1)
+        self.assert_percentiles([rng.uniform(0.01, 2.0) for _ in range(20000)])
+
+    def test_exponential(self):
+        rng = random.Random(2)
+        self.assert_percentiles([0.002 + rng.expovariate(1 / 0.25) for _ in range(20000)])
+
+    def test_lognormal_tail(self):
+        rng = random.Random(3)
+        self.assert_percentiles([rng.lognormvariate(-2, 1.5) for _ in range(20000)])
+
+    def test_small_and_empty(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertEqual(histogram.summary()['count'], 0)
+        for value in (0.0, 0.0005, 0.4):
+            histogram.observe(value)
+        # Values at or below the floor share the first bucket; no percentile exceeds the max seen
+        self.assertLess(histogram.percentile(50), 0.002)
+        self.assertLessEqual(histogram.percentile(100), 0.4)
+        self.assertGreater(histogram.percentile(100), 0.4 / math.sqrt(histogram.growth))
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    WEBSOCKET_PRESENCE_CACHE='default',
+)
+class CommandTimestampTests(TransactionTestCase):
+    """A command tapped in the app, polled, executed and delivered gets all four stage timestamps"""
+
+    email = 'latency@example.com'
+
+    def setUp(self):
+        clear_caches()
+        command_queues.reload()
+        # Batched writes run inline so they are in the database when the next request reads it
+        for writer, persist in [(command_queue.command_writer, command_queue._persist_batch),
+                                (coalescing.heartbeat_writer, coalescing._persist_batch)]:
+            patcher = mock.patch.object(writer, 'submit', side_effect=lambda item, persist=persist: persist([item]))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        user = UserProfile.objects.create(full_name='Latency User', email=self.email)
+        room = Room.objects.create(name='Kitchen', owner=user)
+        self.controller = Controller.objects.create(controller_id='ESP-LTCY', owner=user, room=room)
+        Device.objects.create(
+            device_id='ESP-LTCY-kitchen', name='Kitchen Socket', type='socket', controller=self.controller,
+            owner=user, room=room, is_paired=True, hardware_pin='kitchen'
+        )
+
+    def test_all_stages_stamped(self):
+        async def scenario():
+            socket = WebsocketCommunicator(DeviceStatusConsumer.as_asgi(), f'/ws/devices/?email={self.email}')
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+
+            post = sync_to_async(self.client.post)
+            response = await post(
+                '/api/devices/control/', {'device_id': 'ESP-LTCY-kitchen', 'action': 'on'}, content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+            command_id = response.json()['command_id']
+
+            response = await sync_to_async(self.client.get)('/api/devices/commands/', {'controller_id': 'ESP-LTCY'})
+            self.assertEqual([command['command_id'] for command in response.json()['commands']], [command_id])
+
+            response = await post(
+                '/api/devices/commands/executed/', {'command_id': command_id, 'result': 'success'},
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+            await socket.disconnect()
+            return command_id
+
+        command = DeviceCommand.objects.get(id=async_to_sync(scenario)())
+        self.assertEqual(command.status, 'completed')
+        self.assertIsNotNone(command.delivered_at)
+        self.assertLessEqual(command.created_at, command.claimed_at)
+        self.assertLessEqual(command.claimed_at, command.acked_at)
+        self.assertLessEqual(command.acked_at, command.delivered_at)
+        summary = latency_summary('ESP-LTCY')
+        self.assertEqual({stage: summary[stage]['count'] for stage in summary},
+                         {'claim': 1, 'execute': 1, 'deliver': 1, 'total': 1})
+
+
+@override_settings(
+    COMMAND_QUEUES_IN_MEMORY=True,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    WEBSOCKET_PRESENCE_CACHE='default',
+)
+class CommandQueueTests(TestCase):
+    """In-memory command queues follow committed state and write claims and timeouts with guards"""
+
+    def setUp(self):
+        command_queues.reload()
+        self.submitted = []
+        patcher = mock.patch.object(command_queue.command_writer, 'submit', side_effect=self.submitted.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        user = UserProfile.objects.create(full_name='Queue User', email='queue@example.com')
+        self.controller = Controller.objects.create(controller_id='ESP-QUEU', owner=user)
+        self.devices = [
+            Device.objects.create(
+                device_id=f'ESP-QUEU-{pin}', name=pin, hardware_pin=pin, controller=self.controller,
+                owner=user, is_paired=True
+            )
+            for pin in ('kitchen', 'living')
+        ]
+
+    def create_command(self, device, action='on'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return DeviceCommand.objects.create(device=device, controller=self.controller, action=action)
+
+    def queued_ids(self):
+        return [command['command_id'] for command in command_queues.poll(self.controller)]
+
+    def test_enqueued_when_transaction_commits(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            command = DeviceCommand.objects.create(device=self.devices[0], controller=self.controller, action='on')
+            self.assertIsNone(command_queues.get(command.id, 'ESP-QUEU'))
+        self.assertIsNone(command_queues.get(command.id, 'ESP-QUEU'))
+        for callback in callbacks:
+            callback()
+        self.assertEqual(command_queues.get(command.id, 'ESP-QUEU').action, 'on')
+
+    def test_ack_waits_for_commit(self):
+        command = self.create_command(self.devices[0])
+        self.assertEqual(self.queued_ids(), [command.id])
+
+        # A result that rolls back leaves the command queued
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    command_queues.ack_on_commit(command.id, 'ESP-QUEU')
+                    raise RuntimeError
+        self.assertIsNotNone(command_queues.get(command.id, 'ESP-QUEU'))
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(
+                '/api/devices/commands/executed/', {'command_id': command.id, 'result': 'success'},
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(command_queues.get(command.id, 'ESP-QUEU'))
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(command_queues.get(command.id, 'ESP-QUEU'))
+        self.assertEqual(self.queued_ids(), [])
+
+    def test_stale_head_failed(self):
+        stale, fresh = self.create_command(self.devices[0]), self.create_command(self.devices[1], 'off')
+        DeviceCommand.objects.filter(pk=stale.pk).update(created_at=timezone.now() - timedelta(minutes=1))
+        command_queues.reload()
+
+        self.assertEqual(self.queued_ids(), [fresh.id])
+        self.assertEqual(sorted((kind, command_id) for kind, command_id, _ in self.submitted),
+                         [('claim', fresh.id), ('fail', stale.id)])
+        command_queue._persist_batch(self.submitted)
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, stale.is_executed), ('failed', True))
+        self.assertEqual((fresh.status, fresh.is_executed), ('executing', False))
+        self.assertIsNotNone(fresh.claimed_at)
+        # Claimed entries are handed out again, but not claimed twice
+        self.assertEqual(self.queued_ids(), [fresh.id])
+        self.assertEqual(len(self.submitted), 2)
+
+    def test_persist_batch_guards(self):
+        pending, completed = self.create_command(self.devices[0]), self.create_command(self.devices[1])
+        executed_at = timezone.now()
+        DeviceCommand.objects.filter(pk=completed.pk).update(
+            status='completed', is_executed=True, executed_at=executed_at
+        )
+        later = executed_at + timedelta(seconds=1)
+        command_queue._persist_batch([
+            ('claim', pending.id, later), ('claim', completed.id, later), ('fail', completed.id, later),
+        ])
+        pending.refresh_from_db()
+        completed.refresh_from_db()
+        self.assertEqual((pending.status, pending.claimed_at), ('executing', later))
+        # A late claim or timeout never undoes the result the controller reported
+        self.assertEqual((completed.status, completed.executed_at, completed.claimed_at),
+                         ('completed', executed_at, None))
+
+        command_queue._persist_batch([('fail', pending.id, later)])
+        pending.refresh_from_db()
+        self.assertEqual((pending.status, pending.is_executed), ('failed', True))
+
+    def test_rebuilt_from_database(self):
+        with self.captureOnCommitCallbacks():
+            # Never enqueued in this process, as if created before a restart
+            first = DeviceCommand.objects.create(device=self.devices[0], controller=self.controller, action='on')
+            DeviceCommand.objects.create(
+                device=self.devices[1], controller=self.controller, action='on', is_executed=True, status='completed'
+            )
+        second = self.create_command(self.devices[1], 'off')
+        self.assertEqual(self.queued_ids(), [first.id, second.id])
+
+        command_queues.reload()
+        self.assertIsNone(command_queues.get(first.id, 'ESP-QUEU'))
+        self.assertEqual(self.queued_ids(), [first.id, second.id])
+
+    def test_reload_after_admin_actions(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        command = self.create_command(self.devices[0])
+        self.assertEqual(self.queued_ids(), [command.id])
+        DeviceCommand.objects.filter(pk=command.pk).update(status='pending')
+
+        def admin_action(action):
+            response = self.client.post(
+                '/admin/core/devicecommand/', {'action': action, '_selected_action': [command.pk]}
+            )
+            self.assertEqual(response.status_code, 302)
+
+        admin_action('mark_executed')
+        self.assertEqual(self.queued_ids(), [])
+        admin_action('mark_pending')
+        self.assertEqual(self.queued_ids(), [command.id])
+
+
+class IdempotentEchoView(APIView):
+    """Counts its runs and answers with the status the test asks for"""
+
+    runs = 0
+
+    @idempotency.idempotent('test-echo')
+    def post(self, request):
+        IdempotentEchoView.runs += 1
+        return Response({'run': IdempotentEchoView.runs, 'echo': request.data.get('value')},
+                        status=int(request.data.get('status', 200)))
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    WEBSOCKET_PRESENCE_CACHE='default',
+)
+class IdempotencyTests(TestCase):
+    """Retries with an Idempotency-Key get the first response, per caller, without running again"""
+
+    def setUp(self):
+        clear_caches()
+        metrics.reset()
+        IdempotentEchoView.runs = 0
+        self.factory = APIRequestFactory()
+
+    def post(self, data, key='key-1', **extra):
+        request = self.factory.post('/api/echo/', data, format='json', HTTP_IDEMPOTENCY_KEY=key, **extra)
+        return IdempotentEchoView.as_view()(request)
+
+    def test_replay(self):
+        first = self.post({'email': 'a@example.com', 'value': 1})
+        retry = self.post({'email': 'a@example.com', 'value': 1})
+        self.assertEqual((retry.status_code, retry.data), (first.status_code, first.data))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(IdempotentEchoView.runs, 1)
+        self.assertEqual(metrics.get('idempotency.replays'), 1)
+
+        # From the database once the cache has forgotten it
+        clear_caches()
+        self.assertEqual(self.post({'email': 'a@example.com', 'value': 1}).data, first.data)
+        self.assertEqual(IdempotentEchoView.runs, 1)
+
+    def test_keys_are_per_caller(self):
+        self.post({'email': 'a@example.com', 'value': 1})
+        other = self.post({'email': 'b@example.com', 'value': 1})
+        self.assertEqual(other.data['run'], 2)
+        self.assertFalse(other.has_header('Idempotent-Replayed'))
+        self.assertEqual(IdempotencyRecord.objects.filter(key='key-1').count(), 2)
+        # Without an email the client address tells callers apart
+        self.post({'value': 1}, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(self.post({'value': 1}, REMOTE_ADDR='10.0.0.2').data['run'], 4)
+
+    def test_different_body_rejected(self):
+        self.post({'email': 'a@example.com', 'value': 1})
+        response = self.post({'email': 'a@example.com', 'value': 2})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(IdempotentEchoView.runs, 1)
+
+    def test_conflict_while_in_progress(self):
+        owner = 'email:a@example.com'
+        cache.add(idempotency.cache_key('test-echo', owner, 'key-1'), idempotency.IN_PROGRESS)
+        response = self.post({'email': 'a@example.com', 'value': 1})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(IdempotentEchoView.runs, 0)
+
+    def test_server_errors_not_stored(self):
+        self.assertEqual(self.post({'email': 'a@example.com', 'status': 503}).status_code, 503)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+        # The retry runs again, and its answer is the one kept
+        retry = self.post({'email': 'a@example.com', 'status': 503})
+        self.assertEqual((retry.status_code, IdempotentEchoView.runs), (503, 2))
+        self.assertIsNone(cache.get(idempotency.cache_key('test-echo', 'email:a@example.com', 'key-1')))
+
+    def test_device_control_not_repeated(self):
+        user = UserProfile.objects.create(full_name='Retry User', email='retry@example.com')
+        controller = Controller.objects.create(controller_id='ESP-IDEM', owner=user)
+        Device.objects.create(
+            device_id='ESP-IDEM-kitchen', name='Kitchen', hardware_pin='kitchen', controller=controller,
+            owner=user, is_paired=True
+        )
+        responses = [
+            self.client.post(
+                '/api/devices/control/', {'device_id': 'ESP-IDEM-kitchen', 'action': 'on'},
+                content_type='application/json', HTTP_IDEMPOTENCY_KEY='tap-1'
+            )
+            for _ in range(2)
+        ]
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        self.assertEqual(responses[0].json(), responses[1].json())
+        self.assertEqual(DeviceCommand.objects.filter(controller=controller).count(), 1)
+
+    def test_device_control_keyed_by_owner(self):
+        controllers = []
+        for name in ('owner', 'neighbour'):
+            user = UserProfile.objects.create(full_name=name, email=f'{name}@example.com')
+            controller = Controller.objects.create(controller_id=f'ESP-{name.upper()}', owner=user)
+            # Owned through the controller only
+            Device.objects.create(
+                device_id=f'ESP-{name.upper()}-kitchen', name='Kitchen', hardware_pin='kitchen', controller=controller,
+                is_paired=True
+            )
+            controllers.append(controller)
+
+        def tap(device_id, address):
+            return self.client.post(
+                '/api/devices/control/', {'device_id': device_id, 'action': 'on'},
+                content_type='application/json', HTTP_IDEMPOTENCY_KEY='tap-1', REMOTE_ADDR=address
+            )
+
+        first = tap('ESP-OWNER-kitchen', '10.0.0.1')
+        # The phone switched networks before retrying
+        retry = tap('ESP-OWNER-kitchen', '192.168.1.5')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), first.json())
+        # Someone else's device, same key and address: not a retry
+        self.assertFalse(tap('ESP-NEIGHBOUR-kitchen', '10.0.0.1').has_header('Idempotent-Replayed'))
+        self.assertEqual([DeviceCommand.objects.filter(controller=c).count() for c in controllers], [1, 1])
+        self.assertEqual(
+            sorted(IdempotencyRecord.objects.values_list('caller', flat=True)),
+            sorted(f'profile:{controller.owner_id}' for controller in controllers)
+        )
+
+    def test_expired_record_replaced_inside_transaction(self):
+        IdempotencyRecord.objects.create(
+            scope='test-echo', caller='email:a@example.com', key='key-1', request_hash='old', status_code=200, response={}
+        )
+        IdempotencyRecord.objects.update(created_at=timezone.now() - timedelta(days=2))
+        # Runs inside the test's transaction, like a view under ATOMIC_REQUESTS
+        self.assertEqual(self.post({'email': 'a@example.com', 'value': 1}).data['run'], 1)
+        record = IdempotencyRecord.objects.get()
+        self.assertEqual((record.response, record.status_code), ({'run': 1, 'echo': 1}, 200))
+
+
+class EnergyAccountingTests(TestCase):
+    """Reports are integrated into hourly and daily kWh buckets as they arrive"""
+
+    def setUp(self):
+        self.user = UserProfile.objects.create(full_name='Energy User', email='energy@example.com')
+        self.room = Room.objects.create(name='Kitchen', owner=self.user)
+        self.device = Device.objects.create(
+            device_id='ESP-ENRG-kitchen', name='Kettle', hardware_pin='kitchen', owner=self.user, room=self.room, is_paired=True
+        )
+        self.start = timezone.make_aware(datetime(2026, 3, 10, 10, 59))
+
+    def kwh(self, amps, seconds):
+        return amps * 230.0 * seconds / 3_600_000
+
+    def report(self, previous_amps, amps, seconds):
+        total = accumulate_energy(self.device, previous_amps, amps, self.start + timedelta(seconds=seconds))
+        self.device.save(update_fields=['current_sampled_at'])
+        return total
+
+    def test_split_at_hour_boundary(self):
+        pieces = split_interval(self.start, self.start + timedelta(minutes=2), 0.0, 2.0, 230.0)
+        self.assertEqual([start.hour for start, _ in pieces], [10, 11])
+        # Linear ramp: 0-1 A in the first minute, 1-2 A in the second
+        self.assertAlmostEqual(pieces[0][1], self.kwh(0.5, 60))
+        self.assertAlmostEqual(pieces[1][1], self.kwh(1.5, 60))
+
+    def test_trapezoid_into_hour_and_day_buckets(self):
+        self.assertEqual(self.report(None, 1.0, 0), 0)  # First sample only sets the baseline
+        self.assertAlmostEqual(self.report(1.0, 3.0, 120), self.kwh(2.0, 120))
+
+        buckets = dict(EnergyBucket.objects.filter(period='hour').values_list('start__hour', 'kwh'))
+        self.assertAlmostEqual(buckets[10], self.kwh(1.5, 60))
+        self.assertAlmostEqual(buckets[11], self.kwh(2.5, 60))
+        [day] = EnergyBucket.objects.filter(period='day')
+        self.assertAlmostEqual(day.kwh, self.kwh(2.0, 120))
+
+    @override_settings(ENERGY_MAX_SAMPLE_GAP=300)
+    def test_gap_restarts_integration(self):
+        self.report(None, 2.0, 0)
+        self.assertEqual(self.report(2.0, 2.0, 3600), 0)
+        self.assertFalse(EnergyBucket.objects.exists())
+        # Integration resumes from the sample after the gap
+        self.assertAlmostEqual(self.report(2.0, 2.0, 3660), self.kwh(2.0, 60))
+
+    def test_consumption_endpoint(self):
+        fan = Device.objects.create(device_id='ESP-ENRG-fan', name='Fan', owner=self.user, room=self.room, is_paired=True)
+        day = timezone.localtime(self.start).replace(hour=0, minute=0)
+        EnergyBucket.objects.create(device=self.device, period='day', start=day, kwh=1.5)
+        EnergyBucket.objects.create(device=fan, period='day', start=day + timedelta(days=1), kwh=0.25)
+        EnergyBucket.objects.create(device=fan, period='day', start=day + timedelta(days=5), kwh=9.0)
+
+        response = self.client.get('/api/energy/', {'email': self.user.email, 'start': '2026-03-10', 'end': '2026-03-11'})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['total_kwh'], 1.75)
+        self.assertEqual([(device['device_id'], device['kwh']) for device in body['devices']],
+                         [('ESP-ENRG-kitchen', 1.5), ('ESP-ENRG-fan', 0.25)])
+        self.assertEqual([(room['room_name'], room['kwh']) for room in body['rooms']], [('Kitchen', 1.75)])
+
+        bad = self.client.get('/api/energy/', {'email': self.user.email, 'start': '2026-03-11', 'end': '2026-03-10'})
+        self.assertEqual(bad.status_code, 400)
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    WEBSOCKET_PRESENCE_CACHE='default',
+)
+class CoalescedEnergyTests(TestCase):
+    """Coalescing heartbeat writes integrates the same kWh as writing every report"""
+
+    # (seconds, kitchen amps) every 5 s: steady stretches with a few steps between them. The
+    # last report changes the current, so everything held before it is integrated by the end.
+    REPORTS = [(i * 5, 1.0 if i < 30 else 3.0 if i < 70 else 0.5 if i < 100 else 2.25) for i in range(130)] + [(650, 0.0)]
+
+    def setUp(self):
+        metrics.reset()
+        patcher = mock.patch.object(
+            coalescing.heartbeat_writer, 'submit', side_effect=lambda item: coalescing._persist_batch([item])
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def report_all(self, controller_id, resolution):
+        user = UserProfile.objects.create(full_name='Energy User', email=f'{controller_id.lower()}@example.com')
+        controller = Controller.objects.create(controller_id=controller_id, owner=user)
+        device = Device.objects.create(
+            device_id=f'{controller_id}-kitchen', name='Kitchen', type='socket', hardware_pin='kitchen',
+            controller=controller, owner=user, is_paired=True
+        )
+        start = timezone.now().replace(minute=50, second=0, microsecond=0)
+        view = views.DeviceStatusView.as_view()
+        with mock.patch.object(coalescing.heartbeats, 'resolution', resolution):
+            for seconds, amps in self.REPORTS:
+                request = APIRequestFactory().post('/api/devices/status/', {
+                    'controller_id': controller_id,
+                    'device_status': {'kitchen': True, 'kitchen_current': amps},
+                }, format='json')
+                with mock.patch('django.utils.timezone.now', return_value=start + timedelta(seconds=seconds)):
+                    self.assertEqual(view(request).status_code, 200)
+        return dict(EnergyBucket.objects.filter(device=device, period='hour').values_list('start', 'kwh'))
+
+    def test_same_energy_as_per_report_writes(self):
+        every_report = self.report_all('ESP-EVRY', 0)
+        skipped_every_report = metrics.get('writes.coalesced')
+        coalesced = self.report_all('ESP-COAL', 60)
+        # Both the controller's and the device's heartbeats were held back
+        self.assertGreater(metrics.get('writes.coalesced') - 2 * skipped_every_report, 200)
+
+        # The run crosses an hour boundary, so both hours must match
+        self.assertEqual(sorted(every_report), sorted(coalesced))
+        self.assertEqual(len(every_report), 2)
+        for hour, kwh in every_report.items():
+            self.assertAlmostEqual(coalesced[hour], kwh, places=9)
+        expected = sum(
+            (a + b) / 2 * 230.0 * 5 / 3_600_000 for (_, a), (_, b) in zip(self.REPORTS, self.REPORTS[1:])
+        )
+        self.assertAlmostEqual(sum(every_report.values()), expected, places=9)
+
+
+class ActivityLogExportTests(TestCase):
+    """The export streams the filtered logs as CSV or NDJSON, optionally gzipped, under WSGI and ASGI"""
+
+    URL = '/api/logs/export/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(full_name='Export User', email='export@example.com')
+        device = Device.objects.create(device_id='ESP-EXPT-fan', name='Fan', owner=cls.user)
+        ActivityLog.objects.create(user=cls.user, device=device, log_type='error', message='Fan tripped')
+        ActivityLog.objects.create(user=cls.user, log_type='info', message='Logged in, "twice"')
+        other = UserProfile.objects.create(full_name='Other User', email='other-export@example.com')
+        ActivityLog.objects.create(user=other, log_type='error', message='Not yours')
+
+    def params(self, **extra):
+        return {'email': self.user.email, 'sort_order': 'asc', **extra}
+
+    def test_csv(self):
+        response = self.client.get(self.URL, self.params())
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], list(views.ActivityLogExportView.EXPORT_FIELDS))
+        self.assertEqual([row[4] for row in rows[1:]], ['Fan tripped', 'Logged in, "twice"'])
+        self.assertEqual(rows[1][7], 'ESP-EXPT-fan')
+
+    def test_ndjson_gzip_with_filter(self):
+        response = self.client.get(self.URL, self.params(export_format='ndjson', gzip='1', type='error'))
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertTrue(response['Content-Disposition'].endswith('.ndjson.gz"'))
+        records = [json.loads(line) for line in gzip.decompress(b''.join(response.streaming_content)).splitlines()]
+        self.assertEqual([record['message'] for record in records], ['Fan tripped'])
+        self.assertEqual(records[0]['device_name'], 'Fan')
+
+    def test_rejects_unknown_format(self):
+        self.assertEqual(self.client.get(self.URL, self.params(export_format='xml')).status_code, 400)
+
+    async def test_asgi_streams_async_iterator(self):
+        response = await self.async_client.get(self.URL, self.params(gzip='true', search='Logged'))
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        rows = list(csv.reader(gzip.decompress(body).decode().splitlines()))
+        self.assertEqual([row[4] for row in rows[1:]], ['Logged in, "twice"'])
+
+
+class QRCodeCacheTests(SimpleTestCase):
+    """Renders are kept in a bounded LRU backed by PNG files on disk"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='qr-cache-test-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        render = mock.patch('core.qr.render_qr_png', side_effect=lambda device_id, code, size: f'{device_id}|{code}'.encode())
+        self.render = render.start()
+        self.addCleanup(render.stop)
+
+    def test_lru_evicts_least_recently_used(self):
+        qr = QRCodeCache(max_entries=2)
+        for device_id in ('a', 'b', 'a', 'c'):
+            qr.get(device_id, '123456')
+        self.assertEqual(self.render.call_count, 3)
+        qr.get('a', '123456')
+        self.assertEqual(self.render.call_count, 3)
+        qr.get('b', '123456')
+        self.assertEqual(self.render.call_count, 4)
+
+    def test_disk_cache_survives_the_process_cache(self):
+        etag, png = QRCodeCache(root=self.root).get('ESP-QR-fan', '123456', 'thumb')
+        self.assertEqual(etag, qr_etag('ESP-QR-fan', '123456', 'thumb'))
+        self.assertEqual(QRCodeCache(root=self.root).get('ESP-QR-fan', '123456', 'thumb'), (etag, png))
+        self.assertEqual(self.render.call_count, 1)
+        # A new pairing code is a new key
+        QRCodeCache(root=self.root).get('ESP-QR-fan', '654321', 'thumb')
+        self.assertEqual(self.render.call_count, 2)
+
+
+class ControllerBulkQRTests(TestCase):
+    """The admin bulk QR action renders small selections and hands large ones to generate_qrcodes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.controller = Controller.objects.create(controller_id='ESP-BULK')
+        for pin in ('kitchen', 'living'):
+            Device.objects.create(device_id=f'ESP-BULK-{pin}', name=pin, controller=cls.controller)
+        cls.empty = Controller.objects.create(controller_id='ESP-EMPTY')
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+
+    def run_action(self, *controllers):
+        return self.client.post('/admin/core/controller/', {
+            'action': 'generate_bulk_qr',
+            '_selected_action': [controller.pk for controller in controllers],
+        }, follow=False)
+
+    def messages(self, response):
+        return [str(message) for message in response.wsgi_request._messages]
+
+    def test_small_selection_downloads_bundle(self):
+        response = self.run_action(self.controller)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as bundle:
+            self.assertEqual(
+                sorted(bundle.namelist()), ['ESP-BULK-kitchen.png', 'ESP-BULK-living.png', 'labels.pdf']
+            )
+
+    @override_settings(ADMIN_BULK_QR_LIMIT=1)
+    def test_large_selection_points_to_command(self):
+        response = self.run_action(self.controller, self.empty)
+        self.assertEqual(response.status_code, 302)
+        [message] = self.messages(response)
+        self.assertIn('generate_qrcodes --controller ESP-BULK --controller ESP-EMPTY', message)
+
+    def test_no_devices(self):
+        response = self.run_action(self.empty)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.messages(response), ['Selected controllers have no devices with pairing codes'])
+
+class DeviceAdminQRTests(TestCase):
+    """The changelist links to a cacheable QR image instead of inlining it"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.device = Device.objects.create(device_id='ESP-QR-kitchen', name='kitchen')
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+        qr_cache.clear()
+        self.url = f'/admin/core/device/{self.device.pk}/qr.png'
+
+    def test_changelist_links_image(self):
+        response = self.client.get('/admin/core/device/')
+        self.assertContains(response, f'{self.url}?v={qr_etag(self.device.device_id, self.device.pairing_code, "thumb")}')
+        self.assertNotContains(response, 'base64')
+
+    def test_image_etag_and_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response.content.startswith(b'\x89PNG'))
+        self.assertIn('max-age', response['Cache-Control'])
+        etag = response['ETag']
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, {'size': 'full'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        self.device.generate_pairing_code()
+        self.device.save(update_fields=['pairing_code'])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_missing_device(self):
+        self.assertEqual(self.client.get('/admin/core/device/999999/qr.png').status_code, 404)
@@ -1,7 +1,10 @@
+from django.conf import settings
 from django.urls import path
+from .async_views import AsyncDeviceCommandExecutedView, AsyncDeviceCommandsView, AsyncDeviceStatusView
 from .views import (
     DeviceCommandExecutedView,
     DeviceCommandStatusView,
+    CommandLatencyView,
     OnboardingStartView,
     PhoneVerificationView,
     RoomCreationView,
@@ -14,13 +17,27 @@ from .views import (
     DeviceAlertsView,
     DeviceListView,
     ActivityLogListView,
+    ActivityLogExportView,
     AlertDismissalView,
     DeviceManagementView,
     UserProfileUpdateView,
     EmergencyControlsView,
-    SystemSettingsView
+    SystemSettingsView,
+    EnergyConsumptionView,
+    ConsumptionAnalyticsView,
+    SystemMetricsView
 )
 
+# ESP32 polling endpoints, served natively on the event loop when enabled
+if settings.ASYNC_ESP32_VIEWS:
+    ESP32_COMMANDS_VIEW = AsyncDeviceCommandsView
+    ESP32_STATUS_VIEW = AsyncDeviceStatusView
+    ESP32_COMMAND_EXECUTED_VIEW = AsyncDeviceCommandExecutedView
+else:
+    ESP32_COMMANDS_VIEW = DeviceCommandsView
+    ESP32_STATUS_VIEW = DeviceStatusView
+    ESP32_COMMAND_EXECUTED_VIEW = DeviceCommandExecutedView
+
 urlpatterns = [
     # User Onboarding
     path('onboarding/start/', OnboardingStartView.as_view(), name='onboarding-start'),
@@ -31,10 +48,11 @@ urlpatterns = [
     
     # Controller Management
     path('devices/controller/register/', ControllerRegistrationView.as_view(), name='controller-register'),
-    path('devices/commands/', DeviceCommandsView.as_view(), name='device-commands'),
+    path('devices/commands/', ESP32_COMMANDS_VIEW.as_view(), name='device-commands'),
     path('devices/alerts/', DeviceAlertsView.as_view(), name='device-alerts'),
-    path('devices/commands/executed/', DeviceCommandExecutedView.as_view(), name='device_command_executed'),
+    path('devices/commands/executed/', ESP32_COMMAND_EXECUTED_VIEW.as_view(), name='device_command_executed'),
     path('devices/commands/<int:command_id>/status/', DeviceCommandStatusView.as_view(), name='command-status'),
+    path('devices/commands/latency/', CommandLatencyView.as_view(), name='command-latency'),
     
     
     # Device Management
@@ -42,13 +60,17 @@ urlpatterns = [
     path('devices/control/', DeviceControlView.as_view(), name='device-control'),
     path('devices/pairing/init/', DevicePairingInitView.as_view(), name='device-pairing-init'),
     path('devices/pairing/complete/', DevicePairingCompleteView.as_view(), name='device-pairing-complete'),
-    path('devices/status/', DeviceStatusView.as_view(), name='device-status'),
+    path('devices/status/', ESP32_STATUS_VIEW.as_view(), name='device-status'),
     path('logs/', ActivityLogListView.as_view(), name='activity_logs'),
+    path('logs/export/', ActivityLogExportView.as_view(), name='activity-logs-export'),
+    path('energy/', EnergyConsumptionView.as_view(), name='energy-consumption'),
+    path('analytics/consumption/', ConsumptionAnalyticsView.as_view(), name='consumption-analytics'),
 
     # Settings related endpoints
     path('profile/', UserProfileUpdateView.as_view(), name='user-profile'),
     path('devices/<str:device_id>/remove/', DeviceManagementView.as_view(), name='remove-device'),
     path('system/settings/', SystemSettingsView.as_view(), name='system-settings'),
     path('system/emergency/', EmergencyControlsView.as_view(), name='emergency-controls'),
+    path('system/metrics/', SystemMetricsView.as_view(), name='system-metrics'),
     path('alerts/dismiss/', AlertDismissalView.as_view(), name='dismiss-alert'),
 ]
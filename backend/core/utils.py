@@ -1,62 +1,178 @@
-def create_activity_logs_from_existing_data():
-    """
-    One-time function to create activity logs from existing DeviceCommand and DeviceAlert data
-    Run this in Django shell after adding the ActivityLog model
+from django.db import transaction
+from django.db.models import Max
+
+from .models import ActivityLog, DeviceAlert, DeviceCommand, MaintenanceCheckpoint
+
+ALERT_LOG_TYPES = {
+    'overload': 'warning',
+    'short_circuit': 'error',
+    'offline': 'warning',
+    'high_current': 'warning',
+}
+ALERT_TYPE_LABELS = dict(DeviceAlert.ALERT_TYPES)
+
+
+def _command_log(cmd):
+    # Always store device control logs as 'info'
+    return ActivityLog(
+        user_id=cmd.device.owner_id,
+        device_id=cmd.device_id,
+        controller_id=cmd.controller_id,
+        room_id=cmd.device.room_id,
+        log_type='info',
+        action_type='device_control',
+        message=f"Device turned {cmd.action}",
+        details=f"Command executed via {cmd.controller.name if cmd.controller else 'unknown controller'}",
+        source='system',
+        created_at=cmd.executed_at or cmd.created_at
+    )
+
+
+def _alert_log(alert):
+    return ActivityLog(
+        user_id=alert.device.owner_id,
+        device_id=alert.device_id,
+        controller_id=alert.controller_id,
+        room_id=alert.device.room_id,
+        log_type=ALERT_LOG_TYPES.get(alert.alert_type, 'warning'),
+        action_type='system_alert',
+        message=alert.message[:255],
+        details=f"Alert type: {ALERT_TYPE_LABELS.get(alert.alert_type, alert.alert_type)}",
+        source='system',
+        created_at=alert.created_at
+    )
+
+
+# Source table -> (model, relations to join, columns to load, row -> ActivityLog)
+BACKFILL_SOURCES = {
+    'devicecommand': (
+        DeviceCommand,
+        ('device', 'controller'),
+        ('action', 'created_at', 'executed_at', 'device__owner', 'device__room', 'controller__name'),
+        _command_log,
+    ),
+    'devicealert': (
+        DeviceAlert,
+        ('device',),
+        ('alert_type', 'message', 'created_at', 'controller', 'device__owner', 'device__room'),
+        _alert_log,
+    ),
+}
+
+
+def backfill_checkpoint_name(source, part=None):
+    name = f'activity_backfill:{source}'
+    return name if part is None else f'{name}:{part}'
+
+
+def plan_backfill(source, workers=1):
+    """Split the source's ids into ``workers`` ranges, up to the newest row at planning time.
+
+    An unfinished plan from an interrupted run is returned unchanged, so every
+    range resumes from its own progress marker. A finished backfill is final:
+    rows created since are logged by the live views, and backfilling them too
+    would duplicate their logs.
     """
-    from django.utils import timezone
-    from datetime import timedelta
-    from .models import DeviceCommand, DeviceAlert, ActivityLog  # adjust 'core' to your app name
-
-    print("Creating activity logs from existing device commands...")
-
-    # Create logs from DeviceCommands
-    commands = DeviceCommand.objects.all().order_by('created_at')
-    for cmd in commands:
-        if cmd.device and cmd.device.owner:
-            # Always store device control logs as 'info'
-            log_type = 'info'
-            message = f"Device turned {cmd.action}"
-            details = f"Command executed via {cmd.controller.name if cmd.controller else 'unknown controller'}"
-
-            ActivityLog.objects.create(
-                user=cmd.device.owner,
-                device=cmd.device,
-                controller=cmd.controller,
-                room=cmd.device.room,
-                log_type=log_type,
-                action_type='device_control',
-                message=message,
-                details=details,
-                source='system',
-                created_at=cmd.executed_at or cmd.created_at
-            )
+    model = BACKFILL_SOURCES[source][0]
+    checkpoint, _ = MaintenanceCheckpoint.objects.get_or_create(name=backfill_checkpoint_name(source))
+    if checkpoint.state.get('ranges'):
+        return checkpoint.state['ranges']
+    if 'high_water' in checkpoint.state:
+        return []
+
+    start = 1
+    end = model.objects.aggregate(last=Max('id'))['last'] or 0
+    if end < start:
+        checkpoint.state = {'high_water': 0}
+        checkpoint.save(update_fields=['state', 'updated_at'])
+        return []
 
-    
-
-    # Create logs from DeviceAlerts
-    alerts = DeviceAlert.objects.all().order_by('created_at')
-    for alert in alerts:
-        if alert.device and alert.device.owner:
-            # Map alert type to log_type
-            log_type_mapping = {
-                'overload': 'warning',
-                'short_circuit': 'error',
-                'offline': 'warning',
-                'high_current': 'warning',
-            }
-            log_type = log_type_mapping.get(alert.alert_type, 'warning')
-
-            ActivityLog.objects.create(
-                user=alert.device.owner,
-                device=alert.device,
-                controller=alert.controller,
-                room=alert.device.room,
-                log_type=log_type,
-                action_type='system_alert',
-                message=alert.message,
-                details=f"Alert type: {alert.get_alert_type_display()}",
-                source='system',
-                created_at=alert.created_at
+    step = -(-(end - start + 1) // max(workers, 1))
+    ranges = [[low, min(low + step - 1, end)] for low in range(start, end + 1, step)]
+    with transaction.atomic():
+        for part, (low, high) in enumerate(ranges):
+            MaintenanceCheckpoint.objects.update_or_create(
+                name=backfill_checkpoint_name(source, part),
+                defaults={'state': {'start': low, 'end': high, 'done_through': low - 1}}
             )
-    print("Creating activity logs from existing device alerts...")
+        checkpoint.state = {**checkpoint.state, 'ranges': ranges}
+        checkpoint.save(update_fields=['state', 'updated_at'])
+    return ranges
+
+
+def backfill_range(source, part, chunk_size=2000):
+    """Create activity logs for one planned id range; returns the number of logs written.
+
+    Rows are read a keyset page at a time, so no cursor stays open while a
+    chunk is written (on SQLite that would deadlock parallel workers). Each
+    chunk's logs and the range's progress marker are committed together,
+    so a crash never loses or duplicates a chunk.
+    """
+    model, related, columns, build_log = BACKFILL_SOURCES[source]
+    checkpoint = MaintenanceCheckpoint.objects.get(name=backfill_checkpoint_name(source, part))
+    end = checkpoint.state['end']
+    rows = (
+        model.objects.filter(id__lte=end, device__owner__isnull=False)
+        .select_related(*related)
+        .only(*related, *columns)
+        .order_by('id')
+    )
+
+    written = 0
+    while True:
+        chunk = list(rows.filter(id__gt=checkpoint.state['done_through'])[:chunk_size])
+        if not chunk:
+            break
+        written += _write_chunk(checkpoint, chunk, build_log)
+
+    if checkpoint.state['done_through'] < end:
+        checkpoint.state = {**checkpoint.state, 'done_through': end}
+        checkpoint.save(update_fields=['state', 'updated_at'])
+    return written
+
+
+def _write_chunk(checkpoint, rows, build_log):
+    logs = [build_log(row) for row in rows]
+    # created_at is auto_now_add, which bulk_create overwrites on the objects
+    # themselves; put the source timestamps back (bulk_update leaves them alone)
+    timestamps = [log.created_at for log in logs]
+    with transaction.atomic():
+        ActivityLog.objects.bulk_create(logs)
+        for log, created_at in zip(logs, timestamps):
+            log.created_at = created_at
+        ActivityLog.objects.bulk_update(logs, ['created_at'])
+
+        checkpoint.state = {**checkpoint.state, 'done_through': rows[-1].id}
+        checkpoint.save(update_fields=['state', 'updated_at'])
+    return len(logs)
+
+
+def finish_backfill(source):
+    """Record the backfill as finished (through its high-water mark) once every planned range is done"""
+    checkpoint = MaintenanceCheckpoint.objects.get(name=backfill_checkpoint_name(source))
+    ranges = checkpoint.state.get('ranges') or []
+    parts = MaintenanceCheckpoint.objects.filter(
+        name__in=[backfill_checkpoint_name(source, part) for part in range(len(ranges))]
+    )
+    if any(part.state['done_through'] < part.state['end'] for part in parts):
+        return False
+
+    with transaction.atomic():
+        parts.delete()
+        high_water = max([0] + [high for _, high in ranges])
+        checkpoint.state = {'high_water': high_water}
+        checkpoint.save(update_fields=['state', 'updated_at'])
+    return True
+
+
+def create_activity_logs_from_existing_data():
+    """
+    One-time function to create activity logs from existing DeviceCommand and DeviceAlert data.
+    Kept for the Django shell; `manage.py backfill_activity_logs` does the same in resumable chunks.
+    """
+    for source in BACKFILL_SOURCES:
+        print(f"Creating activity logs from existing {source} rows...")
+        for part, _ in enumerate(plan_backfill(source)):
+            backfill_range(source, part)
+        finish_backfill(source)
     print("Done creating activity logs.")
@@ -1,25 +1,44 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from .models import UserProfile, Room,ActivityLog, Device, Controller, DeviceCommand, DeviceAlert
+from rest_framework.permissions import IsAdminUser
+from .models import UserProfile, Room,ActivityLog, Device, Controller, DeviceCommand, DeviceAlert, EnergyBucket, CurrentReading
 from .serializers import (
     UserProfileSerializer,
     RoomSerializer,
     DeviceSerializer,
     DevicePairingSerializer
 )
+import csv
+import json
 import secrets
+import zlib
 from django.db import transaction
 from django.utils import timezone
-from django.utils.crypto import get_random_string
 from django.db import models
 from datetime import timedelta
 import logging
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from .websocket_utils import send_command_status_update, send_device_status_update, send_alert_notification
+from .energy import accumulate_energy
+from .analytics import get_consumption_analytics, invalidate_user_analytics
+from .anomaly import current_anomaly_detector
+from .metrics import metrics
+from .db_router import read_from_replica
+from .polling import poll_advisor
+from .command_latency import latency_summary, record_ack
+from .command_queue import command_queues
+from .presence import is_online
+from .coalescing import controller_seen, heartbeats
+from .idempotency import device_owner, idempotent, profile_owner
 from django.core.paginator import Paginator
-from datetime import timedelta
+from django.utils.decorators import method_decorator
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from datetime import timedelta, datetime, time
+from time import perf_counter
 
 logger = logging.getLogger(__name__)
 
@@ -104,7 +123,6 @@ class PhoneVerificationView(APIView):
                                 name='System Device',
                                 type='socket',
                                 controller=controller,
-                                pairing_code=get_random_string(6, '0123456789'),
                                 is_paired=True,
                                 hardware_pin='system'
                             )
@@ -228,7 +246,6 @@ class ControllerRegistrationView(APIView):
                         'type': device_type,
                         'controller': controller,
                         'hardware_pin': device_name,
-                        'pairing_code': get_random_string(6, '0123456789'),
                         'last_seen': timezone.now()
                     }
                 )
@@ -272,7 +289,6 @@ class DevicePairingInitView(APIView):
             device, created = Device.objects.get_or_create(
                 device_id=device_id,
                 defaults={
-                    'pairing_code': get_random_string(6, '0123456789'),
                     'name': f"Device {device_id[-4:]}",
                     'type': device_type
                 }
@@ -280,6 +296,7 @@ class DevicePairingInitView(APIView):
             
             if not created:
                 device.generate_pairing_code()
+                device.save(update_fields=['pairing_code'])
                 
             return Response({
                 'device_id': device.device_id,
@@ -412,6 +429,7 @@ class DevicePairingCompleteView(APIView):
 class DeviceCommandsView(APIView):
     def get(self, request, format=None):
         """ESP32 checks for pending commands"""
+        started = perf_counter()
         try:
             controller_id = request.query_params.get('controller_id')
 
@@ -422,56 +440,21 @@ class DeviceCommandsView(APIView):
                 )
             
             try:
-                controller = Controller.objects.select_related().get(controller_id=controller_id)
-
-                with transaction.atomic():
-                    controller.last_seen = timezone.now()
-                    controller.is_online = True
-                    controller.save(update_fields=['last_seen', 'is_online'])
-                
+                controller = Controller.objects.select_related('owner').get(controller_id=controller_id)
 
-                
-                self.cleanup_stale_commands(controller)
+                controller_seen(controller, timezone.now())
 
-                # Get pending commands
-                pending_commands = DeviceCommand.objects.filter(
-                    controller=controller,
-                    is_executed=False,
-                    status__in=['pending', 'executing']
-                ).order_by('created_at')[:10]
-
-                commands = []
-
-
-                with transaction.atomic():
-                    for cmd in pending_commands:
-
-                        if cmd.status == 'pending':
-                            cmd.status = 'executing'
-                            cmd.save(update_fields=['status'])
-
-                        if cmd.device:
-                            device_hardware_name = cmd.device.hardware_pin
-                            if not device_hardware_name:
-                                logger.warning(f"Device {cmd.device.device_id} has no hardware pin")
-                                device_hardware_name = 'unknown'
-                            commands.append({
-                                'command_id': cmd.id,
-                                'device_name': device_hardware_name,
-                                'action': cmd.action,
-                                'created_at': cmd.created_at
-                            })
-                        else:
-                            commands.append({
-                                'command_id': cmd.id,
-                                'device_name': '',
-                                'action': cmd.action,
-                                'created_at': cmd.created_at
-                            })
+                commands = command_queues.poll(controller)
 
+                poll_advisor.observe_latency(perf_counter() - started)
                 return Response({
                     'commands': commands,
-                    'timestamp': timezone.now().isoformat()
+                    'timestamp': timezone.now().isoformat(),
+                    'next_poll_ms': poll_advisor.next_poll_ms(
+                        controller.controller_id,
+                        has_pending=bool(commands),
+                        owner_online=bool(controller.owner) and is_online(controller.owner.email)
+                    )
                 }, status=status.HTTP_200_OK)
 
             except Controller.DoesNotExist:
@@ -487,28 +470,8 @@ class DeviceCommandsView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-    def cleanup_stale_commands(self, controller):
-        """Clean up stale commands more aggressively - 30 seconds"""
-        stale_cutoff = timezone.now() - timezone.timedelta(seconds=30)
-
-        with transaction.atomic():
-            stale_commands = DeviceCommand.objects.filter(
-                controller = controller,
-                is_executed = False,
-                created_at__lt = stale_cutoff
-            )
-
-            stale_count = stale_commands.count()
-            if stale_count > 0:
-                stale_commands.update(
-                    is_executed = True,
-                    status = 'failed',
-                    executed_at = timezone.now()
-                )
-                logger.info(f"Cleaned up {stale_count} stale commands for controller {controller.controller_id}")
-       
-
 class DeviceControlView(APIView):
+    @idempotent('device-control', owner=device_owner)
     def post(self, request, format=None):
         """Mobile app sends device control commands"""
         try:
@@ -583,6 +546,7 @@ class DeviceControlView(APIView):
                     action=action.lower(),
                     status='pending'
                 )
+                poll_advisor.note_activity(device.controller.controller_id)
 
                 #Immediately update device status (for UI responsiveness)
                 if action.lower() == 'on':
@@ -657,9 +621,20 @@ class DeviceCommandExecutedView(APIView):
             try:
                 with transaction.atomic():
                     command = DeviceCommand.objects.select_related('device', 'controller').get(id=command_id)
+                    queued = command_queues.get(command.id, command.controller.controller_id)
+                    command_queues.ack_on_commit(command.id, command.controller.controller_id)
+                    if queued and command.claimed_at is None:
+                        # The claim may still be waiting to be written
+                        command.claimed_at = queued.claimed_at
+                    first_ack = command.acked_at is None
                     command.is_executed = True
                     command.executed_at = timezone.now()
+                    if first_ack:
+                        command.acked_at = command.executed_at
                     command.status = 'completed' if execution_result == 'success' else 'failed'
+                    command.save(update_fields=['is_executed', 'executed_at', 'acked_at', 'claimed_at', 'status'])
+                    if first_ack:
+                        record_ack(command)
 
                     if command.device and execution_result == 'success':
                         if command.action == 'on':
@@ -728,6 +703,47 @@ class DeviceCommandExecutedView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+def raise_device_alert(device, controller, alert_type, message, dedupe_window=timedelta(minutes=1)):
+    """Create an alert, notify the owner and log it, unless the same alert was raised recently"""
+    recent_alert = DeviceAlert.objects.filter(
+        device=device,
+        alert_type=alert_type,
+        created_at__gte=timezone.now() - dedupe_window
+    ).first()
+
+    if recent_alert:
+        logger.info(f"Duplicate alert prevented: {alert_type} for {device.name}")
+        return None
+
+    alert = DeviceAlert.objects.create(
+        device=device,
+        controller=controller,
+        alert_type=alert_type,
+        message=message
+    )
+
+    # Send WebSocket alert notification
+    if device.owner:
+        send_alert_notification(
+            user_email=device.owner.email,
+            alert_type=alert_type,
+            title=f"{device.name} Alert",
+            message=message,
+            device_id=device.device_id
+        )
+
+    # Create activity log
+    ActivityLog.log_system_alert(
+        device=device,
+        alert_type=alert_type,
+        message=message,
+        details=f'Alert from controller {controller.controller_id}',
+        controller=controller
+    )
+
+    logger.info(f"New alert: {alert_type} for {device.name}")
+    return alert
+
 class DeviceStatusView(APIView):
     def post(self, request, format=None):
         """Endpoint for ESP32 to report status"""
@@ -746,11 +762,13 @@ class DeviceStatusView(APIView):
 
             try:
                 controller = Controller.objects.get(controller_id=controller_id)
-                controller.last_seen = timezone.now()
-                controller.is_online = True
-                controller.save()
+                now = timezone.now()
+                controller_seen(controller, now)
 
                 valid_hardware_pins = ['kitchen', 'living', 'light1', 'light2', 'fan']
+                readings = []
+                reading_owners = set()
+                current_anomalies = []
 
                 # FIXED: Update device statuses using hardware_pin matching
                 for hardware_pin, is_on in device_status.items():
@@ -764,7 +782,7 @@ class DeviceStatusView(APIView):
                         old_current = device.current_value  # Store old current value
                         
                         device.status = 'on' if is_on else 'off'
-                        device.last_seen = timezone.now()
+                        changed = ['status'] if device.status != old_status else []
 
                         # Update current values for sockets
                         current_changed = False
@@ -778,8 +796,39 @@ class DeviceStatusView(APIView):
                             if device.current_value != new_current:
                                 device.current_value = new_current
                                 current_changed = True
-
-                        device.save()
+                        if current_changed:
+                            changed.append('current_value')
+
+                        current_key = f'{hardware_pin}_current'
+                        if current_key in device_status:
+                            # Integrate energy since the previous report before the sample is overwritten.
+                            # A coalesced report carried the same current, so its share is
+                            # integrated exactly at the next write instead.
+                            if changed or heartbeats.due(device, now):
+                                accumulate_energy(
+                                    device, old_current, device_status[current_key], now,
+                                    steady_until=heartbeats.release(device)
+                                )
+                                changed.append('current_sampled_at')
+                            try:
+                                amps = float(device_status[current_key])
+                                readings.append(CurrentReading(
+                                    device=device,
+                                    recorded_at=now,
+                                    current=amps
+                                ))
+                                if device.owner_id:
+                                    reading_owners.add(device.owner_id)
+                                # Only a running load says anything about the appliance behind the socket
+                                observed = current_anomaly_detector.observe(device.pk, amps) if device.status == 'on' else []
+                                for kind, detail in observed:
+                                    current_anomalies.append((device, f'Unusual current in {device.name}: {detail}'))
+                            except (TypeError, ValueError):
+                                pass
+
+                        update_fields = heartbeats.seen_fields(device, now, changed)
+                        if update_fields:
+                            device.save(update_fields=update_fields)
 
                         # Send WebSocket notification if status OR current changed
                         if (old_status != device.status or current_changed) and device.owner:
@@ -795,8 +844,16 @@ class DeviceStatusView(APIView):
                         print(f"Device not found for controller {controller_id} and hardware_pin {hardware_pin}")
                         pass
 
+                if readings:
+                    CurrentReading.objects.bulk_create(readings)
+                    for owner_id in reading_owners:
+                        invalidate_user_analytics(owner_id)
+
                 self.process_device_alerts(controller, device_status)
 
+                for device, message in current_anomalies:
+                    raise_device_alert(device, controller, 'high_current', message)
+
                 return Response({
                     'message': 'Status received'
                 }, status=status.HTTP_200_OK)
@@ -843,49 +900,16 @@ class DeviceStatusView(APIView):
                             alert_type = 'offline'
                             message = f'Fault detected in {device.name}'
 
-                        # Create alert (check for recent alerts to avoid duplicates)
-                        recent_alert = DeviceAlert.objects.filter(
-                            device=device,
-                            alert_type=alert_type,
-                            created_at__gte=timezone.now() - timedelta(minutes=1)  # Reduced from 10 minutes
-                        ).first()
-
-                        if not recent_alert:
-                            DeviceAlert.objects.create(
-                                device=device,
-                                controller=controller,
-                                alert_type=alert_type,
-                                message=message
-                            )
-
-                            # Send WebSocket alert notification
-                            if device.owner:
-                                send_alert_notification(
-                                    user_email=device.owner.email,
-                                    alert_type=alert_type,
-                                    title=f"{device.name} Alert",
-                                    message=message,
-                                    device_id=device.device_id
-                                )
-
-                            # Create activity log
-                            ActivityLog.log_system_alert(
-                                device=device,
-                                alert_type=alert_type,
-                                message=message,
-                                details=f'Alert from controller {controller.controller_id}',
-                                controller=controller
-                            )
-
-                            print(f"🚨 NEW FAULT ALERT: {alert_type} for {device.name}")
-                        else:
-                            print(f"⚠️ Duplicate alert prevented: {alert_type} for {device.name}")
+                        raise_device_alert(device, controller, alert_type, message)
 
                     # Update the previous fault state for this device
                     if not device.previous_fault_state:
                         device.previous_fault_state = {}
-                    device.previous_fault_state[device_key] = current_fault
-                    device.save(update_fields=['previous_fault_state'])
+                    if device.previous_fault_state.get(device_key) != current_fault:
+                        device.previous_fault_state[device_key] = current_fault
+                        device.save(update_fields=['previous_fault_state'])
+                    else:
+                        metrics.incr('writes.coalesced')
 
                     # Log fault state changes for debugging
                     if current_fault != previous_fault:
@@ -994,6 +1018,7 @@ class DeviceAlertsView(APIView):
                 {'error': str(e)}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+@method_decorator(read_from_replica, name='dispatch')
 class DeviceListView(APIView):
     def get(self, request, format=None):
         """Get all paired devices for a user"""
@@ -1051,6 +1076,9 @@ class DeviceCommandStatusView(APIView):
                 'command_id': command.id,
                 'status': command.status,
                 'created_at': command.created_at,
+                'claimed_at': command.claimed_at,
+                'acked_at': command.acked_at,
+                'delivered_at': command.delivered_at,
                 'executed_at': command.executed_at
             }, status=status.HTTP_200_OK)
         except DeviceCommand.DoesNotExist:
@@ -1059,6 +1087,63 @@ class DeviceCommandStatusView(APIView):
                 status=status.HTTP_404_NOT_FOUND
             )
 
+def filter_activity_logs(queryset, params):
+    """Apply the activity log list filters and sorting from query parameters"""
+    log_type = params.get('type', 'all')  # all, error, warning, info
+    search_query = params.get('search', '')
+    date_filter = params.get('date', 'all')  # all, today, yesterday, week
+    device_id = params.get('device_id', '')
+    sort_by = params.get('sort_by', 'timestamp')  # timestamp, type, device
+    sort_order = params.get('sort_order', 'desc')  # asc, desc
+
+    # Apply filters
+    if log_type != 'all':
+        queryset = queryset.filter(log_type=log_type)
+
+    if search_query:
+        queryset = queryset.filter(
+            models.Q(message__icontains=search_query) |
+            models.Q(details__icontains=search_query) |
+            models.Q(device__name__icontains=search_query) |
+            models.Q(room__name__icontains=search_query)
+        )
+
+    if device_id:
+        queryset = queryset.filter(device__device_id=device_id)
+
+    # Date filtering
+    if date_filter != 'all':
+        now = timezone.now()
+        if date_filter == 'today':
+            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            queryset = queryset.filter(created_at__gte=start_date)
+        elif date_filter == 'yesterday':
+            yesterday = now - timedelta(days=1)
+            start_date = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
+            end_date = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
+            queryset = queryset.filter(created_at__range=[start_date, end_date])
+        elif date_filter == 'week':
+            week_ago = now - timedelta(days=7)
+            queryset = queryset.filter(created_at__gte=week_ago)
+
+    # Apply sorting
+    sort_field_map = {
+        'timestamp': 'created_at',
+        'type': 'log_type',
+        'device': 'device__name',
+        'room': 'room__name',
+        'message': 'message'
+    }
+
+    sort_field = sort_field_map.get(sort_by, 'created_at')
+
+    # Add descending order prefix if needed
+    if sort_order == 'desc':
+        sort_field = f'-{sort_field}'
+
+    return queryset.order_by(sort_field)
+
+@method_decorator(read_from_replica, name='dispatch')
 class ActivityLogListView(APIView):
     """Get activity logs for a user with filtering and pagination"""
     
@@ -1074,70 +1159,16 @@ class ActivityLogListView(APIView):
             try:
                 user = UserProfile.objects.get(email=email)
                 
-                # Get query parameters for filtering
-                log_type = request.query_params.get('type', 'all')  # all, error, warning, info
-                search_query = request.query_params.get('search', '')
-                date_filter = request.query_params.get('date', 'all')  # all, today, yesterday, week
-                device_id = request.query_params.get('device_id', '')
                 page = int(request.query_params.get('page', 1))
                 page_size = int(request.query_params.get('page_size', 5))
-                
-                # Get sorting parameters
                 sort_by = request.query_params.get('sort_by', 'timestamp')  # timestamp, type, device
                 sort_order = request.query_params.get('sort_order', 'desc')  # asc, desc
-                
-                # Base queryset - get logs for the user
-                queryset = ActivityLog.objects.filter(user=user).select_related(
-                    'device', 'controller', 'room'
+
+                queryset = filter_activity_logs(
+                    ActivityLog.objects.filter(user=user).select_related('device', 'controller', 'room'),
+                    request.query_params
                 )
-                
-                # Apply filters
-                if log_type != 'all':
-                    queryset = queryset.filter(log_type=log_type)
-                
-                if search_query:
-                    queryset = queryset.filter(
-                        models.Q(message__icontains=search_query) |
-                        models.Q(details__icontains=search_query) |
-                        models.Q(device__name__icontains=search_query) |
-                        models.Q(room__name__icontains=search_query)
-                    )
-                
-                if device_id:
-                    queryset = queryset.filter(device__device_id=device_id)
-                
-                # Date filtering
-                if date_filter != 'all':
-                    now = timezone.now()
-                    if date_filter == 'today':
-                        start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-                        queryset = queryset.filter(created_at__gte=start_date)
-                    elif date_filter == 'yesterday':
-                        yesterday = now - timedelta(days=1)
-                        start_date = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-                        end_date = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
-                        queryset = queryset.filter(created_at__range=[start_date, end_date])
-                    elif date_filter == 'week':
-                        week_ago = now - timedelta(days=7)
-                        queryset = queryset.filter(created_at__gte=week_ago)
-                
-                # Apply sorting
-                sort_field_map = {
-                    'timestamp': 'created_at',
-                    'type': 'log_type',
-                    'device': 'device__name',
-                    'room': 'room__name',
-                    'message': 'message'
-                }
-                
-                sort_field = sort_field_map.get(sort_by, 'created_at')
-                
-                # Add descending order prefix if needed
-                if sort_order == 'desc':
-                    sort_field = f'-{sort_field}'
-                
-                queryset = queryset.order_by(sort_field)
-                
+
                 # Paginate results
                 paginator = Paginator(queryset, page_size)
                 page_obj = paginator.get_page(page)
@@ -1194,6 +1225,158 @@ class ActivityLogListView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class Echo:
+    """File-like object whose write() returns the value, for streaming csv.writer output"""
+    def write(self, value):
+        return value
+
+class ActivityLogExportView(APIView):
+    """Stream every activity log matching the list filters as CSV or NDJSON"""
+
+    EXPORT_FIELDS = {
+        'id': 'id',
+        'timestamp': 'created_at',
+        'type': 'log_type',
+        'action_type': 'action_type',
+        'message': 'message',
+        'details': 'details',
+        'room': 'room__name',
+        'device_id': 'device__device_id',
+        'device_name': 'device__name',
+        'device_type': 'device__type',
+        'controller_id': 'controller__controller_id',
+        'controller_name': 'controller__name',
+        'source': 'source',
+        'ip_address': 'ip_address',
+    }
+    CHUNK_SIZE = 2000
+    FLUSH_BYTES = 64 * 1024
+
+    def get(self, request, format=None):
+        try:
+            email = request.query_params.get('email')
+            export_format = request.query_params.get('export_format', 'csv')  # csv, ndjson
+            use_gzip = request.query_params.get('gzip', '').lower() in ('1', 'true', 'yes')
+
+            if not email:
+                return Response(
+                    {'error': 'Email is required'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if export_format not in ('csv', 'ndjson'):
+                return Response(
+                    {'error': 'export_format must be "csv" or "ndjson"'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            try:
+                user = UserProfile.objects.get(email=email)
+            except UserProfile.DoesNotExist:
+                return Response(
+                    {'error': 'User not found'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+
+            logs = filter_activity_logs(ActivityLog.objects.filter(user=user), request.query_params)
+
+            # Under ASGI a sync iterator is drained into a list before sending,
+            # so the export is streamed from the async ORM there instead.
+            # values() rather than values_list(): the latter's aiterator()
+            # runs its query on the event loop.
+            if isinstance(request._request, ASGIRequest):
+                rows = logs.values(*self.EXPORT_FIELDS.values()).aiterator(chunk_size=self.CHUNK_SIZE)
+                lines = self.alines(rows, export_format)
+                content = self.agzip_stream(lines) if use_gzip else self.abatched(lines)
+            else:
+                rows = logs.values_list(*self.EXPORT_FIELDS.values()).iterator(chunk_size=self.CHUNK_SIZE)
+                lines = self.lines(rows, export_format)
+                content = self.gzip_stream(lines) if use_gzip else self.batched(lines)
+
+            filename = f"activity-logs-{timezone.now():%Y%m%d-%H%M%S}.{export_format}" + ('.gz' if use_gzip else '')
+            content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+            response = StreamingHttpResponse(content, content_type='application/gzip' if use_gzip else content_type)
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return response
+
+        except Exception as e:
+            logger.error(f"Error in ActivityLogExportView: {str(e)}")
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+    def line_formatter(self, export_format):
+        """The header line (empty for NDJSON) and a function turning one row into a line"""
+        names = list(self.EXPORT_FIELDS)
+        if export_format == 'csv':
+            writer = csv.writer(Echo())
+
+            def csv_line(row):
+                row = list(row)
+                row[1] = row[1].isoformat()
+                return writer.writerow(row)
+            return writer.writerow(names), csv_line
+
+        def ndjson_line(row):
+            record = dict(zip(names, row))
+            record['timestamp'] = record['timestamp'].isoformat()
+            return json.dumps(record, separators=(',', ':')) + '\n'
+        return '', ndjson_line
+
+    def lines(self, rows, export_format):
+        header, format_line = self.line_formatter(export_format)
+        if header:
+            yield header
+        for row in rows:
+            yield format_line(row)
+
+    async def alines(self, rows, export_format):
+        """lines() over an async iterator of values() dicts"""
+        header, format_line = self.line_formatter(export_format)
+        if header:
+            yield header
+        async for row in rows:
+            yield format_line(tuple(row.values()))
+
+    def batched(self, lines):
+        """Group small lines into larger chunks so each write to the socket carries real data"""
+        buffer, size = [], 0
+        for line in lines:
+            buffer.append(line)
+            size += len(line)
+            if size >= self.FLUSH_BYTES:
+                yield ''.join(buffer).encode()
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer).encode()
+
+    async def abatched(self, lines):
+        buffer, size = [], 0
+        async for line in lines:
+            buffer.append(line)
+            size += len(line)
+            if size >= self.FLUSH_BYTES:
+                yield ''.join(buffer).encode()
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer).encode()
+
+    def gzip_stream(self, lines):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+        for chunk in self.batched(lines):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    async def agzip_stream(self, lines):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        async for chunk in self.abatched(lines):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
 class UserProfileUpdateView(APIView):
     def get(self, request, format=None):
         """Get user profile details"""
@@ -1332,6 +1515,7 @@ class DeviceManagementView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+@method_decorator(read_from_replica, name='dispatch')
 class SystemSettingsView(APIView):
     def get(self, request, format=None):
         """Get system settings for a user"""
@@ -1389,6 +1573,7 @@ class SystemSettingsView(APIView):
             )
 
 class EmergencyControlsView(APIView):
+    @idempotent('emergency-controls', owner=profile_owner)
     def post(self, request, format=None):
         """Handle emergency controls"""
         try:
@@ -1420,6 +1605,9 @@ class EmergencyControlsView(APIView):
                                     status='pending'
                                 )
                     
+                    for controller in controllers:
+                        poll_advisor.note_activity(controller.controller_id)
+
                     # Log emergency shutdown
                     ActivityLog.log_user_action(
                         user=user,
@@ -1515,3 +1703,152 @@ class AlertDismissalView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class EnergyConsumptionView(APIView):
+    def get(self, request, format=None):
+        """Energy consumed per device and per room over a date range"""
+        try:
+            email = request.query_params.get('email')
+            if not email:
+                return Response(
+                    {'error': 'Email is required'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            today = timezone.localdate()
+            start_date = parse_date(request.query_params.get('start', '')) if request.query_params.get('start') else today
+            end_date = parse_date(request.query_params.get('end', '')) if request.query_params.get('end') else start_date
+
+            if not start_date or not end_date or end_date < start_date:
+                return Response(
+                    {'error': 'start and end must be YYYY-MM-DD dates with start <= end'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            try:
+                user = UserProfile.objects.get(email=email)
+
+                # Daily buckets make this a sum over (devices x days) rows, however many reports arrived
+                range_start = timezone.make_aware(datetime.combine(start_date, time.min))
+                range_end = timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min))
+                per_device = EnergyBucket.objects.filter(
+                    device__owner=user,
+                    period='day',
+                    start__gte=range_start,
+                    start__lt=range_end
+                ).values(
+                    'device__device_id', 'device__name', 'device__room_id', 'device__room__name'
+                ).annotate(
+                    total_kwh=models.Sum('kwh')
+                ).order_by('-total_kwh')
+
+                devices = []
+                rooms = {}
+                for row in per_device:
+                    kwh = round(row['total_kwh'], 4)
+                    devices.append({
+                        'device_id': row['device__device_id'],
+                        'name': row['device__name'],
+                        'room_id': row['device__room_id'],
+                        'kwh': kwh
+                    })
+                    room = rooms.setdefault(row['device__room_id'], {
+                        'room_id': row['device__room_id'],
+                        'room_name': row['device__room__name'],
+                        'kwh': 0.0
+                    })
+                    room['kwh'] = round(room['kwh'] + kwh, 4)
+
+                return Response({
+                    'start': start_date.isoformat(),
+                    'end': end_date.isoformat(),
+                    'total_kwh': round(sum(device['kwh'] for device in devices), 4),
+                    'devices': devices,
+                    'rooms': sorted(rooms.values(), key=lambda room: room['kwh'], reverse=True)
+                }, status=status.HTTP_200_OK)
+
+            except UserProfile.DoesNotExist:
+                return Response(
+                    {'error': 'User not found'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+
+        except Exception as e:
+            logger.error(f"Error in EnergyConsumptionView: {str(e)}")
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+class ConsumptionAnalyticsView(APIView):
+    def get(self, request, format=None):
+        """Load profile, peak hours, percentiles and week-over-week for a user's sockets"""
+        try:
+            email = request.query_params.get('email')
+            if not email:
+                return Response(
+                    {'error': 'Email is required'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            today = timezone.localdate()
+            end_date = parse_date(request.query_params.get('end', '')) if request.query_params.get('end') else today
+            start_date = parse_date(request.query_params.get('start', '')) if request.query_params.get('start') else None
+            if end_date and not start_date:
+                start_date = end_date - timedelta(days=29)
+
+            if not start_date or not end_date or end_date < start_date:
+                return Response(
+                    {'error': 'start and end must be YYYY-MM-DD dates with start <= end'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            try:
+                user = UserProfile.objects.get(email=email)
+
+                range_start = timezone.make_aware(datetime.combine(start_date, time.min))
+                range_end = timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min))
+                analytics = get_consumption_analytics(user, range_start, range_end)
+
+                return Response({
+                    'start': start_date.isoformat(),
+                    'end': end_date.isoformat(),
+                    **analytics
+                }, status=status.HTTP_200_OK)
+
+            except UserProfile.DoesNotExist:
+                return Response(
+                    {'error': 'User not found'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+
+        except Exception as e:
+            logger.error(f"Error in ConsumptionAnalyticsView: {str(e)}")
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class CommandLatencyView(APIView):
+    """Command latency percentiles per stage, fleet-wide or for ?controller_id= (staff only)"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        controller_id = request.query_params.get('controller_id')
+        return Response({
+            'generated_at': timezone.now().isoformat(),
+            'controller_id': controller_id,
+            'unit': 'seconds',
+            'stages': latency_summary(controller_id)
+        }, status=status.HTTP_200_OK)
+
+class SystemMetricsView(APIView):
+    """Operational counters of this worker process (staff only)"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response({
+            'generated_at': timezone.now().isoformat(),
+            **metrics.snapshot(),
+            'polling': poll_advisor.snapshot()
+        }, status=status.HTTP_200_OK)
@@ -1,11 +1,19 @@
 # core/websocket_utils.py
 import re
+import json
+import asyncio
 import logging
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 
+from core.command_latency import final_command_id, arecord_deliveries
+from core.dispatch import BatchDispatcher
+from core.event_stream import arecord_event, record_event
+from core.metrics import metrics
 from core.models import UserProfile
+from core.presence import ais_online, is_online
 
 logger = logging.getLogger(__name__)
 
@@ -13,45 +21,162 @@ def sanitize_group_name(name):
     """Sanitize group name to only contain allowed characters"""
     return re.sub(r'[^a-zA-Z0-9_\.-]', '_', name)
 
-def _safe_send(user_id, message):
-    """Helper function to safely send WebSocket messages with error handling"""
+def _count_offline_skip(message_type):
+    metrics.incr('websocket.sends_skipped_offline')
+    metrics.incr(f'websocket.sends_skipped_offline.{message_type}')
+
+def _user_offline(user_email, message_type):
+    """True (and counted) when the user has no open socket, so the send can be skipped.
+
+    The event has already been buffered by record_event, so a client that
+    reconnects with since=<seq> still receives it.
+    """
+    if is_online(user_email):
+        return False
+    _count_offline_skip(message_type)
+    return True
+
+async def _auser_offline(user_email, message_type):
+    if await ais_online(user_email):
+        return False
+    _count_offline_skip(message_type)
+    return True
+
+def encode_channel_message(message):
+    """Channel layer message carrying the client JSON already encoded.
+
+    The text is serialized once here instead of by every socket the user has
+    open, and the layer only has to pack a flat string rather than the nested
+    event. ``type`` routes to the consumer handler and ``seq`` stays readable
+    for its replay check.
+    """
+    return {
+        'type': message['type'],
+        'seq': message.get('seq'),
+        'text': json.dumps(message),
+    }
+
+async def _group_send(channel_layer, group_name, channel_message):
     try:
-        channel_layer = get_channel_layer()
-        # Create group name using user ID
-        group_name = f'user_{user_id}'
-        group_name = sanitize_group_name(group_name)
-        
-        async_to_sync(channel_layer.group_send)(
-            group_name,
-            message
-        )
+        await channel_layer.group_send(group_name, channel_message)
+        metrics.incr('websocket.sends')
         return True
     except Exception as e:
+        metrics.incr('websocket.send_errors')
         logger.error(f"WebSocket send error: {str(e)}. Group: {group_name}", exc_info=True)
         return False
 
+def _prepare_batch(items):
+    """Number, buffer and address queued (user_email, message) pairs.
+
+    Users without an open socket are skipped after their events are
+    buffered, and the remaining users' ids come from a single query.
+    Returns group name -> [(channel message, id of the command whose result
+    it reports or None)].
+    """
+    online = []
+    for user_email, message in items:
+        message = record_event(user_email, message)
+        if not _user_offline(user_email, message['type']):
+            online.append((user_email, message))
+    if not online:
+        return {}
+
+    user_ids = dict(
+        UserProfile.objects.filter(email__in={user_email for user_email, _ in online}).values_list('email', 'id')
+    )
+    groups = {}
+    for user_email, message in online:
+        if user_email not in user_ids:
+            logger.error(f"Failed to send {message['type']}: no user found with email {user_email}")
+            continue
+        group_name = sanitize_group_name(f'user_{user_ids[user_email]}')
+        groups.setdefault(group_name, []).append((encode_channel_message(message), final_command_id(message)))
+    return groups
+
+async def _send_batch(groups):
+    """Send each group's messages in order, all groups concurrently"""
+    channel_layer = get_channel_layer()
+    delivered_commands = []
+
+    async def send_in_order(group_name, channel_messages):
+        for channel_message, command_id in channel_messages:
+            if await _group_send(channel_layer, group_name, channel_message) and command_id:
+                delivered_commands.append(command_id)
+
+    await asyncio.gather(*(send_in_order(group_name, messages) for group_name, messages in groups.items()))
+    await arecord_deliveries(delivered_commands)
+
+def _send_in_background():
+    # The in-memory layer only works on the event loop of the process serving
+    # the sockets, so it keeps sending inline after commit
+    return (
+        getattr(settings, 'WEBSOCKET_BACKGROUND_DISPATCH', True)
+        and not isinstance(get_channel_layer(), InMemoryChannelLayer)
+    )
+
+websocket_dispatcher = BatchDispatcher(
+    'websocket.dispatch',
+    _prepare_batch,
+    _send_batch,
+    background=_send_in_background,
+    batch_size=getattr(settings, 'WEBSOCKET_DISPATCH_BATCH_SIZE', 100)
+).register_flush_at_exit()
+
+def _dispatch(user_email, message):
+    """Queue a message for the user once the current transaction commits.
+
+    Outside a transaction it is queued right away. Nothing is sent for a
+    transaction that rolls back, and the request never waits on the layer.
+    """
+    transaction.on_commit(lambda: websocket_dispatcher.submit((user_email, message)))
+    return True
+
+def _device_status_message(device_id, status, current_value):
+    return {
+        'type': 'device_status',
+        'timestamp': timezone.now().isoformat(),
+        'data': {
+            'device_id': device_id,
+            'status': status,
+            'current_value': current_value,
+            'last_seen': timezone.now().isoformat()
+        }
+    }
+
+def _command_update_message(command_id, device_id, status, time_remaining, error):
+    return {
+        'type': 'command_update',
+        'timestamp': timezone.now().isoformat(),
+        'data': {
+            'command_id': command_id,
+            'device_id': device_id,
+            'status': status,
+            'time_remaining': time_remaining,
+            'error': error
+        }
+    }
+
+def _alert_message(alert_type, title, message, device_id):
+    return {
+        'type': 'alert_notification',
+        'timestamp': timezone.now().isoformat(),
+        'data': {
+            'alert_type': alert_type,  # 'short_circuit', 'overload', 'device_off', 'success', etc.
+            'title': title,
+            'message': message,
+            'device_id': device_id
+        }
+    }
+
 def send_device_status_update(user_email, device_id, status, current_value=None):
     """Send device status update via Websocket"""
     try:
-        user = UserProfile.objects.filter(email=user_email).first()
-        if not user:
-            logger.error(f"Failed to send device status: no user found with email {user_email}")
-            return False
-            
-        message = {
-            'type': 'device_status',
-            'timestamp': timezone.now().isoformat(),
-            'data': {
-                'device_id': device_id,
-                'status': status,
-                'current_value': current_value,
-                'last_seen': timezone.now().isoformat()
-            }
-        }
+        message = _device_status_message(device_id, status, current_value)
 
         print(f"📤 WebSocket message being sent: {message}")
-        
-        return _safe_send(user.id, message)
+
+        return _dispatch(user_email, message)
         
     except Exception as e:
         logger.error(f"Critical error in send_device_status_update: {str(e)}", exc_info=True)
@@ -60,24 +185,8 @@ def send_device_status_update(user_email, device_id, status, current_value=None)
 def send_command_status_update(user_email, command_id, device_id, status, time_remaining=None, error=None):
     """Send command status update via WebSocket"""
     try:
-        user = UserProfile.objects.filter(email=user_email).first()
-        if not user:
-            logger.error("Failed to send command update: invalid user")
-            return False
-            
-        message = {
-            'type': 'command_update',
-            'timestamp': timezone.now().isoformat(),
-            'data': {
-                'command_id': command_id,
-                'device_id': device_id,
-                'status': status,
-                'time_remaining': time_remaining,
-                'error': error
-            }
-        }
-        
-        return _safe_send(user.id, message)
+        message = _command_update_message(command_id, device_id, status, time_remaining, error)
+        return _dispatch(user_email, message)
         
     except Exception as e:
         logger.error(f"Critical error in send_command_status_update: {str(e)}", exc_info=True)
@@ -86,26 +195,47 @@ def send_command_status_update(user_email, command_id, device_id, status, time_r
 def send_alert_notification(user_email, alert_type, title, message, device_id=None):
     """Send alert notification via WebSocket"""
     try:
-        user = UserProfile.objects.filter(email=user_email).first()
-        if not user:
-            logger.error(f"Failed to send alert: no user found with email {user_email}")
-            return False
-            
-        message_data = {
-            'type': 'alert_notification',
-            'timestamp': timezone.now().isoformat(),
-            'data': {
-                'alert_type': alert_type,  # 'short_circuit', 'overload', 'device_off', 'success', etc.
-                'title': title,
-                'message': message,
-                'device_id': device_id
-            }
-        }
+        message_data = _alert_message(alert_type, title, message, device_id)
 
         print(f"🚨 Alert WebSocket message being sent: {message_data}")
-        
-        return _safe_send(user.id, message_data)
+
+        return _dispatch(user_email, message_data)
         
     except Exception as e:
         logger.error(f"Critical error in send_alert_notification: {str(e)}", exc_info=True)
-        return False
\ No newline at end of file
+        return False
+
+# Async versions for views running on the event loop; they await the channel
+# layer directly instead of going through async_to_sync
+
+async def _adeliver(user_email, message):
+    message = await arecord_event(user_email, message)
+    if await _auser_offline(user_email, message['type']):
+        return True
+
+    user = await UserProfile.objects.filter(email=user_email).afirst()
+    if not user:
+        logger.error(f"Failed to send {message['type']}: no user found with email {user_email}")
+        return False
+
+    group_name = sanitize_group_name(f'user_{user.id}')
+    sent = await _group_send(get_channel_layer(), group_name, encode_channel_message(message))
+    command_id = final_command_id(message)
+    if sent and command_id:
+        await arecord_deliveries([command_id])
+    return sent
+
+async def asend_device_status_update(user_email, device_id, status, current_value=None):
+    """Async version of send_device_status_update"""
+    return await _adeliver(user_email, _device_status_message(device_id, status, current_value))
+
+async def asend_command_status_update(user_email, command_id, device_id, status, time_remaining=None, error=None):
+    """Async version of send_command_status_update"""
+    return await _adeliver(
+        user_email,
+        _command_update_message(command_id, device_id, status, time_remaining, error)
+    )
+
+async def asend_alert_notification(user_email, alert_type, title, message, device_id=None):
+    """Async version of send_alert_notification"""
+    return await _adeliver(user_email, _alert_message(alert_type, title, message, device_id))